@@ -0,0 +1,725 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for the bot. Nothing here talks to Slack: the Web API is played by
+FakeSlacker, which answers from a made-up workspace after a fixed delay per call, and the RTM
+socket by FakeSocket.
+
+    python benchmarks.py                          # Run everything.
+    python benchmarks.py cold_start               # Run some of it.
+    python benchmarks.py --save baseline.json     # Keep the results...
+    python benchmarks.py --compare baseline.json  # ...and check a later run against them.
+
+The hot-path benchmarks (parse_message, respond, deck_ops) time every operation on its own and
+report ops/sec and latency percentiles; --save writes those to a JSON file, and --compare flags
+any that got slower than the saved ones by more than --tolerance.
+"""
+
+import argparse
+import collections
+import functools
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from game_journal import GameJournal
+from game_objects import Card, CardDeck, CardPile, deck_dict
+from slack_directory import SlackDirectory
+
+## Stand-ins.
+
+class FakeResponse(object):
+    "Looks like a slacker.Response, as far as we use one."
+    def __init__(self, body):
+        self.body = body
+
+class FakeSlacker(object):
+    """
+    Plays the part of slacker.Slacker for a workspace with num_users users (each with an IM)
+    and num_channels channels. Every API call sleeps for api_delay seconds first.
+    """
+
+    class _Endpoint(object):
+        def __init__(self, **methods):
+            self.__dict__.update(methods)
+
+    def __init__(self, num_users=100, num_channels=10, api_delay=0.0):
+        self.api_delay = api_delay
+        self.calls = collections.Counter()
+        self.posts = []
+        members = [{'id':'U{:06d}'.format(i), 'name':'user{}'.format(i)} for i in range(num_users)]
+        channels = [{'id':'C{:06d}'.format(i), 'name':'channel{}'.format(i)} for i in range(num_channels)]
+        ims = [{'id':'D{:06d}'.format(i), 'user':member['id']} for i, member in enumerate(members)]
+        self.users = self._Endpoint(
+            list=self._api('users.list', lambda: {'members':members}),
+            info=self._api('users.info', lambda user: {'user':self._find(members, user, 'user_not_found')}))
+        self.channels = self._Endpoint(
+            list=self._api('channels.list', lambda: {'channels':channels}),
+            info=self._api('channels.info', lambda channel: {'channel':self._find(channels, channel, 'channel_not_found')}))
+        self.groups = self._Endpoint(
+            list=self._api('groups.list', lambda: {'groups':[]}),
+            info=self._api('groups.info', lambda channel: {'group':self._find([], channel, 'channel_not_found')}))
+        self.im = self._Endpoint(
+            list=self._api('im.list', lambda: {'ims':ims}),
+            open=self._api('im.open', lambda user: {'channel':{'id':'D' + user}}))
+        self.chat = self._Endpoint(
+            post_message=self._api('chat.postMessage', self._post_message))
+
+    def _api(self, name, method):
+        def api_call(*args, **kwargs):
+            self.calls[name] += 1
+            if self.api_delay:
+                time.sleep(self.api_delay)
+            return FakeResponse(method(*args, **kwargs))
+        return api_call
+
+    @staticmethod
+    def _find(items, item_id, error):
+        for item in items:
+            if item['id'] == item_id:
+                return item
+        raise StandardError, error
+
+    def _post_message(self, channel, text, as_user=True):
+        self.posts.append((channel, text))
+        return {'ok':True}
+
+class FakeSocket(object):
+    "Plays the part of slacksocket.SlackSocket: events() yields whatever it was given."
+    def __init__(self, events=()):
+        self._events = list(events)
+
+    def events(self):
+        return iter(self._events)
+
+class FakeEvent(object):
+    "Looks like a slacksocket event, as far as we use one."
+    def __init__(self, type, **event):
+        self.type = type
+        self.event = event
+
+class ListCardDeck(CardDeck):
+    "CardDeck as it was before it kept its cards in a deque; every draw or insert copies the list."
+
+    def __init__(self, cards, name=None):
+        super(ListCardDeck, self).__init__(cards, name)
+        self._cards = list(cards)
+
+    def peek(self, num_cards='all'):
+        if num_cards == 'all':
+            return tuple(self._cards)
+        return tuple(self._cards[:num_cards])
+
+    def shuffle(self):
+        random.shuffle(self._cards)
+        return self
+
+    def draw(self, num_cards=1):
+        assert isinstance(num_cards,int) and num_cards > 0
+        drawn_cards = self._cards[:num_cards]
+        self._cards = self._cards[num_cards:]
+        return drawn_cards
+
+    def insert(self, cards, top=True):
+        if isinstance(cards,Card):
+            cards = list([cards])
+        elif isinstance(cards,(tuple,set,list)):
+            assert all(isinstance(card,Card) for card in cards), "all cards must be Card type"
+            cards = list(cards)
+        if top:
+            self._cards = cards + self._cards
+        else:
+            self._cards += cards
+        return self
+
+class DictCard(object):
+    "Card as it was before it had __slots__: every card carries its own attribute dict."
+    def __init__(self, suit=None, rank=None, name=None, details=None):
+        self._suit = suit
+        self._rank = rank
+        self._name = name
+        self._details = details
+
+class DictMessage(object):
+    """
+    Message as it was before it had __slots__: checked field by field, and tokenized as it's made,
+    whether anything reads the words or not.
+    """
+    TOKENIZER_RE = re.compile(r'(?:@?\w+|`[^`]*`)')
+    def __init__(self, text=None, user_id=None, chan_id=None, im=False, user_name=None,
+                 chan_name=None):
+        assert isinstance(text, (basestring))
+        self.text = text
+        assert isinstance(user_id, (basestring))
+        self.user_id = user_id
+        assert isinstance(chan_id, (basestring))
+        self.chan_id = chan_id
+        assert isinstance(im, bool)
+        self.im = im
+        if user_name: assert isinstance(user_name, (basestring))
+        self.user_name = user_name
+        if chan_name: assert isinstance(chan_name, (basestring))
+        self.chan_name = chan_name
+        tokenized = self.TOKENIZER_RE.findall(text.lower())
+        if tokenized: assert (isinstance(tokenized, (list, tuple))
+                              and all(isinstance(x, basestring) for x in tokenized))
+        self.tokenized = tokenized
+
+def deep_sizeof(obj, seen=None):
+    "Roughly how many bytes obj takes, counting everything it refers to once."
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_sizeof(getattr(obj, slot), seen)
+                    for slot in obj.__slots__ if hasattr(obj, slot))
+    return size
+
+# Run in a fresh interpreter by bench_startup: import a module with every import timed, in the
+# spirit of python3's -X importtime, and print the cumulative and self time (in us) of each import.
+IMPORT_TIMER = '''
+import __builtin__, sys, time
+real_import = __builtin__.__import__
+timings, stack = [], []
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return real_import(name, *args, **kwargs)
+    stack.append(0.0)
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        timings.append((elapsed, elapsed - nested, name))
+__builtin__.__import__ = timed_import
+import {module}
+for timing in timings:
+    print 'importtime: %d %d %s' % (timing[0] * 1e6, timing[1] * 1e6, timing[2])
+'''
+
+## Measurement.
+
+class Quiet(object):
+    "Throw away anything printed inside the with block."
+    def __enter__(self):
+        self._stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+
+def percentile(sorted_values, fraction):
+    "The value fraction of the way through sorted_values (nearest rank)."
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def measure(name, op, min_ops=200, min_time=0.5, setup=None):
+    """
+    Call op() over and over, timing each call, until it's run at least min_ops times and for at
+    least min_time seconds. If there's a setup, call it (untimed) before each op. Record and
+    print the ops/sec and latency percentiles under name, and return them.
+    """
+    timer = timeit.default_timer
+    latencies = []
+    elapsed = 0.0
+    with Quiet():
+        while len(latencies) < min_ops or elapsed < min_time:
+            if setup:
+                setup()
+            start = timer()
+            op()
+            latency = timer() - start
+            latencies.append(latency)
+            elapsed += latency
+    latencies.sort()
+    stats = {
+        'ops':len(latencies),
+        'ops_per_sec':len(latencies) / elapsed if elapsed else float('inf'),
+        'p50_us':percentile(latencies, 0.50) * 1e6,
+        'p90_us':percentile(latencies, 0.90) * 1e6,
+        'p99_us':percentile(latencies, 0.99) * 1e6,
+        'max_us':latencies[-1] * 1e6}
+    RESULTS[name] = stats
+    print "{:<44s} {:>11.0f} ops/s  p50={:8.1f}us  p90={:8.1f}us  p99={:8.1f}us".format(
+        name, stats['ops_per_sec'], stats['p50_us'], stats['p90_us'], stats['p99_us'])
+    return stats
+
+# Everything measure()d in this run, by name.
+RESULTS = collections.OrderedDict()
+
+def save_results(path):
+    "Write this run's results to path as JSON, to compare later runs against."
+    with open(path, 'wb') as results_file:
+        json.dump({
+            'python':platform.python_version(),
+            'machine':platform.machine(),
+            'time':time.time(),
+            'results':RESULTS}, results_file, indent=1, sort_keys=True)
+
+def compare_results(path, tolerance):
+    """
+    Compare this run with the results saved at path. Print how each benchmark's ops/sec and p99
+    latency changed, and return the names of those that lost more than tolerance (a fraction).
+    """
+    with open(path, 'rb') as results_file:
+        baseline = json.load(results_file)['results']
+    regressions = []
+    for name, stats in RESULTS.iteritems():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        speed = stats['ops_per_sec'] / old['ops_per_sec'] if old['ops_per_sec'] else 1.0
+        latency = stats['p99_us'] / old['p99_us'] if old['p99_us'] else 1.0
+        regressed = speed < 1 - tolerance or latency > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print "{:<44s} ops/s x{:5.2f}  p99 x{:5.2f}{}".format(
+            name, speed, latency, '  REGRESSED' if regressed else '')
+    return regressions
+
+## Benchmarks.
+
+def bench_cold_start(args):
+    """
+    How long until the directory can serve its first message: a full refresh from the list APIs,
+    versus loading a snapshot (and reconciling in the background).
+    """
+    snapshot_dir = tempfile.mkdtemp()
+    snapshot_path = os.path.join(snapshot_dir, 'directory.snapshot')
+    try:
+        for num_users in (100, 1000, 10000, 100000):
+            slack = FakeSlacker(num_users, num_users // 10, args.api_delay)
+            start = time.time()
+            directory = SlackDirectory(slack)
+            directory.start(None)
+            refresh_time = time.time() - start
+            directory.save(snapshot_path)
+
+            start = time.time()
+            directory = SlackDirectory(slack)
+            reconcile = directory.start(snapshot_path)
+            snapshot_time = time.time() - start
+            reconcile.join()
+
+            print "cold_start users={:<7d} refresh={:8.1f}ms  snapshot={:8.1f}ms  ({} bytes)".format(
+                num_users, refresh_time * 1000, snapshot_time * 1000, os.path.getsize(snapshot_path))
+    finally:
+        shutil.rmtree(snapshot_dir)
+
+def bench_journal(args):
+    """
+    What journaling costs a handler (per op, for a deal-heavy game), and how long it takes to
+    rebuild every game from the journal after a restart, for increasingly many big games.
+    """
+    import slack_dicebot
+    deck = deck_dict['poker_deck']
+    game_factory = lambda: slack_dicebot.RegexCardGame(deck=deck.copy())
+    journal_dir = tempfile.mkdtemp()
+    try:
+        for num_games in (10, 100, 1000):
+            journal_path = os.path.join(journal_dir, 'games.journal')
+            journal = GameJournal(journal_path)
+            games = []
+            for i in range(num_games):
+                game = game_factory()
+                game.attach_journal(functools.partial(journal.append, 'C{:06d}'.format(i)))
+                game.replay('wake', {'chan_id':'C{:06d}'.format(i), 'chan_name':'channel'})
+                for player in range(8):
+                    game.replay('join', {'player_id':'U{}'.format(player), 'player_name':'p{}'.format(player)})
+                games.append(game)
+
+            start = time.time()
+            num_ops = 0
+            for game in games:
+                game._apply('begin')
+                for _ in range(20):
+                    game._shuffle()
+                    for player in range(8):
+                        game._apply('deal', player_id='U{}'.format(player), num_cards=3)
+                        game._apply('discard', player_id='U{}'.format(player))
+                    num_ops += 17
+            op_time = (time.time() - start) / num_ops
+            journal.close()
+
+            start = time.time()
+            registry = slack_dicebot.GameRegistry(game_factory, GameJournal(journal_path))
+            recovery_time = time.time() - start
+            assert len(registry) == num_games
+            print "journal games={:<5d} {:6.1f}us/op  recovery={:8.1f}ms  ({} records)".format(
+                num_games, op_time * 1e6, recovery_time * 1000,
+                sum(1 for _ in open(journal_path)))
+            os.remove(journal_path)
+    finally:
+        shutil.rmtree(journal_dir)
+
+def bench_deck(args):
+    """
+    Dealing from shoes of increasingly many poker decks: draw 3, put them back on the bottom,
+    peek at the top 5, put one on top. The list-backed deck copies the shoe for each of these.
+    """
+    poker_cards = deck_dict['poker_deck'].peek()
+    for num_decks in (1, 10, 100, 1000):
+        cards = [Card(name=card.name) for _ in range(num_decks) for card in poker_cards]
+        timings = []
+        for deck_class in (ListCardDeck, CardDeck):
+            deck = deck_class(cards, name='Shoe').shuffle()
+            rounds = 2000
+            best = None
+            # Best of several runs: one run of a few microseconds a round is mostly noise.
+            for _ in xrange(5):
+                start = time.time()
+                for _ in xrange(rounds):
+                    deck.insert(deck.draw(3), top=False)
+                    deck.peek(5)
+                    deck.insert(deck.draw(1), top=True)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best / rounds)
+        print "deck cards={:<6d} list={:8.2f}us/round  deque={:6.2f}us/round".format(
+            len(cards), timings[0] * 1e6, timings[1] * 1e6)
+
+def bench_memory(args):
+    """
+    What a game's cards cost: a shuffled copy of the poker deck split among 8 hands, per game.
+    Before, each game had its own copies of the cards (with attribute dicts) in its lists and sets;
+    now every game shares one catalog of slotted cards and keeps only their ids.
+    """
+    poker_cards = deck_dict['poker_deck'].peek()
+    catalog = deck_dict['poker_deck'].catalog
+    for num_games in (1, 100, 1000):
+        # Keep every game alive until it's been measured, so no id() gets reused.
+        games = []
+        for _ in range(num_games):
+            cards = [DictCard(name=card.name, details=card.details) for card in poker_cards]
+            random.shuffle(cards)
+            games.append((cards[24:], [set(cards[i * 3:i * 3 + 3]) for i in range(8)]))
+        old_size = deep_sizeof(games)
+
+        games = []
+        for _ in range(num_games):
+            deck = deck_dict['poker_deck'].copy().shuffle()
+            hands = [CardPile(deck.draw(3), name='Hand', catalog=catalog) for _ in range(8)]
+            games.append((deck._cards, [hand._cards for hand in hands]))
+        new_size = deep_sizeof((catalog, games))
+        print "memory games={:<5d} per-game cards={:10d} bytes  shared catalog={:10d} bytes".format(
+            num_games, old_size, new_size)
+
+def bench_startup(args):
+    """
+    How long importing the bot's modules takes in a fresh interpreter (best of several runs), and
+    which imports cost the most themselves. Building decks and importing the Slack clients should
+    not show up here: they happen on first use.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module in ('game_objects', 'slack_dicebot', 'benchmarks'):
+        runs = []
+        for _ in range(5):
+            output = subprocess.check_output(
+                [sys.executable, '-c', IMPORT_TIMER.format(module=module)], cwd=here)
+            timings = [line.split(' ', 3)[1:] for line in output.splitlines()
+                       if line.startswith('importtime: ')]
+            runs.append([(int(total), int(own), name) for total, own, name in timings])
+        best = min(runs, key=lambda timings: sum(own for _, own, _ in timings))
+        print "startup {:<14s} {:8.1f}ms  slowest: {}".format(
+            module, sum(own for _, own, _ in best) / 1000.0,
+            ', '.join('{} {:.1f}ms'.format(name, own / 1000.0)
+                      for _, own, name in sorted(best, reverse=True, key=lambda t: t[1])[:3]))
+
+def bench_render(args):
+    """
+    Building the help text and a player's hand, as a busy game does over and over: formatting
+    them from scratch every time, versus the parsed and cached templates in slack_templates.
+    """
+    from slack_templates import CardListRenderer
+    import slack_dicebot
+    help_template = slack_dicebot.RegexCardGame.HELP_TEMPLATE_BY_STATE[slack_dicebot.RegexCardGame.ACTIVE_GAME]
+    deck = deck_dict['poker_deck'].copy()
+    card_lists = CardListRenderer()
+    rounds = 20000
+    for hand_size in (5, 13, 52):
+        hand = CardPile(deck.peek(hand_size), name='Hand', indexed=True)
+        start = time.time()
+        for _ in xrange(rounds):
+            help_template.text.format(B_U_ID='UBOT', CHANNEL='general')
+            u"\n".join(u' \u2022 `{}`'.format(card.name) for card in sorted(hand.peek()))
+        format_time = (time.time() - start) / rounds
+        start = time.time()
+        for _ in xrange(rounds):
+            help_template.render(B_U_ID='UBOT', CHANNEL='general')
+            card_lists.render_pile('U1', hand)
+        template_time = (time.time() - start) / rounds
+        print "render hand={:<3d} format={:7.2f}us  templates={:5.2f}us".format(
+            hand_size, format_time * 1e6, template_time * 1e6)
+
+        # A card in and a card out between renders, as when a player draws and plays: the whole
+        # list built again from the sorted pile, versus just those two lines spliced.
+        spare = [card for card in deck.peek() if card not in hand.peek()][:1]
+        start = time.time()
+        for _ in xrange(rounds):
+            spare = cycle_card(hand, spare)
+            card_lists.render(hand.peek_sorted(), sort=False)
+        rebuild_time = (time.time() - start) / rounds
+        start = time.time()
+        for _ in xrange(rounds):
+            spare = cycle_card(hand, spare)
+            card_lists.render_pile('U1', hand)
+        splice_time = (time.time() - start) / rounds
+        print "render hand={:<3d} changed: rebuild={:7.2f}us  splice={:7.2f}us".format(
+            hand_size, rebuild_time * 1e6, splice_time * 1e6)
+
+def cycle_card(pile, spare):
+    "Put the spare card(s) in the pile and take its first card out; return that, as the next spare."
+    out = pile.peek_sorted()[0]
+    pile.add(spare)
+    pile.pull_named(out.name)
+    return [out]
+
+def bench_parse_message(args):
+    """
+    SlackInterface._parse_message on a mention in a channel, chatter that isn't for us, and an IM,
+    in increasingly big workspaces (all of it already in the directory).
+    """
+    import slack_dicebot
+    from slack_token import BOT_USER_NAME
+    for num_users in (100, 10000, 100000):
+        slack = FakeSlacker(num_users, max(1, num_users // 100))
+        with Quiet():
+            interface = slack_dicebot.SlackInterface(
+                slack_dicebot.GameRegistry(lambda: slack_dicebot.RegexCardGame(deck=deck_dict['poker_deck'].copy())),
+                slack=slack, socket=FakeSocket())
+        user_id = 'U{:06d}'.format(num_users // 2)
+        events = (
+            ('mention', FakeEvent('message', user=user_id, channel='C000000',
+                                  text=u'@{} deal 2 to <@{}>'.format(BOT_USER_NAME, user_id))),
+            ('chatter', FakeEvent('message', user=user_id, channel='C000000',
+                                  text=u'lunch, anyone? <@U000001> <@U000002>')),
+            ('im', FakeEvent('message', user=user_id, channel='D{:06d}'.format(num_users // 2),
+                             text=u'check hand')))
+        for kind, event in events:
+            measure('parse_message users={} {}'.format(num_users, kind),
+                    functools.partial(interface._parse_message, event))
+
+def bench_message(args):
+    """
+    What a Message costs to make and keep, before (DictMessage: checked and tokenized up front,
+    with an attribute dict) and now (slotted, tokenized only when something asks), for a message
+    nothing reads the words of and one that's answered.
+    """
+    from slack_objects import Message
+    text = u'@dealer deal 2 to @someone, and then `check deck 3` if you would, thanks'
+    fields = dict(text=text, user_id='U000001', user_name='someone', chan_id='C000001',
+                  chan_name='general', im=False)
+
+    def new_unread():
+        return Message(**fields)
+    def new_read():
+        msg = Message(**fields)
+        msg.token_set
+        return msg
+    for name, make in (('before', lambda: DictMessage(**fields)),
+                       ('now unread', new_unread),
+                       ('now read', new_read)):
+        measure('message make {}'.format(name), make, min_ops=1000)
+        # Keep every message alive until it's been measured, so no id() gets reused.
+        messages = [make() for _ in range(1000)]
+        per_message = (deep_sizeof(messages) - deep_sizeof([None] * 1000)) // 1000
+        # The text is the same str in each, and deep_sizeof counts it once; count it in each.
+        print "message size {:<10s} {:6d} bytes each".format(name, per_message + sys.getsizeof(text))
+
+def bench_respond(args):
+    """
+    respond_to_message for both kinds of game, in each state, over a mix of what players say
+    there (chosen so that the game ends each round in the state it started in).
+    """
+    import slack_dicebot
+    from slack_objects import Message
+    from slack_token import BOT_USER_NAME
+
+    def message(text, user_id='U1', im=False):
+        text = u'@{} {}'.format(BOT_USER_NAME, text)
+        return Message(text=text, user_id=user_id, user_name=user_id.lower(), chan_id='C1',
+                       chan_name='general', im=im,
+                       tokenized=[word.lower() for word in text.replace('@', ' @').split()])
+
+    with Quiet():
+        game = slack_dicebot.RegexCardGame(deck=deck_dict['poker_deck'].copy())
+    messages_by_state = collections.OrderedDict((
+        ('asleep', ([], [u'hello?', u'are you awake'])),
+        ('accepting_players', ([u'wake', u'join'], [u'list', u'help', u'join', u'what now'])),
+        ('active_game', ([u'begin game'], [
+            u'deal 2 to me', u'check hand', u'where is Ace of Spades', u'check deck 3',
+            u'discard hand', u'list', u'huh'])),
+    ))
+    for state, (to_get_there, messages) in messages_by_state.iteritems():
+        with Quiet():
+            for text in to_get_there:
+                game.respond_to_message(message(text))
+        cycle = itertools.cycle([message(text) for text in messages])
+        measure('respond regex {}'.format(state),
+                lambda: game.respond_to_message(next(cycle)))
+
+    with Quiet():
+        game = slack_dicebot.MethodCardGame(deck=deck_dict['poker_deck'].copy())
+    for state in (game.ASLEEP, game.ACCEPTING_PLAYERS, game.ACTIVE_GAME):
+        game.state = state
+        game.game_chan_id, game.game_chan_name = 'C1', 'general'
+        cycle = itertools.cycle([message(text) for text in (u'hello?', u'list', u'check hand')])
+        measure('respond method {}'.format(messages_by_state.keys()[state]),
+                lambda: game.respond_to_message(next(cycle)))
+
+def bench_match(args):
+    """
+    CommandMatcher against searching with each of a state's regexes in turn (as RegexResponder
+    used to), on a command, chatter that isn't for us, and a long message.
+    """
+    import slack_dicebot
+    from slack_token import BOT_USER_NAME
+    game = slack_dicebot.RegexCardGame
+    table = game.REGEX_METHOD_BY_STATE[game.ACTIVE_GAME]
+    matcher = slack_dicebot.CommandMatcher(table)
+    def search_in_turn(text):
+        for regex_obj, method_name in table:
+            match_obj = regex_obj.search(text)
+            if match_obj:
+                return method_name, match_obj
+        return None, None
+    texts = (
+        ('command', u'@{} deal 3 to @bob'.format(BOT_USER_NAME)),
+        ('chatter', u'lunch, anyone? I was thinking about that new place by the station'),
+        ('long', (u'some long chatter without the name in it at all, going on and on ' * 7)[:400]))
+    for kind, text in texts:
+        measure('match loop {}'.format(kind), functools.partial(search_in_turn, text), min_ops=1000)
+        measure('match matcher {}'.format(kind), functools.partial(matcher.match, text), min_ops=1000)
+
+def _numpy_version():
+    from numpy_support import HAVE_NUMPY
+    if not HAVE_NUMPY:
+        return 'no'
+    import numpy
+    return numpy.__version__
+
+def bench_odds(args):
+    """
+    DeckOdds on the poker deck: exact (hypergeometric) answers, a simulated one for wants that share
+    a card (a million shuffles, or fewer without NumPy), and that again before the deck changes,
+    from the cache.
+    """
+    import odds
+    deck = deck_dict['poker_deck'].copy().shuffle()
+    cards = deck.peek()
+    aces = odds.parse_want(cards, u'2 aces')
+    kings = odds.parse_want(cards, u'a king')
+    spades = odds.parse_want(cards, u'a spades')
+    print "odds numpy={}".format(_numpy_version())
+    measure('odds exact', lambda: odds.draw_odds(cards, [aces], 5))
+    measure('odds exact disjoint', lambda: odds.draw_odds(cards, [aces, kings], 100))
+    measure('odds simulated', lambda: odds.draw_odds(cards, [aces, spades], 5), min_ops=5)
+    deck_odds = odds.DeckOdds(deck)
+    deck_odds.odds([aces, spades], 5)
+    measure('odds cached', lambda: deck_odds.odds([aces, spades], 5))
+
+def bench_dice(args):
+    """
+    dice.roll on small rolls, repeated rolls and huge pools; parsing is cached after the first
+    call, so this is the cost of rolling and describing the result.
+    """
+    import dice
+    print "dice numpy={} max_dice={:,}".format(_numpy_version(), dice.MAX_DICE)
+    for expression in (u'd20', u'8d6+3', u'6x 4d6kh3', u'10d6!', u'1000d100', u'1000d100kh10',
+                       u'{}d6'.format(dice.MAX_DICE)):
+        measure('dice roll {}'.format(expression), functools.partial(dice.roll, expression), min_ops=20)
+
+def bench_dice_stats(args):
+    """
+    dice_stats.describe, worked out from scratch (the cache is cleared first) and then cached:
+    plain pools by repeated squaring, big pools by FFT, and keep-highest/lowest pools.
+    """
+    import dice_stats
+    for expression in (u'4d6kh3 >= 15', u'100d20', u'1000d100', u'(2d6+1)*10', u'10d6!',
+                       u'100d20kh10', u'20d20kl5', u'4d6kh3+4d6kh3+4d6kh3'):
+        measure('dice_stats {}'.format(expression), functools.partial(dice_stats.describe, expression),
+                setup=dice_stats._stats.clear, min_ops=20)
+    measure('dice_stats cached 100d20kh10', functools.partial(dice_stats.describe, u'100d20kh10'))
+
+def bench_deck_ops(args):
+    "CardDeck.draw, insert and shuffle, and CardPile.pull, at several deck sizes."
+    poker_cards = deck_dict['poker_deck'].peek()
+    for num_decks in (1, 10, 100):
+        cards = [Card(name=card.name) for _ in range(num_decks) for card in poker_cards]
+        deck = CardDeck(cards, name='Shoe').shuffle()
+        num_cards = len(cards)
+        measure('deck_ops cards={} draw+insert'.format(num_cards),
+                lambda: deck.insert(deck.draw(3), top=False))
+        measure('deck_ops cards={} shuffle'.format(num_cards), deck.shuffle,
+                min_ops=50)
+        pile = CardPile(name='Pile', catalog=deck.catalog)
+        def refill():
+            if len(pile) < num_cards // 2:
+                pile.add(deck.draw(num_cards // 2))
+        def pull():
+            deck.insert(list(pile.pull(1, key_fn=lambda card: 'Spades' in card.name)), top=False)
+        measure('deck_ops cards={} pile.pull'.format(num_cards), pull, setup=refill)
+        deck.insert(list(pile.pull('all')))
+
+BENCHMARKS = collections.OrderedDict((
+    ('cold_start', bench_cold_start),
+    ('journal', bench_journal),
+    ('deck', bench_deck),
+    ('memory', bench_memory),
+    ('startup', bench_startup),
+    ('render', bench_render),
+    ('parse_message', bench_parse_message),
+    ('message', bench_message),
+    ('respond', bench_respond),
+    ('match', bench_match),
+    ('deck_ops', bench_deck_ops),
+    ('odds', bench_odds),
+    ('dice', bench_dice),
+    ('dice_stats', bench_dice_stats),
+))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run offline benchmarks.")
+    parser.add_argument(
+        'names', nargs='*', choices=[[]] + list(BENCHMARKS),
+        help="Benchmarks to run. Default is all of them.")
+    parser.add_argument(
+        '--api-delay', type=float, default=0.05,
+        help="Seconds each fake Slack API call takes.")
+    parser.add_argument(
+        '--save', metavar='PATH',
+        help="Write the ops/sec and latency percentiles of this run to PATH, as JSON.")
+    parser.add_argument(
+        '--compare', metavar='PATH',
+        help="Compare this run with the results saved at PATH; exit 1 if anything regressed.")
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help="How much slower (as a fraction) a benchmark can get before it counts as regressed.")
+    args = parser.parse_args()
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name](args)
+    if args.save:
+        save_results(args.save)
+    if args.compare and compare_results(args.compare, args.tolerance):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
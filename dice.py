@@ -0,0 +1,362 @@
+import heapq
+import random
+import re
+
+# NumPy rolls big pools of dice (1000d100, say) in one go. Without it dice are rolled one at a
+# time, and the limit on how many one message may roll is lower to match.
+from numpy_support import HAVE_NUMPY
+
+class DiceError(StandardError):
+    "An expression that can't be rolled, with a message saying why, fit to show the player."
+
+# Limits start {
+# However it's written, one message can't make the bot do more than this much work.
+
+MAX_EXPRESSION_CHARS = 200
+MAX_TERMS = 20                              # Dice and numbers, all told.
+MAX_SIDES = 1000000
+MAX_REPEAT = 20                             # As in 6x 4d6kh3.
+MAX_DICE = 1000000 if HAVE_NUMPY else 20000 # Dice rolled, all told, exploding ones included.
+MAX_EXPLODE_ROUNDS = 100                    # How many times exploding dice can explode again.
+
+# Show each die that was rolled in a term of up to this many dice; just the total past that.
+SHOW_DICE = 30
+# } and end.
+
+# Expressions start {
+# An expression is a sum (or difference, or product) of dice and numbers, with brackets:
+#   d20, 8d6+3, 4d6kh3 (keep the highest 3), 2d20kl1 (keep the lowest), 4d6dl1 (drop the lowest),
+#   3d6! (a die that rolls its highest rolls again), d% (a d100), (2d6+1)*10
+# and may be rolled several times over: 6x 4d6kh3.
+
+class ExplodeBudget(object):
+    "How many more dice exploding dice may add, across everything one message rolls."
+
+    __slots__ = ('left',)
+
+    def __init__(self, left):
+        self.left = left
+
+    def take(self, num_dice):
+        if num_dice > self.left:
+            raise DiceError("Those dice explode into more than the {:,} dice I'll roll at once.".format(MAX_DICE))
+        self.left -= num_dice
+
+class Number(object):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+    def num_dice(self):
+        return 0
+
+    def roll(self, batch, budget):
+        return [self.value] * batch, [str(self.value)] * batch
+
+class Dice(object):
+    "count dice of sides sides, maybe exploding, keeping only some of them (keep is ('kh'|'kl', n))."
+
+    __slots__ = ('count', 'sides', 'explode', 'keep')
+
+    def __init__(self, count, sides, explode=False, keep=None):
+        self.count = count
+        self.sides = sides
+        self.explode = explode
+        self.keep = keep
+
+    def __str__(self):
+        text = '{}d{}'.format(self.count, self.sides)
+        if self.explode:
+            text += '!'
+        if self.keep:
+            text += '{}{}'.format(*self.keep)
+        return text
+
+    def num_dice(self):
+        return self.count
+
+    def roll(self, batch, budget):
+        """
+        Roll these dice batch times over, taking any dice they explode into from budget (an
+        ExplodeBudget). Return the totals, and how each came about, as text.
+        """
+        if HAVE_NUMPY:
+            import numpy
+            rows = numpy.random.randint(1, self.sides + 1, size=(batch, self.count))
+            # Rows small enough to show are quicker to handle as lists than as arrays.
+            rows = rows.tolist() if self.count <= SHOW_DICE else list(rows)
+        else:
+            rows = [[random.randint(1, self.sides) for _ in xrange(self.count)] for _ in xrange(batch)]
+        totals, details = [], []
+        for row in rows:
+            if self.explode:
+                row = self._explode(row, budget)
+            kept = self._kept(row)
+            totals.append(sum(kept) if isinstance(kept, list) else int(kept.sum()))
+            details.append(self._describe(row, kept))
+        return totals, details
+
+    def _explode(self, row, budget):
+        rolled = [row]
+        exploding = sum(1 for value in row if value == self.sides)
+        for _ in xrange(MAX_EXPLODE_ROUNDS):
+            if not exploding:
+                break
+            budget.take(exploding)
+            if not isinstance(row, list):
+                import numpy
+                extra = numpy.random.randint(1, self.sides + 1, size=exploding)
+                exploding = int(numpy.count_nonzero(extra == self.sides))
+            else:
+                extra = [random.randint(1, self.sides) for _ in xrange(exploding)]
+                exploding = extra.count(self.sides)
+            rolled.append(extra)
+        if not isinstance(row, list):
+            import numpy
+            return numpy.concatenate(rolled)
+        return [value for values in rolled for value in values]
+
+    def _kept(self, row):
+        if not self.keep:
+            return row
+        how, num_kept = self.keep
+        if num_kept >= len(row):
+            # Keeping them all (or dropping none, as in 4d6dl0).
+            return row
+        if num_kept <= 0:
+            return []
+        if not isinstance(row, list):
+            import numpy
+            # Only the sum is wanted; a partition finds the kept dice without sorting them all.
+            if how == 'kh':
+                return numpy.partition(row, len(row) - num_kept)[len(row) - num_kept:]
+            return numpy.partition(row, num_kept - 1)[:num_kept]
+        return (heapq.nlargest if how == 'kh' else heapq.nsmallest)(num_kept, row)
+
+    def _describe(self, row, kept):
+        if len(row) > SHOW_DICE:
+            return '{} ({:,} dice)'.format(self, len(row))
+        dropped = list(row)
+        for value in kept:
+            dropped.remove(value)
+        shown = []
+        for value in row:
+            if value in dropped:
+                dropped.remove(value)
+                shown.append('~{}~'.format(value))
+            else:
+                shown.append(str(value))
+        return '{} [{}]'.format(self, ', '.join(shown))
+
+class BinaryOp(object):
+    __slots__ = ('op', 'left', 'right')
+
+    OPS = {
+        '+':lambda a, b: a + b,
+        '-':lambda a, b: a - b,
+        '*':lambda a, b: a * b,
+    }
+    PRECEDENCE = {'+':1, '-':1, '*':2}
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def _bracketed(self, left, right):
+        "Put brackets round left and right, where they'd be read differently without."
+        if isinstance(self.left, BinaryOp) and self.PRECEDENCE[self.left.op] < self.PRECEDENCE[self.op]:
+            left = '({})'.format(left)
+        if isinstance(self.right, BinaryOp) and self.PRECEDENCE[self.right.op] <= self.PRECEDENCE[self.op]:
+            right = '({})'.format(right)
+        return left, right
+
+    def __str__(self):
+        return '{0}{op}{1}'.format(*self._bracketed(str(self.left), str(self.right)), op=self.op)
+
+    def num_dice(self):
+        return self.left.num_dice() + self.right.num_dice()
+
+    def roll(self, batch, budget):
+        op = self.OPS[self.op]
+        left_totals, left_details = self.left.roll(batch, budget)
+        right_totals, right_details = self.right.roll(batch, budget)
+        return ([op(left, right) for left, right in zip(left_totals, right_totals)],
+                ['{0} {op} {1}'.format(*self._bracketed(left, right), op=self.op)
+                 for left, right in zip(left_details, right_details)])
+
+class Expression(object):
+    "A parsed dice expression, ready to roll as many times as it's asked for."
+
+    __slots__ = ('root', 'repeat', 'text')
+
+    def __init__(self, root, repeat=1):
+        self.root = root
+        self.repeat = repeat
+        self.text = ('{}x '.format(repeat) if repeat > 1 else '') + str(root)
+
+    def __str__(self):
+        return self.text
+
+    def num_dice(self):
+        return self.root.num_dice() * self.repeat
+
+    def roll(self):
+        """
+        Roll the expression (repeat times). Return a list of (total, how it came about). Raise
+        DiceError if exploding dice would take the dice rolled past MAX_DICE.
+        """
+        totals, details = self.root.roll(self.repeat, ExplodeBudget(MAX_DICE - self.num_dice()))
+        return zip(totals, details)
+# } and end.
+
+# Parsing start {
+
+TOKEN_RE = re.compile(r'''\s*(?:
+    (?P<dice>(?P<count>\d*)d(?P<sides>\d+|%)(?P<explode>!)?(?:(?P<keep>kh|kl|k|dh|dl)(?P<keep_n>\d+))?)
+    |(?P<number>\d+)
+    |(?P<op>[-+*()]))''', re.IGNORECASE | re.VERBOSE)
+REPEAT_RE = re.compile(r'^\s*(\d+)\s*x\s*|\s+x\s*(\d+)\s*$', re.IGNORECASE)
+
+class _Parser(object):
+    "Recursive descent: sum := product (('+'|'-') product)*; product := atom ('*' atom)*."
+
+    def __init__(self, text):
+        self.tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = TOKEN_RE.match(text, position)
+            if not match:
+                raise DiceError("I can't read `{}`; try something like `4d6kh3+2`.".format(text[position:].strip()))
+            self.tokens.append(match)
+            position = match.end()
+        if len(self.tokens) > MAX_TERMS * 2:
+            raise DiceError("That's too long an expression; keep it under {} terms.".format(MAX_TERMS))
+        self.position = 0
+        self.num_terms = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise DiceError("Roll what? Try something like `4d6kh3+2`.")
+        node = self._sum()
+        if self.position < len(self.tokens):
+            raise DiceError("I don't know what to do with `{}`.".format(self.tokens[self.position].group().strip()))
+        return node
+
+    def _peek_op(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position].group('op')
+
+    def _sum(self):
+        node = self._product()
+        while self._peek_op() in ('+', '-'):
+            op = self._peek_op()
+            self.position += 1
+            node = BinaryOp(op, node, self._product())
+        return node
+
+    def _product(self):
+        node = self._atom()
+        while self._peek_op() == '*':
+            self.position += 1
+            node = BinaryOp('*', node, self._atom())
+        return node
+
+    def _atom(self):
+        if self.position >= len(self.tokens):
+            raise DiceError("That expression stops short.")
+        token = self.tokens[self.position]
+        self.position += 1
+        if token.group('op') == '(':
+            node = self._sum()
+            if self._peek_op() != ')':
+                raise DiceError("There's a `(` without a `)`.")
+            self.position += 1
+            return node
+        if token.group('op') == '-':
+            return BinaryOp('-', Number(0), self._atom())
+        if token.group('op'):
+            raise DiceError("I didn't expect a `{}` there.".format(token.group('op')))
+        self.num_terms += 1
+        if self.num_terms > MAX_TERMS:
+            raise DiceError("That's too long an expression; keep it under {} terms.".format(MAX_TERMS))
+        if token.group('number'):
+            return Number(int(token.group('number')))
+        return self._dice(token)
+
+    def _dice(self, token):
+        count = int(token.group('count') or 1)
+        sides = 100 if token.group('sides') == '%' else int(token.group('sides'))
+        explode = bool(token.group('explode'))
+        if not 1 <= count <= MAX_DICE:
+            raise DiceError("I can roll from 1 to {:,} dice at once.".format(MAX_DICE))
+        if not 1 <= sides <= MAX_SIDES:
+            raise DiceError("Dice have from 1 to {:,} sides.".format(MAX_SIDES))
+        if explode and sides < 2:
+            raise DiceError("A die with one side would explode forever.")
+        keep = None
+        if token.group('keep'):
+            how, num = token.group('keep').lower(), int(token.group('keep_n'))
+            # Dropping the lowest n is keeping the highest count - n, and so on.
+            if how == 'dl':
+                how, num = 'kh', max(count - num, 0)
+            elif how == 'dh':
+                how, num = 'kl', max(count - num, 0)
+            elif how == 'k':
+                how = 'kh'
+            keep = (how, num)
+        return Dice(count, sides, explode, keep)
+
+# Parsed expressions by the text they were parsed from; start over past MAX_CACHED.
+MAX_CACHED = 1000
+_parsed = {}
+
+def parse(text):
+    """
+    Parse a dice expression, like `4d6kh3+2` or `6x 4d6kh3`, and return an Expression. Raise
+    DiceError if it can't be parsed or would be too much work to roll. The same text parses to the
+    same Expression, from a cache.
+    """
+    key = text.strip().lower()
+    expression = _parsed.get(key)
+    if expression is not None:
+        return expression
+    if len(key) > MAX_EXPRESSION_CHARS:
+        raise DiceError("That's too long an expression; keep it under {} characters.".format(MAX_EXPRESSION_CHARS))
+    repeat = 1
+    match = REPEAT_RE.search(key)
+    if match:
+        repeat = int(match.group(1) or match.group(2))
+        key_text = key[:match.start()] + key[match.end():]
+        if not 1 <= repeat <= MAX_REPEAT:
+            raise DiceError("I can roll something from 1 to {} times at once.".format(MAX_REPEAT))
+    else:
+        key_text = key
+    expression = Expression(_Parser(key_text).parse(), repeat)
+    if expression.num_dice() > MAX_DICE:
+        raise DiceError("That's more than the {:,} dice I'll roll at once.".format(MAX_DICE))
+    if len(_parsed) >= MAX_CACHED:
+        _parsed.clear()
+    _parsed[key] = expression
+    return expression
+# } and end.
+
+def roll(text):
+    """
+    Roll a dice expression. Return the text to show for it: each roll's total, and how it came
+    about. Raise DiceError if it can't be rolled.
+    """
+    expression = parse(text)
+    results = expression.roll()
+    if len(results) == 1:
+        total, detail = results[0]
+        return u"`{}`: {} = *{:,}*".format(expression, detail, total)
+    lines = [u"`{}`:".format(expression)]
+    lines.extend(u" {}. {} = *{:,}*".format(number, detail, total)
+                 for number, (total, detail) in enumerate(results, 1))
+    return u"\n".join(lines)
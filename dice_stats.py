@@ -0,0 +1,270 @@
+# coding=utf-8
+
+import collections
+import math
+import re
+import threading
+
+from dice import Dice, DiceError, Number, parse
+
+# Exact distributions are worked out with NumPy's convolutions; there's no slow path without it.
+from numpy_support import HAVE_NUMPY
+
+# Limits start {
+# However it's written, one message can't make the bot do more than this much work.
+
+MAX_SUPPORT = 1000000       # Possible totals of an expression, or of any part of it.
+MAX_KEEP_STEPS = 20000      # Steps of the keep-highest/lowest recurrence (sides * kept**2 / 2).
+EXPLODE_TAIL = 1e-12        # Exploding dice are followed until less than this chance is left.
+# } and end.
+
+# Past this many values in both, convolve by FFT rather than directly.
+FFT_SIZE = 512
+
+# Distributions start {
+# A distribution is (low, pmf): pmf[i] is the chance of a total of low + i.
+
+def _convolve(a, b):
+    import numpy
+    if min(len(a), len(b)) < FFT_SIZE:
+        return numpy.convolve(a, b)
+    size = len(a) + len(b) - 1
+    fft_size = 1 << (size - 1).bit_length()
+    pmf = numpy.fft.irfft(numpy.fft.rfft(a, fft_size) * numpy.fft.rfft(b, fft_size), fft_size)[:size]
+    # Rounding leaves specks of negative probability where there should be none.
+    return numpy.clip(pmf, 0, None)
+
+def _check_support(size):
+    if size > MAX_SUPPORT:
+        raise DiceError("That has more than {:,} possible totals; too many to work out.".format(MAX_SUPPORT))
+
+def add(x, y):
+    "The distribution of the sum of independent x and y."
+    _check_support(len(x[1]) + len(y[1]) - 1)
+    return x[0] + y[0], _convolve(x[1], y[1])
+
+def negate(x):
+    low, pmf = x
+    return -(low + len(pmf) - 1), pmf[::-1]
+
+def multiply(x, y):
+    "The distribution of the product of independent x and y."
+    import numpy
+    if len(x[1]) == 1:
+        x, y = y, x
+    if len(y[1]) == 1:
+        # Times a number: spread the values out, or flip them over.
+        factor = y[0]
+        low, pmf = x
+        if factor == 0:
+            return 0, numpy.ones(1)
+        if factor < 0:
+            (low, pmf), factor = negate(x), -factor
+        _check_support((len(pmf) - 1) * factor + 1)
+        spread = numpy.zeros((len(pmf) - 1) * factor + 1)
+        spread[::factor] = pmf
+        return low * factor, spread
+    _check_support(len(x[1]) * len(y[1]))
+    values = numpy.multiply.outer(numpy.arange(x[0], x[0] + len(x[1])),
+                                  numpy.arange(y[0], y[0] + len(y[1]))).ravel()
+    low = int(values.min())
+    _check_support(int(values.max()) - low + 1)
+    return low, numpy.bincount(values - low, weights=numpy.multiply.outer(x[1], y[1]).ravel())
+
+def power(x, times):
+    "The distribution of the sum of times independent copies of x, by repeated squaring."
+    _check_support((len(x[1]) - 1) * times + 1)
+    result = None
+    while times:
+        if times & 1:
+            result = x if result is None else add(result, x)
+        times >>= 1
+        if times:
+            x = add(x, x)
+    return result
+
+def die(sides, explode=False):
+    "The distribution of one die, which rolls again (and adds) on its highest face if it explodes."
+    import numpy
+    if not explode:
+        return 1, numpy.full(sides, 1.0 / sides)
+    # Each explosion is a 1/sides chance of going round again; stop once what's left is negligible.
+    rounds = int(math.ceil(math.log(EXPLODE_TAIL) / math.log(1.0 / sides)))
+    _check_support(sides * rounds)
+    pmf = numpy.zeros(sides * rounds)
+    for round_number in range(rounds):
+        start = round_number * sides
+        pmf[start:start + sides - 1] = (1.0 / sides) ** (round_number + 1)
+    # The last round's highest face would explode again, so it's never the total.
+    return 1, pmf[:-1]
+
+def keep_highest(count, sides, keep):
+    """
+    The distribution of the total of the highest keep of count dice, each of sides sides.
+
+    Going down the faces from the highest, the number of the dice left that show this face (given
+    that none shows a higher one) is binomial with p = 1/face. So the state is just how many dice
+    have been kept and their total; once keep dice are kept, the rest don't matter.
+    """
+    import numpy
+    if keep >= count:
+        return power(die(sides), count)
+    if keep <= 0:
+        return 0, numpy.ones(1)
+    if sides * keep * keep // 2 > MAX_KEEP_STEPS:
+        raise DiceError("Keeping {} of {}d{} is too much work to work out exactly.".format(keep, count, sides))
+    size = sides * keep + 1
+    # kept so far -> chance of each total so far
+    states = {0:numpy.zeros(size)}
+    states[0][0] = 1.0
+    result = numpy.zeros(size)
+    for face in xrange(sides, 0, -1):
+        next_states = collections.defaultdict(lambda: numpy.zeros(size))
+        for kept, totals in states.iteritems():
+            left = count - kept
+            chances = _binomial_head(left, 1.0 / face, keep - kept)
+            for showing, chance in enumerate(chances):
+                if chance:
+                    next_states[kept + showing][face * showing:] += chance * totals[:size - face * showing]
+            # The rest of the ways have this face fill up the dice kept.
+            rest = max(0.0, 1.0 - sum(chances))
+            if rest:
+                shift = face * (keep - kept)
+                result[shift:] += rest * totals[:size - shift]
+        states = next_states
+    # At least 1 a die, so totals under keep never come up.
+    return keep, result[keep:]
+
+def _binomial_head(n, p, limit):
+    "The chances of 0, 1, ... limit - 1 successes in n tries with chance p each."
+    if p >= 1:
+        # Every try succeeds.
+        return [1.0 if successes == n else 0.0 for successes in xrange(min(limit, n + 1))]
+    chances = []
+    log_p, log_q = math.log(p), math.log1p(-p)
+    for successes in xrange(min(limit, n + 1)):
+        chances.append(math.exp(
+            math.lgamma(n + 1) - math.lgamma(successes + 1) - math.lgamma(n - successes + 1)
+            + successes * log_p + (n - successes) * log_q))
+    return chances
+
+def distribution(node):
+    "The exact distribution of an expression's (root's) total."
+    import numpy
+    if isinstance(node, Number):
+        return node.value, numpy.ones(1)
+    if isinstance(node, Dice):
+        if node.keep:
+            if node.explode:
+                raise DiceError("I can't work out keeping some exploding dice exactly.")
+            how, keep = node.keep
+            low, pmf = keep_highest(node.count, node.sides, keep)
+            if how == 'kh':
+                return low, pmf
+            # The lowest keep dice are the highest keep of the dice turned upside down.
+            low, pmf = negate((low, pmf))
+            return low + keep * (node.sides + 1), pmf
+        return power(die(node.sides, node.explode), node.count)
+    left, right = distribution(node.left), distribution(node.right)
+    if node.op == '+':
+        return add(left, right)
+    if node.op == '-':
+        return add(left, negate(right))
+    return multiply(left, right)
+# } and end.
+
+class Stats(object):
+    "What's worth knowing about a distribution."
+
+    PERCENTILES = (5, 25, 50, 75, 95)
+
+    def __init__(self, low, pmf):
+        import numpy
+        pmf = pmf / pmf.sum()
+        values = numpy.arange(low, low + len(pmf))
+        self.low = low
+        self.high = low + len(pmf) - 1
+        self.mean = float(numpy.dot(values, pmf))
+        self.stdev = math.sqrt(max(0.0, float(numpy.dot((values - self.mean) ** 2, pmf))))
+        self._cdf = numpy.cumsum(pmf)
+        self.percentiles = [
+            (percent, low + int(numpy.searchsorted(self._cdf, percent / 100.0 - 1e-12)))
+            for percent in self.PERCENTILES]
+
+    def at_least(self, target):
+        "The chance of a total of target or more."
+        if target <= self.low:
+            return 1.0
+        if target > self.high:
+            return 0.0
+        return max(0.0, 1.0 - float(self._cdf[target - self.low - 1]))
+
+class LRUCache(object):
+    """
+    A dict that holds up to size items, dropping the one least recently used to make room. Safe to
+    share between threads (OrderedDict on its own isn't: its linked list can come apart).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            if len(self._items) >= self.size:
+                self._items.popitem(last=False)
+            self._items[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+# Stats by normalized expression (what str() of its parse gives), so 4D6KH3 and 4d6kh3 share.
+_stats = LRUCache(256)
+
+def stats(expression):
+    "Return the Stats of one roll of a parsed dice expression."
+    if not HAVE_NUMPY:
+        raise DiceError("I need NumPy installed to work out distributions.")
+    key = str(expression.root)
+    result = _stats.get(key)
+    if result is None:
+        result = Stats(*distribution(expression.root))
+        _stats.put(key, result)
+    return result
+
+# "4d6kh3 >= 15", or "at least 15". Slack sends a > as &gt;.
+TARGET_RE = re.compile(r'^(?P<expression>.+?)\s*(?:>=|&gt;=|\bat\s+least\b)\s*(?P<target>-?\d+)\s*$', re.IGNORECASE)
+
+def describe(text):
+    """
+    Return the text to show for the stats of a dice expression, like `4d6kh3` or `4d6kh3 >= 15`
+    (which adds the chance of rolling at least 15). Raise DiceError if it can't be worked out.
+    """
+    target = None
+    match = TARGET_RE.match(text.strip())
+    if match:
+        text, target = match.group('expression'), int(match.group('target'))
+    expression = parse(text)
+    result = stats(expression)
+    lines = [
+        u"`{e}`{each}: mean *{m:,.2f}*, σ {s:,.2f}, from {lo:,} to {hi:,}".format(
+            e=expression.root, each=u" (each roll)" if expression.repeat > 1 else u"",
+            m=result.mean, s=result.stdev, lo=result.low, hi=result.high),
+        u"percentiles: " + u", ".join(
+            u"{}% ≤ {:,}".format(percent, value) for percent, value in result.percentiles)]
+    if target is not None:
+        lines.append(u"P(≥ {:,}) = *{:.2%}*".format(target, result.at_least(target)))
+    return u"\n".join(lines)
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+A stand-in for Slack on localhost, for load testing the bot without a live workspace.
+
+FakeSlackServer serves the Web API methods the bot uses (users/channels/groups/im.list and .info,
+im.open and chat.postMessage) under /api/, and an RTM-style event stream, one JSON event per
+line, at /rtm. FakeSlackClient and FakeRTMSocket are the slacker.Slacker and SlackSocket look-alikes
+that SlackInterface is given to talk to it.
+
+Run as a script, it plays a load test: a bot with a GameRegistry listens to the fake server, and
+users in N channels play scripted games (wake, join, begin game, then deal, check hand and return
+card over and over) as fast as the bot answers, or at a set rate. It reports the latency from
+each message event to the first post answering it, and the throughput the bot sustained.
+
+    python fake_slack.py --channels 20 --users 80 --duration 10 --workers 8
+"""
+
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import logging
+import math
+import re
+import socket
+import SocketServer
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import Queue
+
+from slack_token import BOT_USER_ID, BOT_USER_NAME
+
+## The server.
+
+class FakeWorkspace(object):
+    """
+    The users, channels and IMs of a made-up workspace (with our bot user in it), the posts made to
+    it, and the RTM events waiting to be streamed. on_post, if given, is called with
+    (arrival time, channel, text) for every post. With a rate_limit, a channel takes only that
+    many posts a second; past it, posts are turned away with a 429, as Slack does.
+    """
+
+    def __init__(self, num_users=100, num_channels=10, on_post=None, rate_limit=0):
+        self.members = [{'id':BOT_USER_ID, 'name':BOT_USER_NAME}] + [
+            {'id':'U{:06d}'.format(i), 'name':'user{}'.format(i)} for i in range(num_users)]
+        self.channels = [{'id':'C{:06d}'.format(i), 'name':'channel{}'.format(i)} for i in range(num_channels)]
+        self.ims = [{'id':'D' + member['id'][1:], 'user':member['id']} for member in self.members[1:]]
+        self.on_post = on_post
+        self.rate_limit = rate_limit
+        self.num_posts = 0
+        self.num_rate_limited = 0
+        self._posts_this_second = {}   # channel -> (second, posts in it)
+        self.connected = threading.Event()
+        self._lock = threading.Lock()
+        self._events = Queue.Queue()
+
+    def send_event(self, event):
+        "Queue an RTM event (a dict with a 'type') to be streamed to the bot."
+        self._events.put(event)
+
+    def end_stream(self):
+        "End the RTM stream once everything queued before now has gone out."
+        self._events.put(None)
+
+    def next_event(self):
+        return self._events.get()
+
+    def retry_after(self, channel):
+        "If a post to channel now would be over the rate limit, return the seconds to wait; else None."
+        if not self.rate_limit:
+            return None
+        now = time.time()
+        with self._lock:
+            second, posts = self._posts_this_second.get(channel, (None, 0))
+            if second != int(now):
+                second, posts = int(now), 0
+            if posts >= self.rate_limit:
+                self.num_rate_limited += 1
+                return second + 1 - now
+            self._posts_this_second[channel] = (second, posts + 1)
+
+    def post(self, channel, text):
+        with self._lock:
+            self.num_posts += 1
+        if self.on_post:
+            self.on_post(time.time(), channel, text)
+
+    @staticmethod
+    def _find(items, item_id, error):
+        for item in items:
+            if item['id'] == item_id:
+                return item
+        raise ValueError, error
+
+    def api(self, method, params):
+        "Answer a Web API call with the body of its response."
+        if method == 'users.list':
+            return {'members':self.members}
+        elif method == 'channels.list':
+            return {'channels':self.channels}
+        elif method == 'groups.list':
+            return {'groups':[]}
+        elif method == 'im.list':
+            return {'ims':self.ims}
+        elif method == 'users.info':
+            return {'user':self._find(self.members, params.get('user'), 'user_not_found')}
+        elif method == 'channels.info':
+            return {'channel':self._find(self.channels, params.get('channel'), 'channel_not_found')}
+        elif method == 'groups.info':
+            return {'group':self._find([], params.get('channel'), 'channel_not_found')}
+        elif method == 'im.open':
+            return {'channel':{'id':'D' + params.get('user', '')[1:]}}
+        elif method == 'chat.postMessage':
+            self.post(params['channel'], params['text'].decode('utf-8'))
+            return {}
+        raise ValueError, "unknown_method"
+
+class _FakeSlackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        self._handle(urlparse.urlparse(self.path).query)
+
+    def do_POST(self):
+        self._handle(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+
+    def _handle(self, query):
+        path = urlparse.urlparse(self.path).path
+        workspace = self.server.workspace
+        if path == '/rtm':
+            return self._stream(workspace)
+        if not path.startswith('/api/'):
+            return self.send_error(404)
+        params = dict(urlparse.parse_qsl(query))
+        if path == '/api/chat.postMessage':
+            wait = workspace.retry_after(params.get('channel'))
+            if wait is not None:
+                self.send_response(429)
+                self.send_header('Retry-After', str(int(math.ceil(wait))))
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+        try:
+            body = dict(workspace.api(path[len('/api/'):], params), ok=True)
+        except ValueError, err:
+            body = {'ok':False, 'error':str(err)}
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, workspace):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        self.wfile.write(json.dumps({'type':'hello'}) + '\n')
+        self.wfile.flush()
+        workspace.connected.set()
+        while True:
+            event = workspace.next_event()
+            if event is None:
+                return
+            self.wfile.write(json.dumps(event) + '\n')
+            self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeSlackServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    "Serves a FakeWorkspace over HTTP on localhost, from a background thread, until shutdown()."
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # Every API call is a new connection; the default backlog of 5 drops some under load, and a
+    # dropped connection is retried a whole second later.
+    request_queue_size = 128
+
+    def __init__(self, workspace, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _FakeSlackHandler)
+        self.workspace = workspace
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-slack')
+        self._thread.daemon = True
+        self._thread.start()
+
+## The clients.
+
+class FakeSlackResponse(object):
+    "Looks like a slacker.Response, as far as we use one."
+    def __init__(self, body):
+        self.body = body
+
+class FakeSlackClient(object):
+    "Plays the part of slacker.Slacker, for the Web API methods the bot uses, against a FakeSlackServer."
+
+    class _Endpoint(object):
+        def __init__(self, **methods):
+            self.__dict__.update(methods)
+
+    def __init__(self, url):
+        self.url = url
+        self.users = self._Endpoint(
+            list=lambda: self._call('users.list'),
+            info=lambda user: self._call('users.info', user=user))
+        self.channels = self._Endpoint(
+            list=lambda: self._call('channels.list'),
+            info=lambda channel: self._call('channels.info', channel=channel))
+        self.groups = self._Endpoint(
+            list=lambda: self._call('groups.list'),
+            info=lambda channel: self._call('groups.info', channel=channel))
+        self.im = self._Endpoint(
+            list=lambda: self._call('im.list'),
+            open=lambda user: self._call('im.open', user=user))
+        self.chat = self._Endpoint(
+            post_message=lambda channel, text, as_user=True: self._call(
+                'chat.postMessage', channel=channel, text=text.encode('utf-8'), as_user=as_user))
+
+    def _call(self, method, **params):
+        body = json.load(urllib2.urlopen(
+            '{}/api/{}'.format(self.url, method), urllib.urlencode(params)))
+        if not body.get('ok'):
+            raise StandardError, body.get('error')
+        return FakeSlackResponse(body)
+
+class FakeRTMEvent(object):
+    "Looks like a slacksocket event, as far as we use one."
+    def __init__(self, event):
+        self.type = event.get('type')
+        self.event = event
+
+class FakeRTMSocket(object):
+    "Plays the part of slacksocket.SlackSocket, reading events from a FakeSlackServer's RTM stream."
+
+    def __init__(self, url):
+        self.url = url
+
+    def events(self):
+        # Read the stream straight off a socket: urllib2 and httplib both wait for a whole
+        # buffer-full of an unsized response before handing back a line of it.
+        url = urlparse.urlparse(self.url)
+        connection = socket.create_connection((url.hostname, url.port))
+        connection.sendall('GET /rtm HTTP/1.0\r\nHost: {}\r\n\r\n'.format(url.netloc))
+        stream = connection.makefile('rb')
+        try:
+            for line in iter(stream.readline, '\r\n'):
+                pass   # Skip the status line and the headers.
+            for line in iter(stream.readline, ''):
+                yield FakeRTMEvent(json.loads(line))
+        finally:
+            stream.close()
+            connection.close()
+
+## The load generator.
+
+def percentile(sorted_values, fraction):
+    "The value fraction of the way through sorted_values (nearest rank)."
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class LoadGenerator(object):
+    """
+    Plays scripted card games in every channel of a FakeWorkspace. Each channel has one message
+    out at a time: the next is sent once a post answers the last one, in the channel or in the
+    IM of the user who sent it. With a rate (messages per second, over all channels), messages
+    are also held back to that pace.
+    """
+
+    DEAL_RE = re.compile(ur'@(\S+) drew:\n((?: • `[^`]*`\n?)*)')
+    CARD_RE = re.compile(ur'`([^`]*)`')
+
+    def __init__(self, workspace, num_users, rate=0):
+        self.workspace = workspace
+        workspace.on_post = self._on_post
+        self.rate = rate
+        self.latencies = []
+        self.num_sent = 0
+        self._lock = threading.Condition()
+        self._ready = collections.deque()
+        self._outstanding = {}   # chan_id -> when its last message was sent.
+        # Users are dealt round the channels, so every user plays in exactly one.
+        self._players = collections.defaultdict(list)
+        self._chan_id_by_user_id = {}
+        self._user_id_by_im_id = {}
+        self._user_id_by_name = {}
+        members = workspace.members[1:num_users + 1]
+        for i, member in enumerate(members):
+            chan_id = workspace.channels[i % len(workspace.channels)]['id']
+            self._players[chan_id].append(member['id'])
+            self._chan_id_by_user_id[member['id']] = chan_id
+            self._user_id_by_name[member['name']] = member['id']
+        for im in workspace.ims:
+            self._user_id_by_im_id[im['id']] = im['user']
+        self._hands = collections.defaultdict(list)
+        self._scripts = dict(
+            (chan_id, self._script(players)) for chan_id, players in self._players.iteritems())
+        self._ready.extend(self._scripts)
+
+    def _script(self, players):
+        yield players[0], 'wake'
+        for user_id in players:
+            yield user_id, 'join'
+        yield players[0], 'begin game'
+        while True:
+            for user_id in players:
+                yield user_id, 'deal 2 to me'
+                yield user_id, 'check hand'
+                for _ in range(len(self._hands[user_id])):
+                    yield user_id, u'return card {}'.format(self._hands[user_id].pop())
+
+    def _on_post(self, now, channel, text):
+        chan_id = self._chan_id_by_user_id.get(self._user_id_by_im_id.get(channel), channel)
+        deal = self.DEAL_RE.match(text)
+        if deal and deal.group(1) in self._user_id_by_name:
+            self._hands[self._user_id_by_name[deal.group(1)]].extend(self.CARD_RE.findall(deal.group(2)))
+        with self._lock:
+            sent = self._outstanding.pop(chan_id, None)
+            if sent is not None:
+                self.latencies.append(now - sent)
+                self._ready.append(chan_id)
+                self._lock.notify()
+
+    def run(self, duration):
+        """
+        Once the bot is connected, send messages for duration seconds, then wait (briefly) for the
+        last answers. Return how long the messages were sent for.
+        """
+        self.workspace.connected.wait()
+        start = time.time()
+        next_send = start
+        while time.time() < start + duration:
+            with self._lock:
+                while not self._ready and time.time() < start + duration:
+                    self._lock.wait(0.05)
+                if not self._ready:
+                    break
+                chan_id = self._ready.popleft()
+                self._outstanding[chan_id] = time.time()
+            user_id, text = next(self._scripts[chan_id])
+            self.workspace.send_event({
+                'type':'message', 'channel':chan_id, 'user':user_id,
+                'text':u'<@{}> {}'.format(BOT_USER_ID, text), 'ts':'{:.6f}'.format(time.time())})
+            self.num_sent += 1
+            if self.rate:
+                next_send += 1.0 / self.rate
+                time.sleep(max(0, next_send - time.time()))
+        elapsed = time.time() - start
+        with self._lock:
+            deadline = time.time() + 5
+            while self._outstanding and time.time() < deadline:
+                self._lock.wait(0.05)
+        return elapsed
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        print "sent {} messages in {:.1f}s; {} answered ({} posts, {} turned away for the rate limit)".format(
+            self.num_sent, elapsed, len(latencies), self.workspace.num_posts, self.workspace.num_rate_limited)
+        if not latencies:
+            return
+        print "sustained throughput: {:.0f} messages/s".format(len(latencies) / elapsed)
+        print "latency: p50={:.1f}ms  p90={:.1f}ms  p99={:.1f}ms  max={:.1f}ms".format(
+            percentile(latencies, 0.50) * 1000, percentile(latencies, 0.90) * 1000,
+            percentile(latencies, 0.99) * 1000, latencies[-1] * 1000)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot against a fake Slack on localhost.")
+    parser.add_argument('--channels', type=int, default=10, help="Channels with a game going.")
+    parser.add_argument('--users', type=int, default=40, help="Users playing, spread over the channels.")
+    parser.add_argument(
+        '--rate', type=float, default=0,
+        help="Messages per second, over all channels. 0 sends each as soon as its channel is answered.")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to send messages for.")
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help="Answer messages on this many worker threads. 0 answers them one at a time.")
+    parser.add_argument(
+        '--shards', type=int, default=0,
+        help="Answer messages in this many worker processes instead (see SlackInterface.listen_sharded).")
+    parser.add_argument(
+        '--senders', type=int, default=4,
+        help="Send the bot's posts from this many threads (see PostSender). 0 posts each as it's made.")
+    parser.add_argument(
+        '--post-rate', type=float, default=1000,
+        help="Posts a second the bot sends to any one channel. Slack allows about 1.")
+    parser.add_argument(
+        '--coalesce-window', type=float, default=0,
+        help="Seconds the bot holds posts for, to merge the responses to several messages (see PostBuffer).")
+    parser.add_argument(
+        '--rate-limit', type=int, default=0,
+        help="Posts a second the fake Slack takes in a channel before answering 429. 0 takes them all.")
+    parser.add_argument('--verbose', action='store_true', help="Let the bot log as it goes.")
+    args = parser.parse_args()
+    assert args.users >= args.channels, "Every channel needs a player."
+
+    import slack_dicebot
+    from game_objects import deck_dict
+    from slack_metrics import configure_logging
+    configure_logging(logging.DEBUG if args.verbose else logging.WARNING)
+    deck = deck_dict['poker_deck']
+    registry = slack_dicebot.GameRegistry(lambda: slack_dicebot.RegexCardGame(deck=deck.copy()))
+    # The shards have to be forked before the fake Slack (or anything else) starts a thread.
+    dispatcher = slack_dicebot.fork_shards(registry, args.shards) if args.shards else None
+    workspace = FakeWorkspace(args.users, args.channels, rate_limit=args.rate_limit)
+    server = FakeSlackServer(workspace)
+    load = LoadGenerator(workspace, args.users, args.rate)
+
+    si = slack_dicebot.SlackInterface(
+        registry, slack=FakeSlackClient(server.url), socket=FakeRTMSocket(server.url),
+        num_senders=args.senders, posts_per_second=args.post_rate,
+        coalesce_window=args.coalesce_window)
+    if dispatcher:
+        listen, listen_args = si.listen_sharded, (dispatcher,)
+    elif args.workers:
+        listen, listen_args = si.listen_concurrently, (args.workers,)
+    else:
+        listen, listen_args = si.listen, ()
+    bot = threading.Thread(target=listen, args=listen_args, name='bot')
+    bot.daemon = True
+    bot.start()
+    elapsed = load.run(args.duration)
+    workspace.end_stream()
+    bot.join(10)
+    server.shutdown()
+    load.report(elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class GameJournal(object):
+    """
+    An append-only log of the state changes in every game, one JSON record per line, so the
+    games can be rebuilt after a crash or a restart.
+
+    append() only queues a record; a background thread writes whatever has queued up and fsyncs it
+    once every commit_interval seconds (group commit), so a handler never waits on the disk. Games
+    write a 'snapshot' record of their whole state every so often, and once compact_after records
+    have been written the log is rewritten with only the records that still matter: each game's
+    last snapshot and what came after it. That keeps replay short, however long the bot runs.
+    The thread only starts with the first append(), so a journal can be opened and recovered
+    before forking (see ShardedDispatcher) without a thread to take in to the fork.
+    """
+
+    def __init__(self, path, commit_interval=0.05, compact_after=10000):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        self._writing = threading.Lock()
+        self._queued = []
+        self._waiting = threading.Event()
+        self._written = 0   # Records in the file...
+        self._live = 0      # ...and how many of them survived the last compaction.
+        self._closed = False
+        self._file = open(path, 'ab')
+        if os.path.getsize(path):
+            # Start clean: compacting drops anything a crash left half-written at the end.
+            self.compact()
+        self._committer = None
+
+    def append(self, chan_id, op, fields):
+        "Queue a record of op (with its fields) in the game in chan_id."
+        line = json.dumps({'chan':chan_id, 'op':op, 'fields':fields}, separators=(',', ':'))
+        with self._lock:
+            self._queued.append(line)
+            self._waiting.set()
+            if self._committer is None:
+                self._committer = threading.Thread(target=self._run, name='journal-commit')
+                self._committer.daemon = True
+                self._committer.start()
+
+    def commit(self):
+        "Write and fsync everything queued so far."
+        with self._writing:
+            with self._lock:
+                lines, self._queued = self._queued, []
+                self._waiting.clear()
+            if not lines or self._closed:
+                return
+            self._file.write('\n'.join(lines) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._written += len(lines)
+
+    def close(self):
+        "Commit what's queued and close the file."
+        self.commit()
+        with self._writing:
+            self._closed = True
+            self._file.close()
+        self._waiting.set()
+
+    def recover(self):
+        """
+        Read the journal back. Return an ordered dict of chan_id -> list of (op, fields), holding
+        for each game that's still awake the records needed to rebuild it.
+        """
+        with self._writing:
+            return self._live_records(self._read())
+
+    def compact(self):
+        "Rewrite the journal with only the records recover() would use."
+        with self._writing:
+            if self._closed:
+                return
+            live_records = self._live_records(self._read())
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as temp_file:
+                for chan_id, records in live_records.iteritems():
+                    for op, fields in records:
+                        temp_file.write(json.dumps(
+                            {'chan':chan_id, 'op':op, 'fields':fields}, separators=(',', ':')) + '\n')
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            self._file.close()
+            os.rename(temp_path, self.path)
+            self._file = open(self.path, 'ab')
+            self._written = self._live = sum(len(records) for records in live_records.itervalues())
+
+    def _read(self):
+        with open(self.path, 'rb') as journal_file:
+            for line in journal_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A record torn by a crash mid-write; nothing after it was committed.
+                    return
+
+    @staticmethod
+    def _live_records(records):
+        live_records = collections.OrderedDict()
+        for record in records:
+            chan_id, op = record['chan'], record['op']
+            if op == 'sleep':
+                live_records.pop(chan_id, None)
+                continue
+            if op == 'snapshot':
+                live_records[chan_id] = []
+            live_records.setdefault(chan_id, []).append((op, record['fields']))
+        return live_records
+
+    def _run(self):
+        while not self._closed:
+            self._waiting.wait()
+            time.sleep(self.commit_interval)
+            try:
+                self.commit()
+                if self._written - self._live >= self.compact_after:
+                    self.compact()
+            except (IOError, OSError, ValueError):
+                log.exception("commit_failed path=%s", self.path)
@@ -1,7 +1,17 @@
+import bisect
+import collections
+import itertools
+import logging
 import random
+import threading
+
+log = logging.getLogger(__name__)
 
 class Card(object):
 
+    # Cards are shared by every copy of their deck, so keep them small.
+    __slots__ = ('_suit', '_rank', '_name', '_details', '_catalog', '_id')
+
     def __init__(self, suit=None, rank=None, name=None, details=None):
         "Initializer."
         assert suit is None or isinstance(suit, (basestring)), "suit must be string"
@@ -13,6 +23,9 @@ class Card(object):
         self._rank = rank
         self._name = name
         self._details = details
+        # Set once, by the CardCatalog the card goes in to.
+        self._catalog = None
+        self._id = None
 
     @property
     def suit(self):
@@ -62,25 +75,163 @@ class Card(object):
         else: # self.name > other.name:
             return 1
 
-class CardDeck(object):
-    """An ordered list of cards, with some utility functions to help manage moving them."""
+def card_name_key(name):
+    "Card names are matched ignoring case and surrounding space."
+    return name.lower().strip()
+
+class CardCatalog(object):
+    """
+    The one copy of each card in a deck definition. Cards are numbered by their place in the
+    catalog, and decks and piles hold those numbers rather than the cards, so every copy of a deck
+    shares the same Card objects and costs little more than a list of small ints. A card belongs
+    to exactly one catalog. The catalog also indexes its cards by name and by sorted order.
+    """
+
     def __init__(self, cards, name=None):
+        self._cards = tuple(cards)
+        for card_id, card in enumerate(self._cards):
+            assert card._catalog is None, "{} is already in a catalog".format(card)
+            card._catalog = self
+            card._id = card_id
+        self._name = name
+        self._ids_by_name = {}
+        for card_id, card in enumerate(self._cards):
+            self._ids_by_name.setdefault(card_name_key(card.name), []).append(card_id)
+        # Each card's place when the catalog is sorted by name, and which card is in each place.
+        self._id_by_rank = tuple(sorted(range(len(self._cards)), key=lambda card_id: self._cards[card_id].name))
+        rank_by_id = [0] * len(self._cards)
+        for sort_rank, card_id in enumerate(self._id_by_rank):
+            rank_by_id[card_id] = sort_rank
+        self._rank_by_id = tuple(rank_by_id)
+
+    @classmethod
+    def of(cls, cards, name=None):
+        """
+        Return the catalog these cards are in, cataloguing them now if they aren't in one yet.
+        Return None if there are no cards.
+        """
+        catalogs = set(card._catalog for card in cards)
+        if not catalogs:
+            return None
+        if catalogs == set([None]):
+            return cls(cards, name)
+        assert len(catalogs) == 1 and None not in catalogs, "cards must all come from one catalog"
+        return catalogs.pop()
+
+    @property
+    def name(self):
+        "Return immutable name property."
+        return self._name
+
+    def __len__(self):
+        return len(self._cards)
+
+    def card(self, card_id):
+        "Return the card with this id."
+        return self._cards[card_id]
+
+    def cards(self, card_ids):
+        "Return a list of the cards with these ids."
+        cards = self._cards
+        return [cards[card_id] for card_id in card_ids]
+
+    def ids(self, cards):
+        "Return a list of the ids of these cards."
+        # One pass both checks the cards and looks them up; decks call this on every insert.
+        card_ids = [card._id for card in cards if isinstance(card, Card) and card._catalog is self]
+        assert len(card_ids) == len(cards), "cards must all be Card type, from this catalog"
+        return card_ids
+
+    def find(self, name):
+        "Return a tuple of the ids of the cards with this name (ignoring case and surrounding space)."
+        return tuple(self._ids_by_name.get(card_name_key(name), ()))
+
+    def card_named(self, name):
+        "Return a card with this name (ignoring case and surrounding space), or None."
+        card_ids = self._ids_by_name.get(card_name_key(name))
+        return self._cards[card_ids[0]] if card_ids else None
+
+    def sort_rank(self, card_id):
+        "Return where this card comes when the catalog is sorted by name."
+        return self._rank_by_id[card_id]
+
+    def card_by_sort_rank(self, sort_rank):
+        "Return the card that comes sort_rank-th when the catalog is sorted by name."
+        return self._cards[self._id_by_rank[sort_rank]]
+
+class CardLocator(object):
+    """
+    Knows where every card in a game is, in O(1). The decks and piles that track() a locator
+    report to it (by card id) whenever cards come or go; a card that's been drawn or pulled, but
+    not put anywhere yet, is at None, as is any card in the catalog that isn't in the game.
+    """
+
+    def __init__(self, catalog):
+        self._catalog = catalog
+        self._locations = [None] * len(catalog)
+
+    def move(self, card_ids, location):
+        "Record that the cards with these ids are now at location."
+        locations = self._locations
+        for card_id in card_ids:
+            locations[card_id] = location
+
+    def location(self, card):
+        "Return where this card is."
+        return self._locations[self._catalog.ids([card])[0]]
+
+    def find(self, name):
+        "Return a tuple of every card in the game with this name; more than one means trouble."
+        return tuple(self._catalog.cards(
+            card_id for card_id in self._catalog.find(name)
+            if self._locations[card_id] is not None))
+
+class CardDeck(object):
+    """
+    An ordered list of cards, with some utility functions to help manage moving them.
+    The deck keeps the ids of its cards (see CardCatalog) in a deque, so drawing, peeking at or
+    inserting k cards at either end costs O(k), however big the deck is. version goes up every
+    time the cards or their order change, as CardPile's does.
+    """
+    def __init__(self, cards, name=None, catalog=None):
         if isinstance(cards,Card):
-            self._cards = [cards]
-        elif isinstance(cards,(tuple,set,list)):
+            cards = [cards]
+        elif isinstance(cards,(tuple,set,list,collections.deque)):
             assert all(isinstance(card,Card) for card in cards), "all cards must be Card type"
-            self._cards = list(cards)
         else:
             ValueError, "cards must be one or more of Card type"
 
         assert isinstance(name,(basestring)), "Decks must be named."
         self._name = name
+        self._catalog = catalog
+        self._cards = collections.deque(self._ids(cards))
+        self._locator = None
+        self.version = 0
+
+    def _ids(self, cards):
+        if not cards:
+            return []
+        if self._catalog is None:
+            self._catalog = CardCatalog.of(cards, self._name)
+        return self._catalog.ids(cards)
+
+    def track(self, locator, location='deck'):
+        "Report the cards in this deck, and every card that comes or goes, to a CardLocator. Return this object."
+        self._locator = locator
+        self._location = location
+        locator.move(self._cards, location)
+        return self
 
     @property
     def name(self):
         "Return immutable name property."
         return self._name
 
+    @property
+    def catalog(self):
+        "Return the CardCatalog of this deck's cards."
+        return self._catalog
+
     def __len__(self):
         "How many cards in dis"
         return len(self._cards)
@@ -90,61 +241,82 @@ class CardDeck(object):
     def __repr__(self):
         return '{name}:[{cards}]'.format(
             name=self.name,
-            cards=','.join(str(card) for card in self._cards))
+            cards=','.join(str(card) for card in self._catalog.cards(self._cards)))
+
+    def copy(self):
+        "Return a new deck with the same name and the same cards in the same order."
+        deck = CardDeck([], name=self.name, catalog=self._catalog)
+        deck._cards = collections.deque(self._cards)
+        return deck
 
     def peek(self, num_cards='all'):
         "Return an immutable tuple of the first {num_cards} cards from the deck."
         assert num_cards == 'all' or (isinstance(num_cards, int) and num_cards > 0)
+        if not self._cards:
+            return ()
         if num_cards == 'all':
-            return tuple(self._cards)
+            return tuple(self._catalog.cards(self._cards))
         else:
-            return tuple(self._cards[:num_cards])
+            return tuple(self._catalog.cards(itertools.islice(self._cards, num_cards)))
 
     def shuffle(self):
         "Randomize the deck, return this object."
-        random.shuffle(self._cards)
+        # Shuffling swaps cards all over the deck, which a list does in O(1) and a deque doesn't.
+        cards = list(self._cards)
+        random.shuffle(cards)
+        self._cards = collections.deque(cards)
+        self.version += 1
         return self
 
     def draw(self, num_cards=1):
         "Remove the first {num_cards} cards from the deck and return them in a list."
         assert isinstance(num_cards,int) and num_cards > 0
-        if len(self._cards) > num_cards:
-            num_cards = min(len(self._cards), num_cards)
-        drawn_cards = self._cards[:num_cards]
-        self._cards = self._cards[num_cards:]
-        return drawn_cards
+        popleft = self._cards.popleft
+        drawn_ids = [popleft() for _ in xrange(min(len(self._cards), num_cards))]
+        if drawn_ids:
+            self.version += 1
+        if self._locator:
+            self._locator.move(drawn_ids, None)
+        return self._catalog.cards(drawn_ids) if drawn_ids else []
 
     def insert(self, cards, top=True):
         """
         Given a collection of cards, put them in to the top or the bottom of the
         deck (default top). If they're ordered, preserve that order. Return this object.
         """
-        # Verify cards are cards.
+        # Verify cards are cards (the catalog does, as it looks them up).
         if isinstance(cards,Card):
-            cards = list([cards])
-        elif isinstance(cards,(tuple,set,list)):
-            assert all(isinstance(card,Card) for card in cards), "all cards must be Card type"
+            cards = [cards]
+        elif isinstance(cards,set):
             cards = list(cards)
 
+        card_ids = self._ids(cards)
         if top:
-            self._cards = cards + self._cards
+            self._cards.extendleft(reversed(card_ids))
         else:
-            self._cards += cards
+            self._cards.extend(card_ids)
+        self.version += 1
+        if self._locator:
+            self._locator.move(card_ids, self._location)
 
         return self
 
 class CardPile(object):
-    """An unordered set of cards."""
+    """
+    An unordered set of cards, kept as card ids (see CardCatalog); finding a card by name is O(1).
+    An indexed pile also keeps its cards in sorted order as they come and go, so listing them in
+    order needs no sort. version goes up every time the cards change, so anything worked out from
+    them can be kept until then.
+    """
 
-    def __init__(self, cards=None, name=None):
+    def __init__(self, cards=None, name=None, indexed=False, catalog=None):
         # Verify input
         if cards is None:
-            self._cards = set()
+            cards = []
         elif isinstance(cards,Card):
-            self._cards = set([cards])
+            cards = [cards]
         elif isinstance(cards,(tuple,set,list)):
             assert all(isinstance(card,Card) for card in cards), "all cards must be Card type"
-            self._cards = set(cards)
         else:
             ValueError, "cards must be one or more of Card type"
 
@@ -152,12 +324,46 @@ class CardPile(object):
             assert isinstance(name,(basestring))
         self._name = name
 
+        self._catalog = catalog
+        self._cards = set(self._ids(cards))
+        self._locator = None
+        self.version = 0
+        self._sort_ranks = None
+        if indexed:
+            self._sort_ranks = []
+            self._index(self._cards)
+
+    def _ids(self, cards):
+        if not cards:
+            return []
+        if self._catalog is None:
+            self._catalog = CardCatalog.of(cards, self._name)
+        return self._catalog.ids(cards)
+
+    def track(self, locator, location):
+        "Report the cards in this pile, and every card that comes or goes, to a CardLocator. Return this object."
+        self._locator = locator
+        self._location = location
+        locator.move(self._cards, location)
+        return self
+
+    def _index(self, card_ids):
+        for card_id in card_ids:
+            bisect.insort(self._sort_ranks, self._catalog.sort_rank(card_id))
+
+    def _unindex(self, card_ids):
+        for card_id in card_ids:
+            del self._sort_ranks[bisect.bisect_left(self._sort_ranks, self._catalog.sort_rank(card_id))]
+
+    def _cards_for(self, card_ids):
+        return self._catalog.cards(card_ids) if card_ids else []
+
     def __len__(self):
         return len(self._cards)
     def __str__(self):
         return repr(self)
     def __repr__(self):
-        return self.name+':{'+','.join(str(card) for card in self._cards)+'}'
+        return self.name+':{'+','.join(str(card) for card in self._cards_for(self._cards))+'}'
 
     @property
     def name(self):
@@ -166,7 +372,35 @@ class CardPile(object):
 
     def peek(self):
         "Return an immutable tuple of all the cards."
-        return frozenset(self._cards)
+        return frozenset(self._cards_for(self._cards))
+
+    def peek_sorted(self):
+        "Return a tuple of all the cards, sorted by name."
+        if self._sort_ranks is not None:
+            return tuple(self._catalog.card_by_sort_rank(sort_rank) for sort_rank in self._sort_ranks)
+        return tuple(sorted(self.peek()))
+
+    def find(self, name):
+        "Return a card with this name (ignoring case and surrounding space), or None."
+        if self._catalog is None:
+            return None
+        for card_id in self._catalog.find(name):
+            if card_id in self._cards:
+                return self._catalog.card(card_id)
+        return None
+
+    def pull_named(self, name):
+        "Pull a card with this name (ignoring case and surrounding space) from the pile, and return it, or None."
+        card = self.find(name)
+        if card is not None:
+            card_ids = self._catalog.ids([card])
+            self._cards.difference_update(card_ids)
+            self.version += 1
+            if self._sort_ranks is not None:
+                self._unindex(card_ids)
+            if self._locator:
+                self._locator.move(card_ids, None)
+        return card
 
     def add(self, new_cards):
         """
@@ -174,18 +408,23 @@ class CardPile(object):
         in the pile, and then add them to the pile. Return this object."""
         # Verify input
         if isinstance(new_cards,Card):
-            new_cards = set([new_cards])
+            new_cards = [new_cards]
         elif isinstance(new_cards,(tuple,set,list)):
             assert all(isinstance(card,Card) for card in new_cards), "all cards must be Card type"
-            new_cards = set(new_cards)
         else:
             ValueError, "cards must be one or more of Card type"
+        new_ids = set(self._ids(new_cards))
 
         # No dupes, right?
-        assert len(self._cards & new_cards) == 0
+        assert len(self._cards & new_ids) == 0
 
         # Okay, get em'.
-        self._cards |= new_cards
+        self._cards |= new_ids
+        self.version += 1
+        if self._sort_ranks is not None:
+            self._index(new_ids)
+        if self._locator:
+            self._locator.move(new_ids, self._location)
 
         return self
 
@@ -200,23 +439,32 @@ class CardPile(object):
         assert (isinstance(key_fn, type(lambda x:x))) or num_cards == 'all'
 
         # Pull cards.
-        pulled_cards = set()
+        pulled_ids = set()
         if num_cards == 'all':
-            pulled_cards = set(self._cards)
-            self._cards -= pulled_cards
-            return pulled_cards
-        for card in self._cards:
+            pulled_ids, self._cards = self._cards, set()
+            self.version += 1
+            if self._sort_ranks is not None:
+                self._sort_ranks = []
+            if self._locator:
+                self._locator.move(pulled_ids, None)
+            return set(self._cards_for(pulled_ids))
+        for card_id in self._cards:
             if num_cards == 0:
                 break
-            if key_fn(card):
-                pulled_cards.add(card)
+            if key_fn(self._catalog.card(card_id)):
+                pulled_ids.add(card_id)
                 num_cards -= 1
-        self._cards -= pulled_cards
-        return pulled_cards
+        self._cards -= pulled_ids
+        self.version += 1
+        if self._sort_ranks is not None:
+            self._unindex(pulled_ids)
+        if self._locator:
+            self._locator.move(pulled_ids, None)
+        return set(self._cards_for(pulled_ids))
 
-color_deck = CardDeck([Card(name=name) for name in
-    ('Red','Orange','Yellow','Green','Blue','Indigo','Violet')], name='ColorDeck')
-color_deck.shuffle()
+def build_color_deck():
+    return CardDeck([Card(name=name) for name in
+        ('Red','Orange','Yellow','Green','Blue','Indigo','Violet')], name='ColorDeck').shuffle()
 
 def poker_name(rank, suit):
     if rank in range(2,11):
@@ -224,43 +472,130 @@ def poker_name(rank, suit):
     else:
         rank = {1:"Ace",11:"Jack",12:"Queen",13:"King"}[rank]
     return "{r} of {s}".format(r=rank, s=suit)
-poker_deck = CardDeck([
-    Card(rank=rank, suit=suit, name=poker_name(rank, suit))
-    for rank in range(1, 13+1)
-    for suit in ("Hearts","Diamonds","Clubs","Spades")],
-    name="Poker Deck")
-poker_deck.shuffle()
-
-major_arcana = CardDeck(
-    [Card(name=name) for name in (
-        "The Fool",
-        "The Magician",
-        "The High Priestess",
-        "The Empress",
-        "The Emperor",
-        "The Hierophant",
-        "The Lovers",
-        "The Chariot",
-        "Strength",
-        "The Hermit",
-        "Wheel of Fortune",
-        "Justice",
-        "The Hanged Man",
-        "Death",
-        "Temperance",
-        "The Devil",
-        "The Tower",
-        "The Star",
-        "The Moon",
-        "The Sun",
-        "Judgement",
-        "The World",
-    )],
-    name="Major Arcana")
-
-deck_dict = {
-    'color_deck':color_deck,
-    'poker_deck':poker_deck,
-    'major_arcana':major_arcana}
-from private_game_data import private_deck_dict
-deck_dict.update(private_deck_dict)
\ No newline at end of file
+
+def build_poker_deck():
+    return CardDeck([
+        Card(rank=rank, suit=suit, name=poker_name(rank, suit))
+        for rank in range(1, 13+1)
+        for suit in ("Hearts","Diamonds","Clubs","Spades")],
+        name="Poker Deck").shuffle()
+
+def build_major_arcana():
+    return CardDeck(
+        [Card(name=name) for name in (
+            "The Fool",
+            "The Magician",
+            "The High Priestess",
+            "The Empress",
+            "The Emperor",
+            "The Hierophant",
+            "The Lovers",
+            "The Chariot",
+            "Strength",
+            "The Hermit",
+            "Wheel of Fortune",
+            "Justice",
+            "The Hanged Man",
+            "Death",
+            "Temperance",
+            "The Devil",
+            "The Tower",
+            "The Star",
+            "The Moon",
+            "The Sun",
+            "Judgement",
+            "The World",
+        )],
+        name="Major Arcana")
+
+def load_private_decks():
+    from private_game_data import private_deck_dict
+    return private_deck_dict
+
+class DeckRegistry(object):
+    """
+    The decks games can be played with, by name. A deck is only built the first time someone
+    asks for it, and then kept; sources (functions returning a dict of name -> deck, like the
+    private game data) are only loaded when a name isn't found among the built-in decks, or when
+    the whole list of names is wanted. A source that raises is tried again the next time.
+    """
+
+    def __init__(self, builders=None, sources=()):
+        self._builders = dict(builders or {})
+        self._sources = list(sources)
+        self._decks = {}
+        self._lock = threading.RLock()
+
+    def register(self, name, builder):
+        "Add a deck, built by calling builder() with no arguments when it's first wanted."
+        with self._lock:
+            self._builders[name] = builder
+            self._decks.pop(name, None)
+
+    def add_source(self, source):
+        "Add a function that returns a dict of more decks, to be called when they're first wanted."
+        with self._lock:
+            self._sources.append(source)
+
+    def _load_sources(self):
+        while self._sources:
+            decks = self._sources[0]()
+            # Only once it's loaded, so one that fails (an ImportError, say) isn't forgotten.
+            del self._sources[0]
+            for name, deck in decks.iteritems():
+                self._decks[name] = deck
+                self._builders.pop(name, None)
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._decks:
+                if name not in self._builders:
+                    self._load_sources()
+                if name in self._builders:
+                    self._decks[name] = self._builders.pop(name)()
+            if name not in self._decks:
+                raise KeyError, name
+            return self._decks[name]
+
+    def get(self, name, default=None):
+        """
+        Return the deck with this name, or default if there isn't one. If it could only be in a
+        source that won't load, that's logged, and it's taken as not being there.
+        """
+        with self._lock:
+            if name not in self._decks and name not in self._builders:
+                try:
+                    self._load_sources()
+                except Exception:
+                    log.exception("deck_source_failed name=%s", name)
+                    return default
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        with self._lock:
+            if name in self._decks or name in self._builders:
+                return True
+            self._load_sources()
+            return name in self._decks
+
+    def keys(self):
+        "Return the names of every deck, loading the sources (but building nothing)."
+        with self._lock:
+            self._load_sources()
+            return sorted(set(self._decks) | set(self._builders))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+deck_dict = DeckRegistry(
+    builders={
+        'color_deck':build_color_deck,
+        'poker_deck':build_poker_deck,
+        'major_arcana':build_major_arcana},
+    sources=[load_private_decks])
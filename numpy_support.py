@@ -0,0 +1,18 @@
+"""
+Whether NumPy is installed, found out without importing it. odds, dice and dice_stats use NumPy
+when it's there, but import it only in the functions that need it: importing it takes about as
+long as importing the rest of the bot, and most messages never need it.
+"""
+import imp
+
+def installed(name):
+    "Whether the top-level module name can be imported, without importing it."
+    try:
+        module_file = imp.find_module(name)[0]
+    except ImportError:
+        return False
+    if module_file is not None:
+        module_file.close()
+    return True
+
+HAVE_NUMPY = installed('numpy')
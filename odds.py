@@ -0,0 +1,205 @@
+import collections
+import math
+import operator
+import random
+import re
+
+# NumPy makes the simulation fast enough to run a million shuffles while a player waits. Without
+# it the odds are still worked out, from far fewer shuffles.
+from numpy_support import HAVE_NUMPY
+
+# How many shuffles to simulate, with and without NumPy.
+TRIALS = 1000000
+FALLBACK_TRIALS = 20000
+
+def choose(n, k):
+    "n choose k, exactly."
+    if k < 0 or k > n:
+        return 0
+    k = min(k, n - k)
+    result = 1
+    for i in xrange(1, k + 1):
+        result = result * (n - k + i) // i
+    return result
+
+def hypergeometric_at_least(population, successes, draws, at_least):
+    """
+    The chance of drawing at least at_least of the successes cards, drawing draws cards without
+    replacement from population cards.
+    """
+    return multivariate_at_least(population, [(successes, at_least)], draws)
+
+def multivariate_at_least(population, wants, draws):
+    """
+    The chance of drawing, for each (successes, at_least) in wants, at least at_least of its
+    successes cards, drawing draws cards without replacement from population cards, where no card
+    is one of the successes of more than one want.
+    """
+    total = choose(population, draws)
+    if not total:
+        return 0.0
+    # ways[hits]: the ways to draw hits cards from the wants so far with enough of each of them.
+    ways = [1]
+    for successes, at_least in wants:
+        choices = [choose(successes, more) for more in xrange(min(successes, draws) + 1)]
+        combined = [0] * min(len(ways) + successes, draws + 1)
+        for hits, ways_so_far in enumerate(ways):
+            if ways_so_far:
+                for more in xrange(max(at_least, 0), min(successes, draws - hits) + 1):
+                    combined[hits + more] += ways_so_far * choices[more]
+        ways = combined
+    others = population - sum(successes for successes, _ in wants)
+    ways = sum(ways_so_far * choose(others, draws - hits) for hits, ways_so_far in enumerate(ways))
+    # Both can be far too big for a float (choose(520, 100) is); dividing them as longs copes.
+    return operator.truediv(ways, total)
+
+class Odds(collections.namedtuple('Odds', 'probability exact trials')):
+    "The chance of something, and whether it's exact or estimated from trials shuffles."
+
+    __slots__ = ()
+
+    @property
+    def error(self):
+        "The standard error of an estimate (0 if it's exact)."
+        if self.exact:
+            return 0.0
+        return math.sqrt(self.probability * (1 - self.probability) / self.trials)
+
+def draw_odds(pool, wants, draws, trials=None):
+    """
+    The chance that draws cards dealt at random from pool (a sequence of distinct cards) include,
+    for each (cards, at_least) in wants, at least at_least of those cards. Exact when no card is
+    wanted twice over (it's hypergeometric); otherwise estimated by simulating trials shuffles.
+    """
+    draws = min(draws, len(pool))
+    pool_set = set(pool)
+    wants = [(frozenset(cards) & pool_set, at_least) for cards, at_least in wants]
+    if all(at_least <= 0 for _, at_least in wants):
+        return Odds(1.0, True, 0)
+    if any(at_least > min(len(cards), draws) for cards, at_least in wants):
+        return Odds(0.0, True, 0)
+    if draws == len(pool):
+        # Every card gets drawn, and there are enough of each.
+        return Odds(1.0, True, 0)
+    wants = [(cards, at_least) for cards, at_least in wants if at_least > 0]
+    if sum(len(cards) for cards, _ in wants) == len(frozenset().union(*[cards for cards, _ in wants])):
+        return Odds(multivariate_at_least(
+            len(pool), [(len(cards), at_least) for cards, at_least in wants], draws), True, 0)
+
+    # Only which wants a card counts towards matters, not which card it is, so sort the cards in
+    # to atoms by that; how many of each atom get drawn is then one hypergeometric draw after
+    # another, each from what the atoms before it left.
+    atom_sizes = collections.Counter(
+        tuple(card in cards for cards, _ in wants) for card in pool)
+    atom_sizes.pop((False,) * len(wants), None)
+    atoms = atom_sizes.items()
+    if HAVE_NUMPY:
+        trials = trials or TRIALS
+        hits = _simulate_numpy(len(pool), draws, atoms, wants, trials)
+    else:
+        trials = trials or FALLBACK_TRIALS
+        hits = _simulate_python(len(pool), draws, atoms, wants, trials)
+    return Odds(float(hits) / trials, False, trials)
+
+def _simulate_numpy(population, draws, atoms, wants, trials):
+    import numpy
+    left_to_draw = numpy.full(trials, draws, dtype=numpy.int64)
+    counts = numpy.zeros((len(wants), trials), dtype=numpy.int64)
+    for membership, size in atoms:
+        population -= size
+        # numpy wants at least one draw; trials that have drawn all they get just drop theirs.
+        drawn = numpy.random.hypergeometric(size, population, numpy.maximum(left_to_draw, 1))
+        drawn[left_to_draw == 0] = 0
+        left_to_draw -= drawn
+        for want, member in enumerate(membership):
+            if member:
+                counts[want] += drawn
+    at_least = numpy.array([at_least for _, at_least in wants], dtype=numpy.int64)[:, None]
+    return int(numpy.count_nonzero((counts >= at_least).all(axis=0)))
+
+def _simulate_python(population, draws, atoms, wants, trials):
+    labels = [membership for membership, size in atoms for _ in xrange(size)]
+    labels.extend([None] * (population - len(labels)))
+    hits = 0
+    for _ in xrange(trials):
+        counts = [0] * len(wants)
+        for membership in random.sample(labels, draws):
+            if membership is not None:
+                for want, member in enumerate(membership):
+                    counts[want] += member
+        if all(count >= at_least for count, (_, at_least) in zip(counts, wants)):
+            hits += 1
+    return hits
+
+# Naming cards start {
+# What players ask about: a card by name ("The Tower"), or every card with some words in its
+# name ("aces", "an ace of hearts", "2 spades"), possibly with how many of them they're after.
+
+COUNT_RE = re.compile(r'^(?:(?P<count>\d+)|a|an|any)\s+(?P<rest>.+)$', re.IGNORECASE)
+
+def _words(text):
+    return re.findall(r'\w+', text.lower())
+
+def cards_matching(cards, term):
+    """
+    Return the cards named term (ignoring case), or failing that the cards with every word of term
+    in their names, where a word may also be a plural ("aces").
+    """
+    key = term.lower().strip()
+    named = [card for card in cards if card.name.lower() == key]
+    if named:
+        return named
+    term_words = _words(term)
+    matching = []
+    for card in cards:
+        name_words = set(_words(card.name))
+        if term_words and all(word in name_words or (word.endswith('s') and word[:-1] in name_words)
+                              for word in term_words):
+            matching.append(card)
+    return matching
+
+def parse_want(cards, term):
+    """
+    Return (matching cards, at least how many) for a term like "The Tower", "2 aces" or "a king",
+    looking for the cards among cards. A term that's a card's name is that card, even if it starts
+    with a number ("2 of Hearts").
+    """
+    term = term.strip()
+    key = term.lower()
+    named = [card for card in cards if card.name.lower() == key]
+    if named:
+        return named, 1
+    match = COUNT_RE.match(term)
+    if match:
+        return cards_matching(cards, match.group('rest')), int(match.group('count') or 1)
+    return cards_matching(cards, term), 1
+# } and end.
+
+class DeckOdds(object):
+    """
+    Works out draw odds for a deck, as its holders see it: the cards still in the deck, in an order
+    no one knows. Answers are kept until the deck changes (see CardDeck.version), so asking again
+    before the next draw or shuffle costs nothing.
+    """
+
+    # Don't let the cache grow without bound; start over past this many answers.
+    MAX_CACHED = 100
+
+    def __init__(self, deck):
+        self._deck = deck
+        self._version = None
+        self._answers = {}
+
+    def odds(self, wants, draws):
+        """
+        The chance that the next draws cards from the deck include, for each (cards, at_least) in
+        wants, at least at_least of those cards. Return an Odds.
+        """
+        if self._version != self._deck.version or len(self._answers) >= self.MAX_CACHED:
+            self._version = self._deck.version
+            self._answers = {}
+        key = (frozenset((frozenset(cards), at_least) for cards, at_least in wants), draws)
+        answer = self._answers.get(key)
+        if answer is None:
+            answer = self._answers[key] = draw_odds(self._deck.peek(), wants, draws)
+        return answer
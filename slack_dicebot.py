@@ -1,21 +1,129 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import argparse
+import collections
+import functools
+import logging
 import re
-
-import slacker
-from slacksocket import SlackSocket
-
-from game_objects import CardDeck, CardPile, deck_dict
+import sre_constants
+import sre_parse
+import threading
+import Queue
+
+import dice
+import dice_stats
+from game_journal import GameJournal
+from game_objects import CardDeck, CardLocator, CardPile, deck_dict
+from odds import DeckOdds, parse_want
+from slack_directory import SlackDirectory
+from slack_dispatch import (
+    POSTS, ChannelDispatcher, PostBuffer, PostSender, ShardedDispatcher, coalesce_posts, shard_of)
+from slack_metrics import REGISTRY, MetricsServer, configure_logging, now, timed
+import slack_objects
 from slack_objects import Message, Response
+from slack_profiler import ProfileSession
+from slack_templates import CardListRenderer, Template
 from slack_token import SLACK_TOKEN, BOT_USER_ID, BOT_USER_NAME
 
+log = logging.getLogger('slack_dicebot')
+
+## Metrics.
+
+PARSE_SECONDS = REGISTRY.histogram(
+    'slack_parse_seconds', "Time taken to turn an RTM event in to a Message (or skip it).")
+MESSAGES = REGISTRY.counter(
+    'slack_messages_total', "RTM events parsed, by whether they were for us.", ('result',))
+MATCH_SECONDS = REGISTRY.histogram(
+    'responder_match_seconds', "Time taken to match a message against a state's commands.",
+    ('responder',))
+HANDLER_SECONDS = REGISTRY.histogram(
+    'responder_handler_seconds', "Time taken by each handler method.", ('responder', 'handler'))
+SEND_SECONDS = REGISTRY.histogram(
+    'slack_send_seconds', "Time taken to send (or queue, with senders) the responses to one message.")
+ERRORS = REGISTRY.counter(
+    'slack_errors_total', "Errors caught and carried on from, by where.", ('where',))
+
 ## Reg-Ex compiler help-function.
 
 def re_comp(pattern):
     pattern = pattern.format(BOT_USER_ID=("@"+BOT_USER_NAME+":?"))
     return re.compile(pattern, flags=re.IGNORECASE)
 
+## Dice.
+
+def roll_dice(expression, msg):
+    "Roll a dice expression for the sender of msg, and return the Response that says how it went."
+    try:
+        text = u"@{} rolled {}".format(msg.user_name, dice.roll(expression))
+    except dice.DiceError, err:
+        text = unicode(err)
+    return Response(text=text, chan_id=msg.chan_id)
+
+def dice_stats_response(expression, msg):
+    "Work out the odds of a dice expression (maybe with a target, >= N), and return the Response."
+    try:
+        text = dice_stats.describe(expression)
+    except dice.DiceError, err:
+        text = unicode(err)
+    return Response(text=text, chan_id=msg.chan_id)
+
+## Command matcher.
+
+def required_literals(regex_obj):
+    """
+    Return the runs of literal text (lowercased, ASCII, two characters or more) that regex_obj
+    can't match without: those at the top level of its pattern, outside any group, branch or
+    repeat. If a search with it could match some text, all of them are in that text, lowercased.
+    """
+    literals = []
+    run = []
+    for op, value in sre_parse.parse(regex_obj.pattern, regex_obj.flags):
+        if op == sre_constants.LITERAL and value < 128:
+            run.append(unichr(value).lower())
+            continue
+        literals.append(u''.join(run))
+        run = []
+    literals.append(u''.join(run))
+    return tuple(literal for literal in literals if len(literal) > 1)
+
+class CommandMatcher(object):
+    """
+    Finds the first of an ordered tuple of (regex_obj, method_name) pairs whose regex is found in
+    a text, as searching with each in turn would. Before searching with a regex, the literal words
+    it needs (see required_literals) are looked for in the lowercased text, so most commands are
+    ruled out without running their regexes at all.
+    """
+
+    def __init__(self, regex_method_pairs):
+        for regex_obj, _ in regex_method_pairs:
+            assert not regex_obj.flags & (re.LOCALE | re.UNICODE), (
+                "Case-folding beyond ASCII would get past the literal check.")
+        literals_by_command = [required_literals(regex_obj) for regex_obj, _ in regex_method_pairs]
+        # Look for the words few commands need first; the bot's name, which most need, rules out
+        # the fewest.
+        commands_needing = collections.Counter(
+            literal for literals in literals_by_command for literal in literals)
+        self._commands = tuple(
+            (regex_obj.search, method_name, tuple(sorted(literals, key=commands_needing.get)))
+            for (regex_obj, method_name), literals in zip(regex_method_pairs, literals_by_command))
+
+    def match(self, text):
+        """
+        Return (method_name, match) for the first command that matches the text,
+        or (None, None) if nothing does.
+        """
+        lowered = text.lower()
+        for search, method_name, literals in self._commands:
+            for literal in literals:
+                if literal not in lowered:
+                    break
+            else:
+                match_obj = search(text)
+                if match_obj:
+                    return method_name, match_obj
+        return None, None
+
 ## Game Logic
 
 class Responder(object):
@@ -25,10 +133,84 @@ class Responder(object):
         "Takes a message, coughs up a response."
         return Response(text="NOT IMPLEMENTED ERROR",chan_id=msg.chan_id)
 
+def guard_handler(func, guard):
+    """
+    Wrap a MethodResponder handler so that guard(self, msg) runs first: the handler only runs if
+    the guard returns True, and otherwise whatever the guard returned is the result. The guards
+    are also recorded on the wrapper, so a HandlerIndex can run them without the wrappers.
+    """
+    def func_wrapper(self, msg):
+        passed = guard(self, msg)
+        if passed is not True:
+            return passed
+        return func(self, msg)
+    func_wrapper.__name__ = func.__name__
+    if getattr(func, '_required_words', None):
+        # The guard has to run whatever the words are, so the word check stays inside the handler.
+        func_wrapper._handler = func
+        func_wrapper._guards = (guard,)
+    else:
+        func_wrapper._handler = getattr(func, '_handler', func)
+        func_wrapper._guards = (guard,) + getattr(func, '_guards', ())
+    func_wrapper._required_words = frozenset()
+    return func_wrapper
+
+def require_words(func, words):
+    """
+    Wrap a MethodResponder handler so that it only runs for messages with all these words in
+    msg.tokenized. The words are recorded on the wrapper, for a HandlerIndex to look it up by.
+    """
+    words = frozenset(str(word) for word in words)
+    def func_wrapper(self, msg):
+        if not words.issubset(msg.token_set):
+            return
+        return func(self, msg)
+    func_wrapper.__name__ = func.__name__
+    func_wrapper._handler = getattr(func, '_handler', func)
+    func_wrapper._guards = getattr(func, '_guards', ())
+    func_wrapper._required_words = words | getattr(func, '_required_words', frozenset())
+    return func_wrapper
+
+class HandlerIndex(object):
+    """
+    An inverted index from keyword to the handlers (of one MethodResponder state) that need it.
+    Given a message's words, candidates() returns just the handlers whose words are all there,
+    plus those that need none, in the order the state lists them; each comes unwrapped, with the
+    guards its decorators would have run.
+    """
+
+    def __init__(self, responder_class, method_names):
+        self._by_word = {}
+        self._always = []
+        for position, method_name in enumerate(method_names):
+            method = getattr(responder_class, method_name).im_func
+            required_words = getattr(method, '_required_words', frozenset())
+            entry = (position, method_name, getattr(method, '_handler', method),
+                     getattr(method, '_guards', ()), required_words)
+            if required_words:
+                # All of them have to be there, so any one will do as the key; min() is as good as any.
+                self._by_word.setdefault(min(required_words), []).append(entry)
+            else:
+                self._always.append(entry)
+
+    def candidates(self, words):
+        "Return (method_name, handler, guards) for each handler that could answer these words."
+        found = []
+        for word in words:
+            entries = self._by_word.get(word)
+            if entries:
+                found.extend(entry for entry in entries if entry[4] <= words)
+        if not found:
+            return [entry[1:4] for entry in self._always]
+        found.extend(self._always)
+        found.sort()
+        return [entry[1:4] for entry in found]
+
 class MethodResponder(Responder):
     """
     A method responder passes messages directly to a list of its internal instance methods,
-    until one returns a response object.
+    until one returns a response object. Handlers decorated with require_words are only tried
+    for messages that have their words in them (see HandlerIndex).
     """
 
     METHOD_LIST_BY_STATE = {}
@@ -43,13 +225,26 @@ class MethodResponder(Responder):
                 assert type(getattr(self, method_name)) == type(self.__init__), (
                     "{meth_name} not a function, but rather a {meth_type}".format(
                         meth_name=method_name, meth_type=type(getattr(self, method_name))))
+        # Index the handlers once per class, not once per game.
+        cls = type(self)
+        if '_HANDLER_INDEX_BY_STATE' not in cls.__dict__:
+            cls._HANDLER_INDEX_BY_STATE = dict(
+                (state, HandlerIndex(cls, method_list))
+                for state, method_list in cls.METHOD_LIST_BY_STATE.iteritems())
 
     def respond_to_message(self, msg):
         "Takes a message, coughs up a response."
-        method_list = self.METHOD_LIST_BY_STATE[self.state]
-        for method_name in method_list:
-            response_method = getattr(self, method_name)
-            response = response_method(msg)
+        words = msg.token_set
+        responder = type(self).__name__
+        for method_name, handler, guards in self._HANDLER_INDEX_BY_STATE[self.state].candidates(words):
+            start = now()
+            for guard in guards:
+                response = guard(self, msg)
+                if response is not True:
+                    break
+            else:
+                response = handler(self, msg)
+            HANDLER_SECONDS.observe(now() - start, responder, method_name)
             if isinstance(response,(tuple, set, list)):
                 return response
             elif isinstance(response, Response):
@@ -73,30 +268,36 @@ class RegexResponder(Responder):
                 assert isinstance(regexobj, re._pattern_type)
                 assert isinstance(method_name, basestring)
                 assert hasattr(self, method_name)
+        # Compile the command tables once per class, not once per game.
+        cls = type(self)
+        if '_MATCHER_BY_STATE' not in cls.__dict__:
+            cls._MATCHER_BY_STATE = dict(
+                (state, CommandMatcher(regex_methods))
+                for state, regex_methods in cls.REGEX_METHOD_BY_STATE.iteritems())
         self._state = None
 
     def respond_to_message(self, msg):
         "Get message, adjust internal state, and reply with a message."
-        # Iterate over the list of (regex_obj/method_name) pairs for our current
-        # state, and test regex's until we get one that matches. Use the
-        # response_method to calculate the return value.
-        response_method, match_obj = None, None
+        # Match the text against every (regex_obj/method_name) pair for our
+        # current state at once; the earliest pair in the table that matches
+        # wins. Use its response_method to calculate the return value.
         text = self._preprocess_msg_text(msg)
-        print u"Effective Text: {}".format(text)
-        for reg_ex_obj, method_name in self.REGEX_METHOD_BY_STATE[self._state]:
-            print u"Testing {}...".format(reg_ex_obj.pattern)
-            match_obj = reg_ex_obj.search(text)
-            if match_obj:
-                print "Matched;",str(match_obj)
-                response_method = getattr(self,method_name)
-                break
+        responder = type(self).__name__
+        start = now()
+        method_name, match_obj = self._MATCHER_BY_STATE[self._state].match(text)
+        MATCH_SECONDS.observe(now() - start, responder)
 
         # If we don't find a match, no response.
-        if not response_method:
-            print "No match."
+        if not method_name:
+            log.debug(u"no_match state=%s text=%r", self._state, text)
             return
+        log.debug(u"matched state=%s handler=%s groups=%r", self._state, method_name, match_obj)
 
-        return response_method(match=match_obj, msg=msg)
+        start = now()
+        try:
+            return getattr(self, method_name)(match=match_obj, msg=msg)
+        finally:
+            HANDLER_SECONDS.observe(now() - start, responder, method_name)
 
     def _preprocess_msg_text(self, msg):
         text = msg.text
@@ -104,6 +305,110 @@ class RegexResponder(Responder):
             text = u'{} '.format(("@" + BOT_USER_NAME)) + text
         return text
 
+class GameRegistry(Responder):
+    """
+    Keeps a separate game for every channel, so one bot can run a table in each of them at once.
+    A channel's game is built by game_factory the first time someone there talks to the bot, and
+    is dropped again as soon as it goes back to sleep. IMs go to the game in the channel the user
+    last talked to the bot in, for as long as that game is awake.
+
+    Given a GameJournal, the registry rebuilds the games that were awake when the journal was last
+    written, and journals every game it starts (if the game knows how to attach_journal).
+    """
+
+    def __init__(self, game_factory=None, journal=None):
+        assert callable(game_factory)
+        self._game_factory = game_factory
+        self._games = {}
+        # Where each user's IMs go, and the other way round, so a game's routes go with it.
+        self._routes_lock = threading.Lock()
+        self._user_id_to_game_chan_id = {}
+        self._chan_id_to_user_ids = {}
+        self._journal = journal
+        if journal:
+            self._recover()
+
+    def _recover(self):
+        for chan_id, records in self._journal.recover().iteritems():
+            game = self._game_factory()
+            for op, fields in records:
+                game.replay(op, fields)
+            if not game.is_asleep:
+                self._attach_journal(chan_id, game)
+                self._games[chan_id] = game
+
+    def _attach_journal(self, chan_id, game):
+        if self._journal and hasattr(game, 'attach_journal'):
+            game.attach_journal(functools.partial(self._journal.append, chan_id))
+
+    def __len__(self):
+        "How many games are awake or waking."
+        return len(self._games)
+
+    def __contains__(self, chan_id):
+        "Whether chan_id has a game awake or waking."
+        return chan_id in self._games
+
+    @property
+    def journal(self):
+        return self._journal
+
+    def take_shard(self, is_mine, journal=None):
+        """
+        Drop the games in every channel but those is_mine(chan_id) says are ours, and journal the
+        rest (and any new ones) to journal from now on. This is for a shard worker process, which
+        starts with a copy of every game the registry had when it was forked.
+        """
+        self._journal = journal
+        for chan_id, game in self._games.items():
+            if is_mine(chan_id):
+                self._attach_journal(chan_id, game)
+            else:
+                del self._games[chan_id]
+
+    def route_key(self, msg):
+        "Return the id of the channel whose game should handle this message."
+        if msg.im:
+            return self._user_id_to_game_chan_id.get(msg.user_id, msg.chan_id)
+        with self._routes_lock:
+            old_chan_id = self._user_id_to_game_chan_id.get(msg.user_id)
+            if old_chan_id != msg.chan_id:
+                if old_chan_id is not None:
+                    user_ids = self._chan_id_to_user_ids[old_chan_id]
+                    user_ids.discard(msg.user_id)
+                    if not user_ids:
+                        del self._chan_id_to_user_ids[old_chan_id]
+                self._user_id_to_game_chan_id[msg.user_id] = msg.chan_id
+                self._chan_id_to_user_ids.setdefault(msg.chan_id, set()).add(msg.user_id)
+        return msg.chan_id
+
+    def discard(self, chan_id):
+        "Drop the game in chan_id, if there is one, and stop sending anyone's IMs to it."
+        self._games.pop(chan_id, None)
+        with self._routes_lock:
+            for user_id in self._chan_id_to_user_ids.pop(chan_id, ()):
+                del self._user_id_to_game_chan_id[user_id]
+
+    def game_for(self, chan_id):
+        "Return the game for this channel, starting a new one if there isn't one."
+        game = self._games.get(chan_id)
+        if game is None:
+            game = self._games[chan_id] = self._game_factory()
+            self._attach_journal(chan_id, game)
+        return game
+
+    def respond_to_message(self, msg):
+        "Pass the message on to its channel's game."
+        return self.respond_in_channel(self.route_key(msg), msg)
+
+    def respond_in_channel(self, chan_id, msg):
+        "Pass the message on to the game in chan_id, which route_key has already picked."
+        game = self.game_for(chan_id)
+        responses = game.respond_to_message(msg)
+        if game.is_asleep:
+            self.discard(chan_id)
+        return responses
+
 class MethodCardGame(MethodResponder):
 
     # CLASS VARIABLES
@@ -117,10 +422,14 @@ class MethodCardGame(MethodResponder):
         ASLEEP:(
             '_wake_up',
             '_quit',
+            '_roll_dice',
+            '_dice_stats',
             '_grumble',
             ),
         ACCEPTING_PLAYERS:(
             '_back_to_sleep',
+            '_roll_dice',
+            '_dice_stats',
             # '_help',
             # '_add_player',
             # '_remove_player',
@@ -130,6 +439,8 @@ class MethodCardGame(MethodResponder):
         ),
         ACTIVE_GAME:(
             '_back_to_sleep',
+            '_roll_dice',
+            '_dice_stats',
             # '_help',
             # '_list_players',
             # '_check_hand',
@@ -142,18 +453,20 @@ class MethodCardGame(MethodResponder):
             # '_grumble'
         )}
 
-    HELP_STR_BY_STATE = {
-        ASLEEP:"",
-        ACCEPTING_PLAYERS:u'\n'.join((
+    HELP_TEMPLATE_BY_STATE = {
+        ASLEEP:Template(u""),
+        ACCEPTING_PLAYERS:Template(u'\n'.join((
             u'Card game is ready to start in #{CHANNEL} after players join:',
             u' • `{BOT} sleep`: Put {BOT} back to sleep.',
             u' • `{BOT} join`: Join the game.',
             u' • `{BOT} leave`: Leave the game.',
             u' • `{BOT} list`: List the players in the game.',
             u' • `{BOT} begin game`: Start the game.',
+            u' • `{BOT} roll [dice]`: Roll some dice, like `4d6kh3+2` or `6x 3d6`.',
+            u' • `{BOT} stats [dice]`: The odds of a roll, like `4d6kh3` or `4d6kh3 >= 15`.',
             u' • `{BOT} help`: Play this message again.',
-        )),
-        ACTIVE_GAME:u'\n'.join((
+        ))),
+        ACTIVE_GAME:Template(u'\n'.join((
             u'Card game is going down in #{CHANNEL}.:',
             u' • `<@{BOT}> sleep`: Put <@{BOT}> back to sleep.',
             u' • `<@{BOT}> list`: List the players in the game.',
@@ -164,13 +477,16 @@ class MethodCardGame(MethodResponder):
             u' • `<@{BOT}> shuffle`: Shuffle the deck.',
             u' • `<@{BOT}> check deck [num_cards]`: Check the size of the deck, or peek at the number of .',
             u' • `<@{BOT}> deal [num_cards] to [player]`: Deal off the top of the deck.',
-        ))}
+            u' • `<@{BOT}> roll [dice]`: Roll some dice, like `4d6kh3+2` or `6x 3d6`.',
+            u' • `<@{BOT}> stats [dice]`: The odds of a roll, like `4d6kh3` or `4d6kh3 >= 15`.',
+        )))}
 
     def __init__(self, deck=None):
         super(MethodCardGame, self).__init__()
         assert isinstance(deck, CardDeck)
 
         self.deck = deck
+        self._card_lists = CardListRenderer()
         self._initialize()
 
     def _initialize(self):
@@ -181,50 +497,37 @@ class MethodCardGame(MethodResponder):
         self.game_chan_id = None
         self.game_chan_name = None
 
+    @property
+    def is_asleep(self):
+        return self.state == self.ASLEEP
+
     # Static decorators start {
     def _no_ims(func):
-        print "defining func_wrapper for _no_ims"
-        def func_wrapper(self, msg):
-            print "checking if msg is im..."
+        def _no_ims_guard(self, msg):
             if msg.im:
                 return Response(
                     text="That function (`{}`) doesn't work in IMs. Try in a channel.".format(func.__name__),
                     im=msg.user_id)
-            else:
-                return func(self, msg)
-        return func_wrapper
+            return True
+        return guard_handler(func, _no_ims_guard)
 
     def _verify_msg_input(*args):
-        print "defining func_decorator for _verify_msg_input"
         def _function_decorator(func):
-            print "defining func_wrapper for _verify_msg_input"
-            def func_wrapper(self, msg):
-                print "checking for {0} in {1}".format(args, msg.tokenized)
-                if not all((str(word) in msg.tokenized) for word in args):
-                    return
-                else:
-                    return func(self, msg)
-            return func_wrapper
+            return require_words(func, args)
         return _function_decorator
 
     def _players_only(func):
-        print "defining func_wrapper for _players_only"
-        def func_wrapper(self, msg):
-            if msg.user_id not in self.player_id_to_name:
-                return
-            else:
-                return func(self, msg)
-        return func_wrapper
+        def _players_only_guard(self, msg):
+            return msg.user_id in self.player_id_to_name or None
+        return guard_handler(func, _players_only_guard)
     # } and end.
 
     # Private functions start {
     def _format_card_sequence(self, cards, sort=True):
-        if sort: cards = sorted(cards)
-        return u"\n".join(
-            u' • `{}`'.format(card.name) for card in cards)
+        return self._card_lists.render(cards, sort)
     @property
     def help_str_for_state(self):
-        return self.HELP_STR_BY_STATE[self.state].format(
+        return self.HELP_TEMPLATE_BY_STATE[self.state].render(
             BOT="<@{}>".format(BOT_USER_ID),
             B_U_ID=BOT_USER_ID,
             CHANNEL=self.game_chan_name)
@@ -234,7 +537,7 @@ class MethodCardGame(MethodResponder):
     @_verify_msg_input('wake')
     @_no_ims
     def _wake_up(self, msg):
-        print "WAKE UP"
+        log.info("wake chan_id=%s", msg.chan_id)
         self.state = self.ACCEPTING_PLAYERS
         self.game_chan_id   = msg.chan_id
         self.game_chan_name = msg.chan_name
@@ -254,6 +557,22 @@ class MethodCardGame(MethodResponder):
             }[self.state]
         return Response(text=text,chan_id=msg.chan_id)
 
+    ROLL_RE = re.compile(r'\broll\s+(?P<expression>.+)', re.IGNORECASE)
+
+    @_verify_msg_input('roll')
+    def _roll_dice(self, msg):
+        match = self.ROLL_RE.search(msg.text)
+        if match:
+            return roll_dice(match.group('expression'), msg)
+
+    STATS_RE = re.compile(r'\bstats\s+(?P<expression>.+)', re.IGNORECASE)
+
+    @_verify_msg_input('stats')
+    def _dice_stats(self, msg):
+        match = self.STATS_RE.search(msg.text)
+        if match:
+            return dice_stats_response(match.group('expression'), msg)
+
     @_verify_msg_input('sleep')
     @_no_ims
     def _back_to_sleep(self, msg):
@@ -285,6 +604,10 @@ class RegexCardGame(RegexResponder):
 
     REGEX_METHOD_BY_STATE = {
         ASLEEP:(
+            (re_comp(r'{BOT_USER_ID}\s+roll\s+(?P<expression>.+)'),
+             '_roll_dice'),
+            (re_comp(r'{BOT_USER_ID}\s+stats\s+(?P<expression>.+)'),
+             '_dice_stats'),
             (re_comp(r'{BOT_USER_ID}.+wake'),
              '_wake_up'),
             (re_comp(r'{BOT_USER_ID}.+quit'),
@@ -293,6 +616,11 @@ class RegexCardGame(RegexResponder):
              '_grumble'),
             ),
         ACCEPTING_PLAYERS:(
+            # Roll some dice.
+            (re_comp(r'{BOT_USER_ID}\s+roll\s+(?P<expression>.+)'),
+             '_roll_dice'),
+            (re_comp(r'{BOT_USER_ID}\s+stats\s+(?P<expression>.+)'),
+             '_dice_stats'),
             # Go back to sleep.
             (re_comp(r'{BOT_USER_ID}.+sleep'),
              '_back_to_sleep'),
@@ -319,6 +647,11 @@ class RegexCardGame(RegexResponder):
              '_grumble'),
             ),
         ACTIVE_GAME:(
+            # Roll some dice.
+            (re_comp(r'{BOT_USER_ID}\s+roll\s+(?P<expression>.+)'),
+             '_roll_dice'),
+            (re_comp(r'{BOT_USER_ID}\s+stats\s+(?P<expression>.+)'),
+             '_dice_stats'),
             # Back to sleep.
             (re_comp(r'{BOT_USER_ID}.+sleep'),
              '_back_to_sleep'),
@@ -335,6 +668,9 @@ class RegexCardGame(RegexResponder):
             # Examine this card.
             (re_comp(r'{BOT_USER_ID}\s+examine\s+card\s*(?P<card_name>@?[\s\w.]*)'),
              '_examine_card'),
+            # Where is this card?
+            (re_comp(r'{BOT_USER_ID}\s+where\s+is\s*(?P<card_name>[\s\w.]*)'),
+             '_locate_card'),
             # Return this card to the deck.
             (re_comp(r'{BOT_USER_ID}\s+return\s+card\s*(?P<card_name>[\s\w]*)'),
              '_return_card'),
@@ -351,18 +687,56 @@ class RegexCardGame(RegexResponder):
             # Deal {person} {num_cards} cards.
             (re_comp('\s+deal\s+(?P<num_cards>\d+)\s+to\s(?P<player_name>@?[\w.]+)'),
              '_deal_cards'),
+            # What are the odds of drawing these cards?
+            (re_comp(r'{BOT_USER_ID}\s+(?:what\s+are\s+the\s+)?odds\s+(?:of\s+|that\s+)?(?:I\s+)?(?:draw(?:ing)?\s+)?'
+                     r'(?P<wants>.+?)\s+in\s+(?:the\s+)?(?:next\s+)?(?P<num_cards>\d+)'),
+             '_draw_odds'),
             # Grumble...
             (re_comp(r'{BOT_USER_ID}'),
              '_grumble'),
         )}
 
+    HELP_TEMPLATE_BY_STATE = {
+        ACCEPTING_PLAYERS:Template(u'\n'.join((
+            u'Card game is ready to start in #{CHANNEL} after players join:',
+            u' • `<@{B_U_ID}> sleep`: Put <@{B_U_ID}> back to sleep.',
+            u' • `<@{B_U_ID}> join`: Join the game.',
+            u' • `<@{B_U_ID}> leave`: Leave the game.',
+            u' • `<@{B_U_ID}> list`: List the players in the game.',
+            u' • `<@{B_U_ID}> begin game`: Start the game.',
+            u' • `<@{B_U_ID}> roll [dice]`: Roll some dice, like `4d6kh3+2` or `6x 3d6`.',
+            u' • `<@{B_U_ID}> stats [dice]`: The odds of a roll, like `4d6kh3` or `4d6kh3 >= 15`.',
+            u' • `<@{B_U_ID}> help`: Play this message again.',
+        ))),
+        ACTIVE_GAME:Template(u'\n'.join((
+            u'Card game is going down in #{CHANNEL}.:',
+            u' • `<@{B_U_ID}> sleep`: Put <@{B_U_ID}> back to sleep.',
+            u' • `<@{B_U_ID}> list`: List the players in the game.',
+            u' • `<@{B_U_ID}> check hand [player]`: Look at someone\'s hand. Default is your hand.',
+            u' • `<@{B_U_ID}> examine card [card name]`: Display the detailed information for this card.',
+            u' • `<@{B_U_ID}> where is [card name]`: Find out whether a card is in the deck or in whose hand.',
+            u' • `<@{B_U_ID}> return card [card name]`: Return a card in your hand to the bottom of the deck.',
+            u' • `<@{B_U_ID}> discard hand`: Return all your cards to the bottom of the deck.',
+            u' • `<@{B_U_ID}> shuffle`: Shuffle the deck.',
+            u' • `<@{B_U_ID}> check deck [num_cards]`: Check the size of the deck, or peek at the number of .',
+            u' • `<@{B_U_ID}> deal [num_cards] to [player]`: Deal off the top of the deck.',
+            u' • `<@{B_U_ID}> odds [cards] in [num_cards]`: The chance the next cards dealt include these; '
+            u'like `odds The Tower and 2 aces in 5`.',
+            u' • `<@{B_U_ID}> roll [dice]`: Roll some dice, like `4d6kh3+2` or `6x 3d6`.',
+            u' • `<@{B_U_ID}> stats [dice]`: The odds of a roll, like `4d6kh3` or `4d6kh3 >= 15`.',
+        )))}
+
     def __init__(self, deck=None):
         super(RegexCardGame, self).__init__()
 
         # The deck or decks are the cards in play at the beginning of the game.
         assert isinstance(deck, CardDeck)
 
-        self._deck = deck
+        self._locator = CardLocator(deck.catalog)
+        self._deck = deck.track(self._locator)
+        self._odds = DeckOdds(self._deck)
+        self._journal = None
+        self._card_lists = CardListRenderer()
         self._initialize()
 
     def _initialize(self):
@@ -373,11 +747,120 @@ class RegexCardGame(RegexResponder):
         self._game_chan_id = None
         self._game_chan_name = None
 
+    @property
+    def is_asleep(self):
+        return self._state == self.ASLEEP
+
+    # State changes start {
+    # Every change to the game goes through _apply, which journals it (if there's a journal) in a
+    # form that replay can apply again after a restart.
+
+    # Journal a snapshot of the whole game, in place of the op, after this many ops.
+    SNAPSHOT_EVERY = 100
+
+    def attach_journal(self, journal):
+        "From now on, call journal(op, fields) for every state change."
+        self._journal = journal
+        self._ops_since_snapshot = 0
+
+    def replay(self, op, fields):
+        "Apply a state change read back from the journal."
+        getattr(self, '_op_' + op)(**fields)
+
+    def get_state(self):
+        "Return the whole state of the game, as the fields of a snapshot op."
+        return {'state':{
+            'state':self._state,
+            'chan_id':self._game_chan_id,
+            'chan_name':self._game_chan_name,
+            'players':self._player_id_to_name,
+            'hands':dict(
+                (player_id, [card.name for card in hand.peek_sorted()])
+                for player_id, hand in self._hands.iteritems()),
+            'deck':[card.name for card in self._deck.peek()]}}
+
+    def _apply(self, op, **fields):
+        result = getattr(self, '_op_' + op)(**fields)
+        if self._journal:
+            self._ops_since_snapshot += 1
+            if self._ops_since_snapshot >= self.SNAPSHOT_EVERY:
+                self._journal('snapshot', self.get_state())
+                self._ops_since_snapshot = 0
+            else:
+                self._journal(op, fields)
+        return result
+
+    def _op_snapshot(self, state):
+        self._initialize()
+        self._state = state['state']
+        self._game_chan_id = state['chan_id']
+        self._game_chan_name = state['chan_name']
+        for player_id, player_name in state['players'].iteritems():
+            self._op_join(player_id, player_name)
+        # Order the deck first: that draws every card out of it, and the hands' cards with them.
+        self._op_order(state['deck'])
+        for player_id, card_names in state['hands'].iteritems():
+            self._hands[player_id].add([self._deck.catalog.card_named(name) for name in card_names])
+
+    def _op_wake(self, chan_id, chan_name):
+        self._state = self.ACCEPTING_PLAYERS
+        self._game_chan_id = chan_id
+        self._game_chan_name = chan_name
+
+    def _op_sleep(self):
+        for hand in self._hands.values():
+            cards = hand.peek_sorted()
+            hand.pull(num_cards='all',)
+            self._deck.insert(cards)
+        self._initialize()
+
+    def _op_join(self, player_id, player_name):
+        self._player_id_to_name[player_id] = player_name
+        self._player_name_to_id[player_name] = player_id
+        self._hands[player_id] = CardPile(
+            name='Hand of {}'.format(player_name), indexed=True,
+            catalog=self._deck.catalog).track(self._locator, player_id)
+
+    def _op_leave(self, player_id):
+        self._op_discard(player_id)
+        del self._player_name_to_id[self._player_id_to_name.pop(player_id)]
+        del self._hands[player_id]
+        self._card_lists.forget(player_id)
+
+    def _op_begin(self):
+        self._state = self.ACTIVE_GAME
+
+    def _op_order(self, card_names):
+        "Put the deck in this order; used to record the result of a shuffle."
+        if len(self._deck):
+            self._deck.draw(len(self._deck))
+        if card_names:
+            self._deck.insert([self._deck.catalog.card_named(name) for name in card_names])
+
+    def _op_deal(self, player_id, num_cards):
+        drawn_cards = self._deck.draw(num_cards)
+        self._hands[player_id].add(drawn_cards)
+        return drawn_cards
+
+    def _op_return(self, player_id, card_name):
+        pulled_card = self._hands[player_id].pull_named(card_name)
+        if pulled_card:
+            self._deck.insert(pulled_card,top=False)
+        return pulled_card
+
+    def _op_discard(self, player_id):
+        hand = self._hands[player_id]
+        cards = hand.peek_sorted()
+        hand.pull(num_cards='all',)
+        self._deck.insert(cards, top=False)
+
+    def _shuffle(self):
+        self._deck.shuffle()
+        self._apply('order', card_names=[card.name for card in self._deck.peek()])
+    # } and end.
+
     def _format_card_sequence(self, cards, sort=True):
-        if sort:
-            return u"\n".join(u' • `{}`'.format(card.name) for card in sorted(cards))
-        else:
-            return u"\n".join(u' • `{}`'.format(card.name) for card in cards)
+        return self._card_lists.render(cards, sort)
 
     def _no_im(self, msg):
         if msg.im:
@@ -386,6 +869,12 @@ class RegexCardGame(RegexResponder):
     def _quit(self, match=None, msg=None):
         raise SystemExit
 
+    def _roll_dice(self, match=None, msg=None):
+        return roll_dice(match.group('expression'), msg)
+
+    def _dice_stats(self, match=None, msg=None):
+        return dice_stats_response(match.group('expression'), msg)
+
     def _grumble(self, match=None, msg=None):
         text = {
             self.ASLEEP:"Gnr... zzz.... snr...",
@@ -395,54 +884,24 @@ class RegexCardGame(RegexResponder):
         return Response(text=text,chan_id=msg.chan_id)
 
     def _wake_up(self, match=None, msg=None):
-        print match
         interrupt = self._no_im(msg)
         if interrupt: return interrupt
-        print "WAKE UP"
-        self._state = self.ACCEPTING_PLAYERS
-        self._game_chan_id = msg.chan_id
-        self._game_chan_name = msg.chan_name
+        log.info("wake chan_id=%s", msg.chan_id)
+        self._apply('wake', chan_id=msg.chan_id, chan_name=msg.chan_name)
         response = self._help(msg=msg)
         response.chan_id = self._game_chan_id
         return response
 
     def _back_to_sleep(self, match=None, msg=None):
-        print match
         interrupt = self._no_im(msg)
         if interrupt: return interrupt
 
-        for hand in self._hands.values():
-            cards = hand.pull(num_cards='all',)
-            self._deck.insert(cards)
-
-        self._initialize()
+        self._apply('sleep')
         return Response(text="Yawn... zzz", chan_id=msg.chan_id)
 
     def _help(self, match=None, msg=None):
-        if self._state == self.ACCEPTING_PLAYERS:
-            text = u'\n'.join((
-                u'Card game is ready to start in #{CHANNEL} after players join:',
-                u' • `<@{B_U_ID}> sleep`: Put <@{B_U_ID}> back to sleep.',
-                u' • `<@{B_U_ID}> join`: Join the game.',
-                u' • `<@{B_U_ID}> leave`: Leave the game.',
-                u' • `<@{B_U_ID}> list`: List the players in the game.',
-                u' • `<@{B_U_ID}> begin game`: Start the game.',
-                u' • `<@{B_U_ID}> help`: Play this message again.',
-            ))
-        elif self._state == self.ACTIVE_GAME:
-            text = u'\n'.join((
-                u'Card game is going down in #{CHANNEL}.:',
-                u' • `<@{B_U_ID}> sleep`: Put <@{B_U_ID}> back to sleep.',
-                u' • `<@{B_U_ID}> list`: List the players in the game.',
-                u' • `<@{B_U_ID}> check hand [player]`: Look at someone\'s hand. Default is your hand.',
-                u' • `<@{B_U_ID}> examine card [card name]`: Display the detailed information for this card.',
-                u' • `<@{B_U_ID}> return card [card name]`: Return a card in your hand to the bottom of the deck.',
-                u' • `<@{B_U_ID}> discard hand`: Return all your cards to the bottom of the deck.',
-                u' • `<@{B_U_ID}> shuffle`: Shuffle the deck.',
-                u' • `<@{B_U_ID}> check deck [num_cards]`: Check the size of the deck, or peek at the number of .',
-                u' • `<@{B_U_ID}> deal [num_cards] to [player]`: Deal off the top of the deck.',
-            ))
-        text=text.format(B_U_ID=BOT_USER_ID, CHANNEL=self._game_chan_name)
+        text = self.HELP_TEMPLATE_BY_STATE[self._state].render(
+            B_U_ID=BOT_USER_ID, CHANNEL=self._game_chan_name)
         return Response(text=text, chan_id=msg.chan_id)
 
     def _add_player(self, match=None, msg=None):
@@ -451,9 +910,7 @@ class RegexCardGame(RegexResponder):
         player_name = msg.user_name.lower()
         if player_id in self._player_id_to_name:
             return Response(text="You're already in this game.", chan_id=msg.chan_id)
-        self._player_id_to_name[player_id] = player_name
-        self._player_name_to_id[player_name] = player_id
-        self._hands[player_id] = CardPile(name='Hand of {}'.format(player_name))
+        self._apply('join', player_id=player_id, player_name=player_name)
         responses = [Response(
             text="<@{}> has joined the game.".format(player_name), chan_id=self._game_chan_id)]
         if msg.im:
@@ -468,9 +925,7 @@ class RegexCardGame(RegexResponder):
         player_name = msg.user_name.lower()
         if player_id not in self._player_id_to_name:
             return Response(text="You aren't a player, tho.", chan_id=msg.chan_id)
-        del self._player_id_to_name[player_id]
-        del self._player_name_to_id[player_name]
-        del self._hands[player_id]
+        self._apply('leave', player_id=player_id)
         responses.append(Response(
             text="<@{}> has left the game.".format(player_name), chan_id=self._game_chan_id))
         if msg.im:
@@ -485,12 +940,11 @@ class RegexCardGame(RegexResponder):
         players = u'\n'.join(
             u' • <@{}>'.format(player_name)
             for player_name in self._player_id_to_name.itervalues())
-        print self._player_id_to_name.values()
         return Response(text=u"The players are:\n{}".format(players), chan_id=msg.chan_id)
 
     def _begin_game(self, match=None, msg=None):
-        self._state=self.ACTIVE_GAME
-        self._deck.shuffle()
+        self._apply('begin')
+        self._shuffle()
         response = self._help(msg=msg)
         response.chan_id = self._game_chan_id
         return response
@@ -508,7 +962,7 @@ class RegexCardGame(RegexResponder):
             # This is your own hand, so IM full details.
             hand = self._hands[msg.user_id]
             if hand:
-                text = u"Your hand is:\n" + self._format_card_sequence(hand.peek())
+                text = u"Your hand is:\n" + self._card_lists.render_pile(msg.user_id, hand)
             else:
                 text = u"Your hand is empty."
             return Response(text=text, im=msg.user_id)
@@ -519,40 +973,59 @@ class RegexCardGame(RegexResponder):
             s='s' if len(hand) != 1 else '')
         return Response(text=text, im=msg.user_id)
 
-    def _examine_card(self, match=None, msg=None):
+    def _find_named_card(self, match, msg):
+        """
+        Look up the card named in the command's card_name. Return (card, None), or (None, the
+        Response to send back) if there isn't exactly one card with that name.
+        """
         card_name = match.group('card_name').strip()
         if not card_name:
-            return Response(text="This command requires a card name to function.", im=msg.user_id)
-        all_cards = list(self._deck.peek())
-        for hand in self._hands.values():
-            all_cards += list(hand.peek())
-        matching_card = [card for card in all_cards if card.name == card_name]
+            return None, Response(text="This command requires a card name to function.", im=msg.user_id)
+        matching_card = self._locator.find(card_name)
         if len(matching_card) == 0:
-            return Response(text="I couldn't find that card. May not be in the game; did you typo?", im=msg.user_id)
+            return None, Response(
+                text="I couldn't find that card. May not be in the game; did you typo?", im=msg.user_id)
         elif len(matching_card) > 1:
-            return Response(
+            return None, Response(
                 text="What the fuck? More than one card with the name `{}`! That shouldn't be!".format(card_name),
                 im=msg.user_id)
-        else:
-            matching_card = matching_card[0]
+        return matching_card[0], None
+
+    def _examine_card(self, match=None, msg=None):
+        matching_card, error = self._find_named_card(match, msg)
+        if error:
+            return error
         details = matching_card.details
         if not details:
             return Response(
-                text="The card `{c}` has no details.".format(c=card_name),
+                text="The card `{c}` has no details.".format(c=match.group('card_name').strip()),
                 im=msg.user_id)
         return Response(text=(u"`"+matching_card.name+u"`\n```\n"+details+u"\n```"), im=msg.user_id)
 
+    def _locate_card(self, match=None, msg=None):
+        if msg.user_id not in self._player_id_to_name:
+            log.debug("players_only user_id=%s", msg.user_id)
+            return
+        matching_card, error = self._find_named_card(match, msg)
+        if error:
+            return error
+        location = self._locator.location(matching_card)
+        if location == 'deck':
+            text = "`{c}` is in the deck.".format(c=matching_card.name)
+        elif location in self._player_id_to_name:
+            text = "`{c}` is in {p}'s hand.".format(c=matching_card.name, p=self._player_id_to_name[location])
+        else:
+            text = "`{c}` isn't in the deck or anyone's hand.".format(c=matching_card.name)
+        return Response(text=text, im=msg.user_id)
+
     def _return_card(self, match=None, msg=None):
         if msg.user_id not in self._player_id_to_name.keys():
-            print "PLAYERS ONLY"
+            log.debug("players_only user_id=%s", msg.user_id)
             return
         card_name = match.group('card_name').lower().strip()
-        key_fn = lambda card: (
-            card.name.lower().strip() == card_name )
-        pulled_card = [x for x in self._hands[msg.user_id].pull(key_fn=key_fn)][0]
+        pulled_card = self._apply('return', player_id=msg.user_id, card_name=card_name)
         if not pulled_card:
             return Response(text="No card like that found.", im=msg.user_id)
-        self._deck.insert(pulled_card,top=False)
         return Response(
             text="{p} returned `{card}` to the bottom of the deck.".format(
                 p=msg.user_name, card=pulled_card.name),
@@ -560,20 +1033,18 @@ class RegexCardGame(RegexResponder):
 
     def _discard_hand(self, match=None, msg=None):
         if msg.user_id not in self._player_id_to_name.keys():
-            print "PLAYERS ONLY"
+            log.debug("players_only user_id=%s", msg.user_id)
             return
-        self._deck.insert(
-            self._hands[msg.user_id].pull(num_cards='all',),
-            top=False)
+        self._apply('discard', player_id=msg.user_id)
         return Response(
             text="{p} returned their entire hand to the bottom of the deck.".format(p=msg.user_name),
             chan_id=self._game_chan_id)
 
     def _shuffle_deck(self, match=None, msg=None):
         if msg.user_id not in self._player_id_to_name.keys():
-            print "PLAYERS ONLY"
+            log.debug("players_only user_id=%s", msg.user_id)
             return
-        self._deck.shuffle()
+        self._shuffle()
         return Response(
             text="`{player} shuffles the deck...`".format(player=msg.user_name.lower()),
             chan_id=self._game_chan_id)
@@ -581,7 +1052,7 @@ class RegexCardGame(RegexResponder):
     def _check_deck(self, match=None, msg=None):
         responses = []
         if msg.user_id not in self._player_id_to_name.keys():
-            print "PLAYERS ONLY"
+            log.debug("players_only user_id=%s", msg.user_id)
             return
         peek_depth = match.group('peek_depth').strip('')
         try:
@@ -609,11 +1080,11 @@ class RegexCardGame(RegexResponder):
 
     def _deal_cards(self, match=None, msg=None):
         if msg.user_id not in self._player_id_to_name.keys():
-            print "PLAYERS ONLY"
+            log.debug("players_only user_id=%s", msg.user_id)
             return
         player_name = match.group('player_name').lstrip('@')
         if player_name in ('everyone','all','us'):
-            player_ids = self._player_name_to_id
+            player_ids = self._player_name_to_id.values()
         elif player_name in ('me','myself','I'):
             player_ids = [msg.user_id]
         elif player_name in self._player_name_to_id:
@@ -624,16 +1095,89 @@ class RegexCardGame(RegexResponder):
         num_cards = int(match.group('num_cards'))
         text = []
         for player_id in player_ids:
-            drawn_cards = self._deck.draw(num_cards)
-            self._hands[player_id].add(drawn_cards)
+            drawn_cards = self._apply('deal', player_id=player_id, num_cards=num_cards)
             text.append(u"@{p} drew:\n{d}".format(
                 p=self._player_id_to_name[player_id],
                 d=self._format_card_sequence(drawn_cards)))
         text=u"\n".join(text)
         return Response(text=text, chan_id=self._game_chan_id)
 
+    def _draw_odds(self, match=None, msg=None):
+        if msg.user_id not in self._player_id_to_name:
+            log.debug("players_only user_id=%s", msg.user_id)
+            return
+        catalog = self._deck.catalog
+        every_card = catalog.cards(range(len(catalog)))
+        wants, described = [], []
+        for term in re.split(r'\s+and\s+', match.group('wants').strip(), flags=re.IGNORECASE):
+            cards, at_least = parse_want(every_card, term)
+            if not cards:
+                return Response(text=u"I don't know any card like `{}`.".format(term), chan_id=msg.chan_id)
+            wants.append((cards, at_least))
+            described.append(u"`{}`".format(term))
+        num_cards = int(match.group('num_cards'))
+        if not num_cards:
+            return Response(text="Drawing no cards gets you no cards.", chan_id=msg.chan_id)
+        odds = self._odds.odds(wants, num_cards)
+        if odds.exact:
+            how = u"exactly, from the {} cards in the deck".format(len(self._deck))
+        else:
+            how = u"from {:,} simulated shuffles of the {} cards in the deck, ±{:.2%}".format(
+                odds.trials, len(self._deck), 2 * odds.error)
+        if 0 < odds.probability < 0.001:
+            chance = u"under 0.1%"
+        else:
+            chance = u"{:.1%}".format(odds.probability)
+        return Response(
+            text=u"Odds of {w} in the next {n} card{s}: *{p}* ({h}).".format(
+                w=u" and ".join(described), n=num_cards, s='' if num_cards == 1 else 's',
+                p=chance, h=how),
+            chan_id=msg.chan_id)
+
 ## The Slack Listener
 
+class ShardJournal(object):
+    """
+    Stands in for the GameJournal in a shard worker process (see SlackInterface.listen_sharded):
+    it passes each record to forward(chan_id, op, fields), so that the process that owns the real
+    journal can write it.
+    """
+
+    def __init__(self, forward):
+        assert callable(forward)
+        self._forward = forward
+
+    def append(self, chan_id, op, fields):
+        self._forward(chan_id, op, fields)
+
+def fork_shards(registry, num_shards):
+    """
+    Fork the num_shards worker processes SlackInterface.listen_sharded answers messages in, and
+    return their ShardedDispatcher. Each worker keeps just its own channels' games from registry
+    (a GameRegistry), journaling them through this process.
+
+    Call this before anything starts a thread (a SlackInterface, a MetricsServer, a journal that's
+    been appended to): the workers are forked from this process as it is, and a lock that another
+    thread held at that moment would stay held in every worker.
+    """
+    assert isinstance(registry, GameRegistry), "Sharding needs a GameRegistry to split up."
+    def start_shard(shard, emit):
+        journal = None
+        if registry.journal:
+            journal = ShardJournal(lambda chan_id, op, fields: emit(('journal', (chan_id, op, fields))))
+        registry.take_shard(lambda chan_id: shard_of(chan_id, num_shards) == shard, journal)
+        def answer(chan_id, msg):
+            responses = registry.respond_in_channel(chan_id, msg)
+            if chan_id not in registry:
+                # The game's gone back to sleep; this process routes IMs, so it has to know.
+                emit(('discarded', chan_id))
+            if not responses: return
+            if not isinstance(responses, (set, list, tuple)):
+                responses = [responses]
+            emit(('responses', (chan_id, list(responses))))
+        return answer
+    return ShardedDispatcher(num_shards, start_shard)
+
 class SlackInterface:
 
     MESSAGES = {
@@ -641,125 +1185,437 @@ class SlackInterface:
             "Hello, world. I'm posting this to @channel in response to {user}."),
     }
 
-    # Get any sequence of word-characters, possibly including the @ before them to indicate a username,
-    # OR,
-    # Get ANYTHING that starts and ends with ``.
-    TOKENIZER_RE = re.compile(r'(?:@?\w+|`[^`]*`)')
+    # A user mention, as Slack sends it: <@U1234>
+    MENTION_RE = re.compile(r'<@(\w+)>')
+
+    # Admin commands, which are carried out here, before the responder sees the message:
+    #   profile start [sample|cprofile] [for] [N seconds|N messages]
+    #   profile stop
+    #   profile status
+    PROFILE_RE = re.compile(
+        r'^\s*(?:@{}\s+)?profile\s+(?P<action>start|stop|status)'
+        r'(?:\s+(?P<mode>sample|cprofile))?'
+        r'(?:\s+(?:for\s+)?(?P<amount>\d+)\s*(?P<unit>s|secs?|seconds?|msgs?|messages?))?\s*$'.format(
+            re.escape(BOT_USER_NAME)),
+        re.IGNORECASE)
+    # How long a profile runs if the admin doesn't say, and the longest it can.
+    DEFAULT_PROFILE_SECONDS = 30
+    MAX_PROFILE_SECONDS = 3600
 
     FAKE_PM_CHANNEL_NAME = '___private_message___'
-    def __init__(self, responder=None):
+    def __init__(self, responder=None, max_post_chars=4000, coalesce_window=0,
+                 directory_snapshot=None, slack=None, socket=None, admins=(), profile_dir='profiles',
+                 num_senders=4, max_queued_posts=1000, posts_per_second=1.0):
+        """
+        Responses to the same channel or IM are merged in to posts of up to max_post_chars. With a
+        coalesce_window (in seconds), posts are held that long so that responses to several
+        messages can be merged as well; otherwise only the responses to one message are.
+        With a directory_snapshot path, start from the users and channels saved there and catch
+        up with Slack in the background. slack and socket stand in for the Slack Web API and RTM
+        clients, which are otherwise made here from SLACK_TOKEN.
+        The users in admins (by id) can profile the bot as it runs; see PROFILE_RE. Profiles are
+        written to profile_dir.
+        Posts go out from num_senders threads (see PostSender), each on its own connection to
+        Slack, with up to max_queued_posts waiting and no more than posts_per_second going to any
+        one channel; with no senders, each is posted as it's made.
+        """
         assert isinstance(responder, Responder)
         self.responder = responder
-
-        self.slack = slacker.Slacker(SLACK_TOKEN)
-        self.socket = SlackSocket(SLACK_TOKEN, translate=False)
-        self.user_id_to_user_name = {}
-        self.chan_id_to_chan_name = {}
-        self.user_id_to_im_chan_id = {}
-        self._update_cache()
-
-    def _update_cache(self):
-        self.user_id_to_user_name = {
-            u['id']:u['name']
-            for u in self.slack.users.list().body['members']}
-        self.chan_id_to_chan_name = {
-            c['id']:c['name']
-            for c in self.slack.channels.list().body['channels']}
-        self.chan_id_to_chan_name.update({
-            g['id']:g['name']
-            for g in self.slack.groups.list().body['groups']})
-        self.user_id_to_im_chan_id = {
-            i['user']:i['id']
-            for i in self.slack.im.list().body['ims']}
-
+        self.admins = frozenset(admins)
+        self.profile_dir = profile_dir
+        self._profile = None
+        self.max_post_chars = max_post_chars
+        self._post_buffer = None
+        if coalesce_window:
+            self._post_buffer = PostBuffer(self._post, coalesce_window, max_post_chars)
+
+        # The Slack clients are only needed once we're really connecting; offline tools that
+        # import this module don't pay for importing them.
+        self._new_slack = None
+        if slack is None:
+            import requests
+            import slacker
+            # Each client keeps its connections open between calls, in its session.
+            self._new_slack = lambda: slacker.Slacker(SLACK_TOKEN, session=requests.Session())
+            slack = self._new_slack()
+        if socket is None:
+            from slacksocket import SlackSocket
+            socket = SlackSocket(SLACK_TOKEN, translate=False)
+        self.slack = slack
+        self.socket = socket
+        self._bot_mention = '<@{}>'.format(BOT_USER_ID)
+        self._bot_name = '@{}'.format(BOT_USER_NAME)
+        self.directory = SlackDirectory(self.slack)
+        self.directory.start(directory_snapshot)
+        self._sender = None
+        if num_senders:
+            self._sender = PostSender(self._make_post, num_senders, max_queued_posts, posts_per_second)
+
+    def _replace_mention(self, match):
+        "Turn a <@U1234> mention in to @user_name, or leave it be if we don't know the user."
+        u_name = self.directory.user_id_to_user_name.get(match.group(1))
+        if u_name is None:
+            return match.group(0)
+        return "@{}".format(u_name)
+
+    @timed(PARSE_SECONDS)
     def _parse_message(self, e):
         if e.type not in ('message',) or e.event['user'] == BOT_USER_ID:
+            MESSAGES.inc('skipped')
             return None
 
-        # Extract and preprocess text.
-        text = e.event['text']
-        for u_id, u_name in self.user_id_to_user_name.iteritems():
-            text = text.replace("<@{}>".format(u_id),
-                                "@{}".format(u_name))
-        tokenized = self.TOKENIZER_RE.findall(text.lower())
-
-        # Extract user and channel names from cache.
-        u_name = self._get_user_name(e.event['user'])
         chan_name, is_im = self._get_channel_name_and_type(e.event['channel'])
+        raw_text = e.event['text']
 
         # if we aren't called out by name and this isn't a direct message to us,
-        # we absolutely do not care
-        if '@{}'.format(BOT_USER_NAME) not in tokenized and not is_im: return
-
-        print (text, u_name, chan_name, is_im)
+        # we absolutely do not care. Most messages aren't for us, so rule them out on the raw
+        # text before doing any work on it: a mention of us is either <@BOT_USER_ID>, or
+        # @BOT_USER_NAME typed out.
+        if not is_im and self._bot_mention not in raw_text and self._bot_name not in raw_text.lower():
+            MESSAGES.inc('ignored')
+            return
 
-        return Message(
-            text=text,                  tokenized=tokenized,
-            user_id=e.event['user'],    user_name=u_name,
+        # Extract and preprocess text.
+        text = self.MENTION_RE.sub(self._replace_mention, raw_text)
+        msg = Message(
+            text=text,
+            user_id=e.event['user'],    user_name=self._get_user_name(e.event['user']),
             chan_id=e.event['channel'], chan_name=chan_name,
             im=is_im)
 
+        # The raw text only might mention us (@BOT_USER_NAMEs, say); the words say for sure.
+        if not is_im and self._bot_name not in msg.token_set:
+            MESSAGES.inc('ignored')
+            return
+
+        MESSAGES.inc('accepted')
+        log.debug(u"message user=%s chan=%s im=%s text=%r", msg.user_name, chan_name, is_im, text)
+        return msg
+
     def _get_channel_name_and_type(self, chan_id):
-        # Check channel_id and im_channel caches.
-        for loop in (True, False):
-            if chan_id in self.chan_id_to_chan_name:
-                return self.chan_id_to_chan_name[chan_id], False
-            elif chan_id in self.user_id_to_im_chan_id.values():
-                return self.FAKE_PM_CHANNEL_NAME, True
-            if loop: self._update_cache()
-        raise ValueError, "Could not find channel_id."
+        chan_name, is_im = self.directory.channel(chan_id)
+        if is_im:
+            return self.FAKE_PM_CHANNEL_NAME, True
+        return chan_name, False
 
     def _get_user_name(self, user_id):
-        for loop in (True, False):
-            if user_id in self.user_id_to_user_name:
-                return self.user_id_to_user_name[user_id]
-            if loop: self._update_cache()
-        raise ValueError, "Could not find user id."
+        return self.directory.user_name(user_id)
 
-    def _send_response(self, response):
-        assert isinstance(response, Response)
-
-        message = response.text.replace("@channel", "<!channel|@channel>")
-        if not message: return
+    def _get_response_channel(self, response):
         channel = response.chan_id
         if not channel and response.im:
-            if not response.im in self.user_id_to_im_chan_id:
-                self._update_cache()
-            channel = self.user_id_to_im_chan_id[response.im]
+            channel = self.directory.im_channel(response.im)
         if not channel:
             raise StandardError, "No channel, explicit or actual, in response {}".format(response)
-        self.slack.chat.post_message(channel, message, as_user=True)
+        return channel
 
-    def listen(self):
-        print "Happy birthday!"
+    def _send_response(self, response):
+        self._send_responses([response])
+
+    @timed(SEND_SECONDS)
+    def _send_responses(self, responses):
+        "Post a batch of responses, merging the ones that go to the same channel or IM."
+        posts = []
+        for response in responses:
+            assert isinstance(response, Response)
+            message = response.text.replace("@channel", "<!channel|@channel>")
+            if not message: continue
+            try:
+                posts.append((self._get_response_channel(response), message))
+            except StandardError:
+                ERRORS.inc('response_channel')
+                log.exception("response_channel_failed response=%s", response)
+        if self._post_buffer:
+            self._post_buffer.extend(posts)
+            return
+        for channel, message in coalesce_posts(posts, self.max_post_chars):
+            self._post(channel, message)
+
+    def _post(self, channel, message):
+        "Queue a post for the senders, or without them, post it now."
+        if self._sender is not None:
+            self._sender.send(channel, message)
+            return
+        try:
+            self.slack.chat.post_message(channel, message, as_user=True)
+        except StandardError:
+            POSTS.inc('error')
+            log.exception("post_failed channel=%s", channel)
+        else:
+            POSTS.inc('ok')
+
+    def _make_post(self):
+        "Make the post(channel, text) a sender thread sends with: on a Slack client of its own, if we make them."
+        slack = self._new_slack() if self._new_slack else self.slack
+        return lambda channel, message: slack.chat.post_message(channel, message, as_user=True)
+
+    def flush(self, timeout=30):
+        "Send every post made so far, waiting up to timeout seconds for the senders to."
+        if self._post_buffer:
+            self._post_buffer.flush()
+        if self._sender is not None and not self._sender.drain(timeout):
+            log.error("flush_timed_out queued=%d", len(self._sender))
+
+    def _dispatch(self, msg, chan_id=None):
+        "Run the responder on a message and send whatever it says back."
+        profile = self._profile
+        if profile is not None:
+            return profile.run(functools.partial(self._answer, msg, chan_id))
+        self._answer(msg, chan_id)
+
+    def _answer(self, msg, chan_id=None):
+        if chan_id is None:
+            responses = self.responder.respond_to_message(msg)
+        else:
+            responses = self.responder.respond_in_channel(chan_id, msg)
+        if not responses: return
+        if not isinstance(responses, (set, list, tuple)):
+            responses = [responses]
+        self._send_responses(responses)
+
+    def _messages(self):
+        "Convert socket events to Message objects, skipping the ones we don't care about."
         for e in self.socket.events():
-            # Convert socket event to Message object, if possible.
             try:
+                self.directory.handle_event(e)
                 msg = self._parse_message(e)
-            except StandardError, err:
-                print err
+            except StandardError:
+                ERRORS.inc('parse')
+                log.exception("parse_failed type=%s", e.type)
                 continue
-            if not msg:
+            if msg:
+                yield msg
+
+    # How often a listen loop with workers checks whether one of them asked to exit, when there's
+    # nothing to read; and how many messages can be read ahead of it.
+    EXIT_POLL_SECONDS = 0.1
+    MAX_READ_AHEAD = 1000
+
+    def _messages_until(self, stopped):
+        """
+        Like _messages, but read the socket on a thread of its own, and stop as soon as stopped()
+        is true rather than once the next event comes in, which could be a long while in a quiet
+        workspace.
+        """
+        inbox = Queue.Queue(self.MAX_READ_AHEAD)
+        def read():
+            try:
+                for msg in self._messages():
+                    inbox.put(msg)
+            finally:
+                inbox.put(None)
+        reader = threading.Thread(target=read, name='socket-reader')
+        reader.daemon = True
+        reader.start()
+        while not stopped():
+            try:
+                msg = inbox.get(timeout=self.EXIT_POLL_SECONDS)
+            except Queue.Empty:
                 continue
+            if msg is None:
+                return
+            yield msg
+
+    # Admin commands start {
+    def _handle_admin(self, msg):
+        "If this message is an admin command from an admin, carry it out and return True."
+        if msg.user_id not in self.admins:
+            return False
+        match = self.PROFILE_RE.match(msg.text)
+        if not match:
+            return False
+        action = match.group('action').lower()
+        profile = self._profile
+        if action == 'status':
+            if profile is None:
+                text = "Not profiling."
+            else:
+                text = "Profiling ({m}): {n} message{s} so far.".format(
+                    m=profile.mode, n=profile.num_messages, s='' if profile.num_messages == 1 else 's')
+        elif action == 'stop':
+            if profile is None:
+                text = "Not profiling."
+            else:
+                # _profile_done sends the summary, once any message being profiled is done.
+                profile.stop()
+                return True
+        elif profile is not None:
+            text = "Already profiling ({}). `profile stop` first.".format(profile.mode)
+        else:
+            seconds = messages = None
+            if match.group('amount'):
+                amount = int(match.group('amount'))
+                if match.group('unit').lower().startswith('s'):
+                    seconds = amount
+                else:
+                    messages = amount
+            if not messages:
+                seconds = min(seconds or self.DEFAULT_PROFILE_SECONDS, self.MAX_PROFILE_SECONDS)
+            self._profile = ProfileSession(
+                (match.group('mode') or 'sample').lower(), seconds=seconds, messages=messages,
+                out_dir=self.profile_dir,
+                on_done=functools.partial(self._profile_done, msg.user_id))
+            self._profile.start()
+            text = "Profiling ({m}) for {a}.".format(
+                m=self._profile.mode,
+                a='{} message{}'.format(messages, '' if messages == 1 else 's') if messages
+                  else '{} second{}'.format(seconds, '' if seconds == 1 else 's'))
+        self._send_responses([Response(text=text, im=msg.user_id)])
+        return True
+
+    def _profile_done(self, admin_id, profile, summary):
+        if self._profile is profile:
+            self._profile = None
+        self._send_responses([Response(text=summary, im=admin_id)])
+    # } and end.
 
-            responses = self.responder.respond_to_message(msg)
-            if not responses: continue
-            if not isinstance(responses, (set, list, tuple)):
-                responses = [responses]
-            for response in responses:
-                try:
-                    self._send_response(response)
-                except StandardError, err:
-                    print err
+    def listen(self):
+        log.info("Happy birthday!")
+        try:
+            for msg in self._messages():
+                if self._handle_admin(msg):
                     continue
+                self._dispatch(msg)
+        finally:
+            self.flush()
+
+    def listen_concurrently(self, num_workers=8):
+        """
+        Like listen, but hand each message to a pool of worker threads instead of answering it
+        before reading the next event. Each game gets its own lane, so messages for one channel
+        are answered in order, while a slow handler or a slow post only holds up its own channel.
+        Without a GameRegistry to say which game a message is for, everything shares one lane.
+        The socket is read on a thread of its own, so that a quit answered on a worker stops this
+        straight away, not once somebody says something else.
+        """
+        log.info("Happy birthday! workers=%d", num_workers)
+        route_key = getattr(self.responder, 'route_key', lambda msg: None)
+        dispatcher = ChannelDispatcher(num_workers)
+        try:
+            for msg in self._messages_until(lambda: dispatcher.exit_requested):
+                if self._handle_admin(msg):
+                    continue
+                chan_id = route_key(msg)
+                dispatcher.submit(chan_id, functools.partial(self._dispatch, msg, chan_id))
+        finally:
+            dispatcher.stop()
+            self.flush()
+        if dispatcher.exit_requested:
+            raise SystemExit
+
+    def listen_sharded(self, dispatcher):
+        """
+        Like listen_concurrently, but answer messages in the worker processes of dispatcher (from
+        fork_shards, called with this interface's responder before this interface was made), so
+        the games don't all share one GIL. This process reads the socket, keeps the directory, and
+        sends the responses (through the senders, if there are any). Each channel's game lives in
+        a single worker, picked by shard_of its id, which answers that channel's messages in order.
+
+        Games are still journaled by this process, from the records the workers send back. An
+        admin's profile only covers this process, not the workers. As with listen_concurrently, a
+        quit in a worker stops this without waiting for another message.
+        """
+        registry = self.responder
+        assert isinstance(registry, GameRegistry), "Sharding needs a GameRegistry to split up."
+        log.info("Happy birthday! shards=%d", dispatcher.num_shards)
+
+        def on_result(result):
+            kind, payload = result
+            if kind == 'journal':
+                registry.journal.append(*payload)
+            elif kind == 'discarded':
+                registry.discard(payload)
+            else:
+                chan_id, responses = payload
+                self._send_responses(responses)
+
+        dispatcher.start(on_result)
+        try:
+            for msg in self._messages_until(lambda: dispatcher.exit_requested):
+                if self._handle_admin(msg):
+                    continue
+                dispatcher.submit(registry.route_key(msg), msg)
+        finally:
+            dispatcher.stop()
+            self.flush()
+        if dispatcher.exit_requested:
+            raise SystemExit
+
 def main():
+    parser = argparse.ArgumentParser(description="Play card games in Slack.")
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help="Answer messages on this many worker threads. 0 answers them one at a time.")
+    parser.add_argument(
+        '--shards', type=int, default=0,
+        help="Answer messages in this many worker processes, each with the games of some of the "
+             "channels. 0 answers them in this process (see --workers).")
+    parser.add_argument(
+        '--senders', type=int, default=4,
+        help="Send posts to Slack from this many threads, each on its own connection. 0 posts each "
+             "as it's made, holding up whatever made it.")
+    parser.add_argument(
+        '--max-queued-posts', type=int, default=1000,
+        help="How many posts can wait to be sent before whatever's making them has to wait too.")
+    parser.add_argument(
+        '--coalesce-window', type=float, default=0,
+        help="Hold posts this many seconds, so the responses to several messages in a row can go "
+             "out as one post. 0 only merges the responses to each message.")
+    parser.add_argument(
+        '--journal', default='.slack_games.journal',
+        help="Where to journal the games, so they survive a restart.")
+    parser.add_argument(
+        '--directory-snapshot', default='.slack_directory.snapshot',
+        help="Where to keep a copy of the user and channel lists, for a fast restart.")
+    parser.add_argument(
+        '--log-level', default='INFO', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+        help="Log records at this level and up.")
+    parser.add_argument(
+        '--log-sample', type=float, default=1.0,
+        help="Keep only this fraction of DEBUG records, so debug logging can stay on under load.")
+    parser.add_argument(
+        '--validate', action='store_true',
+        help="Check the fields of every message as it's made. Slow; for debugging.")
+    parser.add_argument(
+        '--admin', action='append', default=[], metavar='USER_ID',
+        help="A user (by id) who can run admin commands, like `profile start`. Repeat for more.")
+    parser.add_argument(
+        '--profile-dir', default='profiles',
+        help="Where admin-run profiles are written.")
+    parser.add_argument(
+        '--metrics-port', type=int, default=0,
+        help="Serve metrics in the Prometheus text format at http://127.0.0.1:PORT/metrics. 0 doesn't.")
+    args = parser.parse_args()
+
+    configure_logging(getattr(logging, args.log_level), args.log_sample)
+    slack_objects.VALIDATE = args.validate
+
     # TODO: Implement 'select a game to play' functionality.
+    deck = deck_dict['major_arcana']
     if True:
-        card_game = RegexCardGame(deck=deck_dict['major_arcana'])
+        game_factory = lambda: RegexCardGame(deck=deck.copy())
     else:
-        card_game = MethodCardGame(deck=deck_dict['major_arcana'])
-    si = SlackInterface(card_game)
-    si.listen()
+        game_factory = lambda: MethodCardGame(deck=deck.copy())
+    journal = GameJournal(args.journal)
+    registry = GameRegistry(game_factory, journal)
+    # Fork the shards while this is still the only thread; everything below starts more.
+    dispatcher = fork_shards(registry, args.shards) if args.shards else None
+    if args.metrics_port:
+        MetricsServer(args.metrics_port)
+    si = SlackInterface(registry,
+                        directory_snapshot=args.directory_snapshot,
+                        admins=args.admin, profile_dir=args.profile_dir,
+                        num_senders=args.senders, max_queued_posts=args.max_queued_posts,
+                        coalesce_window=args.coalesce_window)
+    try:
+        if dispatcher:
+            si.listen_sharded(dispatcher)
+        elif args.workers:
+            si.listen_concurrently(args.workers)
+        else:
+            si.listen()
+    finally:
+        journal.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,304 @@
+import logging
+import marshal
+import os
+import threading
+import time
+
+from slack_metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+## Metrics.
+
+DIRECTORY_LOOKUPS = REGISTRY.counter(
+    'slack_directory_lookups_total',
+    "Directory lookups, by whether they were cached, cached as missing, or had to go to the API.",
+    ('result',))
+
+# What the info APIs say when an ID really doesn't exist, as opposed to the call failing.
+NOT_FOUND_ERRORS = frozenset(['user_not_found', 'channel_not_found'])
+
+def _not_found(err):
+    return str(err) in NOT_FOUND_ERRORS
+
+class SlackDirectory(object):
+    """
+    A cache of the workspace's user names, channel names and IM channels.
+
+    refresh() loads the whole directory from the list APIs. After that, the cache is kept up to
+    date from RTM events (see handle_event), and anything that's still missing is fetched on its
+    own with the matching info API. IDs that turn out not to exist are remembered for negative_ttl
+    seconds, so a bogus ID can't send us back to the API on every message. (Only when the API
+    says so, though: a call that times out or is rate limited is tried again next time.)
+
+    A refresh builds each map on the side and then replaces it in one assignment, so a lookup
+    never sees one half built. Events and lookups change single entries of the live maps in place,
+    under the lock. A refresh can take a while (the reconcile after a snapshot runs one in the
+    background), and whatever events and lookups change in the meantime is newer than what the
+    lists say, so it's applied on top of them before they go in.
+    """
+
+    # Don't let the negative cache grow without bound; drop expired entries past this size.
+    MAX_NEGATIVE_ENTRIES = 10000
+
+    def __init__(self, slack, negative_ttl=300):
+        self.slack = slack
+        self.negative_ttl = negative_ttl
+        self.user_id_to_user_name = {}
+        self.chan_id_to_chan_name = {}
+        self.user_id_to_im_chan_id = {}
+        self.im_chan_id_to_user_id = {}
+        self._missing_until = {}
+        self._lock = threading.Lock()
+        # While a refresh runs, the (map name, key, value) changes made since it started.
+        self._changes = None
+
+    def refresh(self):
+        "Reload the whole directory from the list APIs."
+        with self._lock:
+            self._changes = []
+        try:
+            maps = {}
+            maps['user_id_to_user_name'] = {
+                u['id']:u['name']
+                for u in self.slack.users.list().body['members']}
+            chans = {
+                c['id']:c['name']
+                for c in self.slack.channels.list().body['channels']}
+            chans.update({
+                g['id']:g['name']
+                for g in self.slack.groups.list().body['groups']})
+            maps['chan_id_to_chan_name'] = chans
+            maps['user_id_to_im_chan_id'], maps['im_chan_id_to_user_id'] = self._im_maps(
+                self.slack.im.list().body['ims'])
+            with self._lock:
+                for map_name, key, value in self._changes:
+                    if value is None:
+                        maps[map_name].pop(key, None)
+                    else:
+                        maps[map_name][key] = value
+                for map_name, new_map in maps.iteritems():
+                    setattr(self, map_name, new_map)
+                self._missing_until = {}
+        finally:
+            with self._lock:
+                self._changes = None
+
+    def _im_maps(self, ims):
+        user_id_to_im_chan_id = {
+            i['user']:i['id']
+            for i in ims}
+        im_chan_id_to_user_id = {
+            chan_id:user_id
+            for user_id, chan_id in user_id_to_im_chan_id.iteritems()}
+        return user_id_to_im_chan_id, im_chan_id_to_user_id
+
+    def _set_ims(self, ims):
+        user_id_to_im_chan_id, im_chan_id_to_user_id = self._im_maps(ims)
+        with self._lock:
+            self.user_id_to_im_chan_id = user_id_to_im_chan_id
+            self.im_chan_id_to_user_id = im_chan_id_to_user_id
+            if self._changes is not None:
+                self._changes.extend(('user_id_to_im_chan_id', user_id, chan_id)
+                                     for user_id, chan_id in user_id_to_im_chan_id.iteritems())
+                self._changes.extend(('im_chan_id_to_user_id', chan_id, user_id)
+                                     for chan_id, user_id in im_chan_id_to_user_id.iteritems())
+
+    def _change(self, map_name, key, value):
+        "Set key to value in a map (or drop it, if value is None), where a running refresh will keep it."
+        with self._lock:
+            if value is None:
+                getattr(self, map_name).pop(key, None)
+            else:
+                getattr(self, map_name)[key] = value
+            if self._changes is not None:
+                self._changes.append((map_name, key, value))
+
+    def _set_im(self, user_id, chan_id):
+        self._change('user_id_to_im_chan_id', user_id, chan_id)
+        self._change('im_chan_id_to_user_id', chan_id, user_id)
+
+    # Snapshots start {
+    SNAPSHOT_VERSION = 1
+
+    def save(self, path):
+        "Write the user, channel and IM maps to path, replacing it in one step."
+        data = marshal.dumps((
+            self.SNAPSHOT_VERSION,
+            self.user_id_to_user_name,
+            self.chan_id_to_chan_name,
+            self.user_id_to_im_chan_id))
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(data)
+        os.rename(temp_path, path)
+
+    def load(self, path):
+        "Load the maps saved by save(). Return False if there's no usable snapshot at path."
+        try:
+            with open(path, 'rb') as snapshot_file:
+                version, users, chans, ims = marshal.loads(snapshot_file.read())
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if version != self.SNAPSHOT_VERSION:
+            return False
+        self.user_id_to_user_name = users
+        self.chan_id_to_chan_name = chans
+        self.im_chan_id_to_user_id = {
+            chan_id:user_id
+            for user_id, chan_id in ims.iteritems()}
+        self.user_id_to_im_chan_id = ims
+        return True
+
+    def start(self, snapshot_path=None):
+        """
+        Get the directory ready to serve. If there's a snapshot at snapshot_path, load it and
+        reconcile with the live directory on a background thread (which is returned); otherwise
+        refresh from the API right now. Either way, save a fresh snapshot once we're up to date.
+        """
+        if snapshot_path and self.load(snapshot_path):
+            thread = threading.Thread(
+                target=self._reconcile, args=(snapshot_path,), name='directory-reconcile')
+            thread.daemon = True
+            thread.start()
+            return thread
+        self.refresh()
+        if snapshot_path:
+            self.save(snapshot_path)
+
+    def _reconcile(self, snapshot_path=None):
+        try:
+            self.refresh()
+            if snapshot_path:
+                self.save(snapshot_path)
+        except StandardError:
+            log.exception("reconcile_failed")
+    # } and end.
+
+    # RTM events start {
+    def handle_event(self, e):
+        "Update the directory from an RTM event, if it's one that changes it."
+        handler = self.EVENT_HANDLERS.get(e.type)
+        if handler:
+            handler(self, e.event)
+
+    def _on_user_event(self, event):
+        user = event['user']
+        self._change('user_id_to_user_name', user['id'], user['name'])
+        self._missing_until.pop(user['id'], None)
+
+    def _on_channel_event(self, event):
+        channel = event['channel']
+        self._change('chan_id_to_chan_name', channel['id'], channel['name'])
+        self._missing_until.pop(channel['id'], None)
+
+    def _on_channel_deleted(self, event):
+        self._change('chan_id_to_chan_name', event['channel'], None)
+
+    def _on_im_created(self, event):
+        self._set_im(event['user'], event['channel']['id'])
+        self._missing_until.pop(event['channel']['id'], None)
+
+    EVENT_HANDLERS = {
+        'user_change':_on_user_event,
+        'team_join':_on_user_event,
+        'channel_created':_on_channel_event,
+        'channel_joined':_on_channel_event,
+        'channel_rename':_on_channel_event,
+        'group_joined':_on_channel_event,
+        'group_rename':_on_channel_event,
+        'channel_deleted':_on_channel_deleted,
+        'im_created':_on_im_created,
+    }
+    # } and end.
+
+    # Lookups start {
+    def _known_missing(self, key):
+        missing_until = self._missing_until.get(key)
+        if missing_until is None:
+            return False
+        if missing_until < time.time():
+            self._missing_until.pop(key, None)
+            return False
+        DIRECTORY_LOOKUPS.inc('negative_hit')
+        return True
+
+    def _mark_missing(self, key):
+        now = time.time()
+        if len(self._missing_until) >= self.MAX_NEGATIVE_ENTRIES:
+            self._missing_until = {
+                k:v for k, v in self._missing_until.iteritems() if v >= now}
+        self._missing_until[key] = now + self.negative_ttl
+
+    def user_name(self, user_id):
+        "Return the name of this user, looking them up if we have to."
+        if user_id in self.user_id_to_user_name:
+            DIRECTORY_LOOKUPS.inc('hit')
+            return self.user_id_to_user_name[user_id]
+        if not self._known_missing(user_id):
+            DIRECTORY_LOOKUPS.inc('api')
+            try:
+                user = self.slack.users.info(user_id).body['user']
+            except StandardError, err:
+                if not _not_found(err):
+                    log.warning("user_lookup_failed user_id=%s error=%r", user_id, err)
+                    raise ValueError, "Could not look up user id."
+                self._mark_missing(user_id)
+            else:
+                self._change('user_id_to_user_name', user['id'], user['name'])
+                return user['name']
+        raise ValueError, "Could not find user id."
+
+    def channel(self, chan_id):
+        """
+        Return (chan_name, is_im) for this channel, looking it up if we have to.
+        IMs have no name, so chan_name is None for them.
+        """
+        if chan_id in self.chan_id_to_chan_name:
+            DIRECTORY_LOOKUPS.inc('hit')
+            return self.chan_id_to_chan_name[chan_id], False
+        elif chan_id in self.im_chan_id_to_user_id:
+            DIRECTORY_LOOKUPS.inc('hit')
+            return None, True
+        if not self._known_missing(chan_id):
+            DIRECTORY_LOOKUPS.inc('api')
+            try:
+                if chan_id.startswith('D'):
+                    # There's no im.info; the IM list is the cheapest way to find one.
+                    self._set_ims(self.slack.im.list().body['ims'])
+                elif chan_id.startswith('G'):
+                    channel = self.slack.groups.info(chan_id).body['group']
+                    self._change('chan_id_to_chan_name', channel['id'], channel['name'])
+                else:
+                    channel = self.slack.channels.info(chan_id).body['channel']
+                    self._change('chan_id_to_chan_name', channel['id'], channel['name'])
+            except StandardError, err:
+                if not _not_found(err):
+                    log.warning("channel_lookup_failed chan_id=%s error=%r", chan_id, err)
+                    raise ValueError, "Could not look up channel_id."
+            if chan_id in self.chan_id_to_chan_name:
+                return self.chan_id_to_chan_name[chan_id], False
+            elif chan_id in self.im_chan_id_to_user_id:
+                return None, True
+            self._mark_missing(chan_id)
+        raise ValueError, "Could not find channel_id."
+
+    def im_channel(self, user_id):
+        "Return the id of our IM channel with this user, opening one if we have to."
+        if user_id in self.user_id_to_im_chan_id:
+            DIRECTORY_LOOKUPS.inc('hit')
+            return self.user_id_to_im_chan_id[user_id]
+        if not self._known_missing(('im', user_id)):
+            DIRECTORY_LOOKUPS.inc('api')
+            try:
+                chan_id = self.slack.im.open(user_id).body['channel']['id']
+            except StandardError, err:
+                if not _not_found(err):
+                    log.warning("im_open_failed user_id=%s error=%r", user_id, err)
+                    raise ValueError, "Could not open an IM channel for user id."
+                self._mark_missing(('im', user_id))
+            else:
+                self._set_im(user_id, chan_id)
+                return chan_id
+        raise ValueError, "Could not find an IM channel for user id."
+    # } and end.
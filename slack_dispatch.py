@@ -0,0 +1,482 @@
+import collections
+import heapq
+import logging
+import multiprocessing
+import threading
+import time
+import zlib
+import Queue
+
+from slack_metrics import REGISTRY, now
+
+log = logging.getLogger(__name__)
+
+## Metrics.
+
+POSTS = REGISTRY.counter(
+    'slack_posts_total', "Posts to Slack, by whether they went through.", ('result',))
+QUEUED_POSTS = REGISTRY.gauge(
+    'slack_posts_queued', "Posts waiting for a PostSender to send them, or being sent.")
+POST_SECONDS = REGISTRY.histogram(
+    'slack_post_seconds', "Time taken by each call to post to Slack, by how it went.", ('result',))
+POST_DELAY_SECONDS = REGISTRY.histogram(
+    'slack_post_delay_seconds', "Time from queueing a post to Slack taking it, waits and retries included.")
+
+def coalesce_posts(posts, max_chars=4000):
+    """
+    Given a sequence of (channel, text) posts, merge the texts bound for each channel in to as few
+    posts as will fit in max_chars, one line per original post. Each channel's texts keep their
+    order, and channels go out in the order they first appear. A single text longer than max_chars
+    is sent on its own rather than cut up.
+    """
+    merged = collections.OrderedDict()
+    for channel, text in posts:
+        chunks = merged.setdefault(channel, [])
+        if chunks and len(chunks[-1]) + 1 + len(text) <= max_chars:
+            chunks[-1] += u'\n' + text
+        else:
+            chunks.append(text)
+    return [(channel, text) for channel, chunks in merged.iteritems() for text in chunks]
+
+class PostBuffer(object):
+    """
+    Holds outgoing (channel, text) posts for up to `window` seconds, then sends them through
+    coalesce_posts from a background thread, so responses from several messages in a row can share
+    a single post.
+    """
+
+    def __init__(self, post, window=0.25, max_chars=4000):
+        assert callable(post)
+        self._post = post
+        self._window = window
+        self._max_chars = max_chars
+        self._lock = threading.Lock()
+        self._sending = threading.Lock()   # One flush at a time, so posts stay in order.
+        self._posts = []
+        self._waiting = threading.Event()
+        self._flusher = threading.Thread(target=self._run, name='post-buffer')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def extend(self, posts):
+        "Queue some (channel, text) posts to go out with the next flush."
+        with self._lock:
+            self._posts.extend(posts)
+            self._waiting.set()
+
+    def flush(self):
+        "Send everything queued so far, now."
+        with self._sending:
+            with self._lock:
+                posts, self._posts = self._posts, []
+                self._waiting.clear()
+            for channel, text in coalesce_posts(posts, self._max_chars):
+                try:
+                    self._post(channel, text)
+                except Exception:
+                    log.exception("post_failed channel=%s", channel)
+
+    def _run(self):
+        while True:
+            self._waiting.wait()
+            time.sleep(self._window)
+            self.flush()
+
+class ChannelDispatcher(object):
+    """
+    Runs jobs on a small pool of worker threads, one lane per key. Jobs that share a key run one
+    at a time, in the order they were submitted; jobs with different keys run side by side, so a
+    slow job (or a slow post to Slack) only holds up its own lane.
+    """
+
+    _STOP = object()
+
+    def __init__(self, num_workers=8):
+        assert isinstance(num_workers, int) and num_workers > 0
+        self._lock = threading.Condition()
+        self._lanes = {}   # key -> deque of jobs waiting behind the one that's running.
+        self._pending = 0
+        self._ready = Queue.Queue()
+        self.exit_requested = False
+        self._workers = [
+            threading.Thread(target=self._work, name='dispatch-{}'.format(i))
+            for i in range(num_workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def __len__(self):
+        "How many jobs are queued or running."
+        return self._pending
+
+    def submit(self, key, job):
+        "Queue a no-argument callable to run after every job already submitted with this key."
+        with self._lock:
+            self._pending += 1
+            lane = self._lanes.get(key)
+            if lane is not None:
+                lane.append(job)
+                return
+            self._lanes[key] = collections.deque([job])
+        self._ready.put(key)
+
+    def stop(self, wait=True):
+        "Let queued jobs finish (unless wait is False or a job asked to exit), then stop the workers."
+        with self._lock:
+            while wait and self._pending and not self.exit_requested:
+                self._lock.wait(0.1)
+        for _ in self._workers:
+            self._ready.put(self._STOP)
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            if key is self._STOP:
+                return
+            with self._lock:
+                job = self._lanes[key].popleft()
+            try:
+                job()
+            except SystemExit:
+                self.exit_requested = True
+            except Exception:
+                log.exception("job_failed key=%s", key)
+            with self._lock:
+                self._pending -= 1
+                if self._lanes[key]:
+                    # Back of the line, so one busy channel can't starve the rest.
+                    self._ready.put(key)
+                else:
+                    del self._lanes[key]
+                self._lock.notify_all()
+
+# Sending posts start {
+
+# How long to wait when Slack turns a post away for going too fast but doesn't say for how long.
+DEFAULT_RETRY_AFTER = 1.0
+
+def retry_after(err):
+    """
+    If err is Slack turning a call away for going too fast (HTTP 429), return the seconds it asked
+    us to wait for (its Retry-After header); otherwise None. Knows requests' HTTPError (which
+    slacker raises), urllib2's, and an ok: false body saying 'ratelimited'.
+    """
+    response = getattr(err, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(err, 'code', None)
+    if status == 429:
+        headers = getattr(response, 'headers', None) or getattr(err, 'headers', None) or {}
+        try:
+            return max(0.0, float(headers.get('Retry-After')))
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER
+    if str(err) == 'ratelimited':
+        return DEFAULT_RETRY_AFTER
+    return None
+
+class TokenBucket(object):
+    "Lets through rate posts a second, on average, and up to burst of them at once after a lull."
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, at):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = at
+
+    def _refill(self, at):
+        if at > self.updated:
+            self.tokens = min(self.burst, self.tokens + (at - self.updated) * self.rate)
+            self.updated = at
+
+    def ready_at(self, at):
+        "When, no earlier than at, the next post can go."
+        self._refill(at)
+        if self.tokens >= 1:
+            return max(at, self.updated)
+        return max(at, self.updated) + (1 - self.tokens) / self.rate
+
+    def take(self, at):
+        self._refill(at)
+        self.tokens -= 1
+
+    def pause(self, until):
+        "Let nothing through before until (as Slack's Retry-After says), then one post, then rate a second."
+        self.tokens = 1
+        self.updated = max(self.updated, until)
+
+class _QueuedPost(object):
+    __slots__ = ('text', 'queued_at', 'failures')
+
+    def __init__(self, text, queued_at):
+        self.text = text
+        self.queued_at = queued_at
+        self.failures = 0
+
+class PostSender(object):
+    """
+    Sends (channel, text) posts to Slack from a small pool of threads, so whoever queues them
+    doesn't wait on Slack. Each thread calls make_post() once for the post(channel, text) it
+    sends with, so each can keep its own connection open.
+
+    Each channel's posts go out one at a time, in the order they were queued, no faster than its
+    token bucket lets them (Slack allows about one post a second in a channel, with short bursts).
+    A post Slack turns away for going too fast is retried after the Retry-After it gives, holding
+    up only its channel; one that fails otherwise is retried a few times, backing off, then dropped.
+
+    At most max_queued posts wait at once. Past that, send() blocks for up to queue_timeout
+    seconds for room, then drops the post.
+    """
+
+    def __init__(self, make_post, num_workers=4, max_queued=1000, rate=1.0, burst=3,
+                 max_failures=4, queue_timeout=5.0):
+        assert callable(make_post)
+        assert isinstance(num_workers, int) and num_workers > 0
+        self._make_post = make_post
+        self.max_queued = max_queued
+        self.rate = rate
+        self.burst = burst
+        self.max_failures = max_failures
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Condition()
+        self._lanes = {}     # channel -> deque of _QueuedPosts; the first may be being sent.
+        self._buckets = {}   # channel -> TokenBucket
+        self._ready = []     # Heap of (when, channel), for channels with posts and none being sent.
+        self._queued = 0
+        self._stopping = False
+        self._workers = [
+            threading.Thread(target=self._work, name='sender-{}'.format(i))
+            for i in range(num_workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def __len__(self):
+        "How many posts are queued or being sent."
+        return self._queued
+
+    def send(self, channel, text):
+        "Queue a post. Return False if it was dropped because the queue stayed full."
+        with self._lock:
+            deadline = None
+            while self._queued >= self.max_queued:
+                if deadline is None:
+                    deadline = now() + self.queue_timeout
+                left = deadline - now()
+                if left <= 0:
+                    POSTS.inc('dropped')
+                    log.error("post_dropped channel=%s queued=%d", channel, self._queued)
+                    return False
+                self._lock.wait(left)
+            self._queued += 1
+            QUEUED_POSTS.set(self._queued)
+            lane = self._lanes.get(channel)
+            if lane is None:
+                lane = self._lanes[channel] = collections.deque()
+                self._schedule(channel, now())
+                self._lock.notify_all()
+            lane.append(_QueuedPost(text, now()))
+        return True
+
+    def drain(self, timeout=None):
+        "Wait until every post queued has been sent or dropped, for up to timeout seconds. Return whether they were."
+        deadline = None if timeout is None else now() + timeout
+        with self._lock:
+            while self._queued:
+                if deadline is not None and deadline <= now():
+                    return False
+                self._lock.wait(1 if deadline is None else min(1, deadline - now()))
+        return True
+
+    def stop(self, timeout=None):
+        "Send what's queued (waiting up to timeout seconds for it), then stop the workers."
+        self.drain(timeout)
+        with self._lock:
+            self._stopping = True
+            self._lock.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _schedule(self, channel, at):
+        bucket = self._buckets.get(channel)
+        if bucket is None:
+            bucket = self._buckets[channel] = TokenBucket(self.rate, self.burst, at)
+        heapq.heappush(self._ready, (bucket.ready_at(at), channel))
+
+    def _next(self):
+        "Wait for a channel whose next post can go now; take it off the heap. None if stopping."
+        with self._lock:
+            while not self._stopping:
+                if not self._ready:
+                    self._lock.wait()
+                    continue
+                wait = self._ready[0][0] - now()
+                if wait > 0:
+                    self._lock.wait(wait)
+                    continue
+                _, channel = heapq.heappop(self._ready)
+                self._buckets[channel].take(now())
+                return channel, self._lanes[channel][0]
+
+    def _work(self):
+        post = self._make_post()
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            channel, queued = job
+            start = now()
+            try:
+                post(channel, queued.text)
+            except Exception, err:
+                wait = retry_after(err)
+                result = 'rate_limited' if wait is not None else 'error'
+                if wait is None:
+                    queued.failures += 1
+                    wait = 0.5 * 2 ** queued.failures
+                    log.warning("post_failed channel=%s failures=%d", channel, queued.failures, exc_info=True)
+            else:
+                wait = None
+                result = 'ok'
+            end = now()
+            POST_SECONDS.observe(end - start, result)
+            POSTS.inc(result)
+            with self._lock:
+                lane = self._lanes[channel]
+                if result != 'ok' and queued.failures < self.max_failures:
+                    # Try it again, once the channel's had a rest.
+                    self._buckets[channel].pause(end + wait)
+                else:
+                    if result == 'ok':
+                        POST_DELAY_SECONDS.observe(end - queued.queued_at)
+                    else:
+                        POSTS.inc('dropped')
+                        log.error("post_dropped channel=%s failures=%d", channel, queued.failures)
+                    lane.popleft()
+                    self._queued -= 1
+                    QUEUED_POSTS.set(self._queued)
+                if lane:
+                    self._schedule(channel, end)
+                else:
+                    del self._lanes[channel]
+                self._lock.notify_all()
+# } and end.
+
+def shard_of(key, num_shards):
+    "Return which of num_shards shards key belongs to. The same key gets the same shard in every process."
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % num_shards
+
+class ShardedDispatcher(object):
+    """
+    Like ChannelDispatcher, but the work is done in num_shards worker processes, so it isn't all
+    behind one GIL. Every item with a given key goes to the same shard (see shard_of), in the order
+    it was submitted.
+
+    Each worker process is forked from this one, and calls start_shard(shard, emit) once to get
+    the handle(key, item) it runs items with. Whatever a worker passes to emit is pickled back to
+    this process, where on_result(result) gets it on a thread of its own, in the order that worker
+    emitted them. on_result can wait to be given to start(), so that the workers can be forked
+    first thing, before anything else this process does starts a thread: a worker only gets the
+    thread that forked it, and any lock another thread held at the time (logging's, a queue's)
+    stays held in the worker for good.
+    """
+
+    def __init__(self, num_shards, start_shard, on_result=None):
+        assert isinstance(num_shards, int) and num_shards > 0
+        assert callable(start_shard)
+        self.num_shards = num_shards
+        self._start_shard = start_shard
+        self._on_result = None
+        self._collector = None
+        self.exit_requested = False
+        if threading.active_count() > 1:
+            log.warning("shards_forked_with_threads threads=%s",
+                        ','.join(thread.name for thread in threading.enumerate()))
+        self._inboxes = [multiprocessing.Queue() for _ in range(num_shards)]
+        self._results = multiprocessing.Queue()
+        self._workers = [
+            multiprocessing.Process(target=self._work, args=(shard,), name='shard-{}'.format(shard))
+            for shard in range(num_shards)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+        if on_result is not None:
+            self.start(on_result)
+
+    def start(self, on_result):
+        "Start passing on what the workers emit, to on_result(result). Return this object."
+        assert callable(on_result) and self._collector is None
+        self._on_result = on_result
+        self._collector = threading.Thread(target=self._collect, name='shard-results')
+        self._collector.daemon = True
+        self._collector.start()
+        return self
+
+    def submit(self, key, item):
+        "Queue item (which has to pickle) for the shard that key belongs to."
+        self._inboxes[shard_of(key, self.num_shards)].put((key, item))
+
+    def stop(self, wait=True):
+        """
+        Let the workers finish what's queued (unless wait is False), pass on all they emitted,
+        then stop them.
+        """
+        if not wait:
+            for worker in self._workers:
+                worker.terminate()
+        if self._collector is None:
+            # Nothing wants the results, but the workers can't exit until they're taken.
+            self.start(lambda result: None)
+        for inbox in self._inboxes:
+            inbox.put(None)
+        self._collector.join()
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self, shard):
+        results = self._results
+        def emit(result):
+            results.put(('result', result))
+        inbox = self._inboxes[shard]
+        try:
+            handle = self._start_shard(shard, emit)
+            while True:
+                job = inbox.get()
+                if job is None:
+                    break
+                try:
+                    handle(*job)
+                except SystemExit:
+                    results.put(('exit', None))
+                except Exception:
+                    log.exception("job_failed shard=%d key=%s", shard, job[0])
+        finally:
+            results.put(('done', shard))
+            # Wait for the queue's feeder thread to hand everything over before exiting.
+            results.close()
+            results.join_thread()
+
+    def _collect(self):
+        done = set()
+        while len(done) < self.num_shards:
+            try:
+                kind, result = self._results.get(timeout=1)
+            except Queue.Empty:
+                # A worker that died without saying so isn't going to.
+                if not any(worker.is_alive() for shard, worker in enumerate(self._workers)
+                           if shard not in done):
+                    break
+                continue
+            if kind == 'done':
+                done.add(result)
+            elif kind == 'exit':
+                self.exit_requested = True
+            else:
+                try:
+                    self._on_result(result)
+                except Exception:
+                    log.exception("result_failed")
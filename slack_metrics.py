@@ -0,0 +1,265 @@
+import BaseHTTPServer
+import bisect
+import functools
+import logging
+import random
+import threading
+import timeit
+
+# Metrics start {
+# Counters and latency histograms, kept in a registry and served in the Prometheus text format.
+
+def _label_text(label_names, label_values, extra=()):
+    pairs = zip(label_names, label_values) + list(extra)
+    if not pairs:
+        return u''
+    return u'{' + u','.join(
+        u'{}="{}"'.format(name, unicode(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs) + u'}'
+
+class Counter(object):
+    "A count of things that have happened, one per combination of label values."
+
+    TYPE = 'counter'
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values):
+        "Add one to the count for these label values."
+        self.add(1, *label_values)
+
+    def add(self, amount, *label_values):
+        "Add amount to the count for these label values."
+        # This is on every message's path, so take the lock by hand rather than with a with.
+        self._lock.acquire()
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+        self._lock.release()
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def expose(self):
+        "Return the Prometheus text lines for this counter."
+        with self._lock:
+            values = sorted(self._values.items())
+        return [u'{}{} {}'.format(self.name, _label_text(self.label_names, label_values), value)
+                for label_values, value in values]
+
+class Gauge(object):
+    "An amount that goes up and down (how many posts are queued, say), one per combination of label values."
+
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def set(self, value, *label_values):
+        "Set the amount for these label values."
+        self._lock.acquire()
+        self._values[label_values] = value
+        self._lock.release()
+
+    def add(self, amount, *label_values):
+        "Add amount (which may be negative) to the amount for these label values."
+        self._lock.acquire()
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+        self._lock.release()
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def expose(self):
+        "Return the Prometheus text lines for this gauge."
+        with self._lock:
+            values = sorted(self._values.items())
+        return [u'{}{} {!r}'.format(self.name, _label_text(self.label_names, label_values), value)
+                for label_values, value in values]
+
+class Histogram(object):
+    """
+    How long something took (or any other amount), counted in to buckets, one set of buckets per
+    combination of label values. Buckets are upper bounds in seconds, as Prometheus expects.
+    """
+
+    TYPE = 'histogram'
+    BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, label_names=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}   # label values -> [count in each bucket..., sum]
+
+    def observe(self, amount, *label_values):
+        "Count one observation of amount for these label values."
+        series = self._series.get(label_values)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(label_values, [0] * (len(self.buckets) + 2))
+        index = bisect.bisect_left(self.buckets, amount)
+        # This is on every message's path, so take the lock by hand rather than with a with.
+        self._lock.acquire()
+        series[index] += 1
+        series[-1] += amount
+        self._lock.release()
+
+    def time(self, *label_values):
+        "Return a context manager that observes how long its with block takes."
+        return _Timer(self, label_values)
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return sum(series[:-1]) if series else 0
+
+    def expose(self):
+        "Return the Prometheus text lines for this histogram."
+        with self._lock:
+            all_series = sorted((label_values, list(series)) for label_values, series in self._series.items())
+        lines = []
+        for label_values, series in all_series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                lines.append(u'{}_bucket{} {}'.format(
+                    self.name,
+                    _label_text(self.label_names, label_values, [('le', '+Inf' if bound == float('inf') else repr(bound))]),
+                    cumulative))
+            labels = _label_text(self.label_names, label_values)
+            lines.append(u'{}_sum{} {!r}'.format(self.name, labels, series[-1]))
+            lines.append(u'{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+# The clock latencies are measured with.
+now = timeit.default_timer
+
+class _Timer(object):
+    def __init__(self, histogram, label_values):
+        self._histogram = histogram
+        self._label_values = label_values
+    def __enter__(self):
+        self._start = now()
+    def __exit__(self, *exc_info):
+        self._histogram.observe(now() - self._start, *self._label_values)
+
+class MetricsRegistry(object):
+    "The metrics of a process, by name."
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, metric_class, name, help, label_names, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, help, label_names, **kwargs)
+            assert isinstance(metric, metric_class) and metric.label_names == tuple(label_names), (
+                "{} is already registered differently".format(name))
+            return metric
+
+    def counter(self, name, help, label_names=()):
+        "Return the counter with this name, registering it if it's new."
+        return self._get(Counter, name, help, label_names)
+
+    def gauge(self, name, help, label_names=()):
+        "Return the gauge with this name, registering it if it's new."
+        return self._get(Gauge, name, help, label_names)
+
+    def histogram(self, name, help, label_names=(), **kwargs):
+        "Return the histogram with this name, registering it if it's new."
+        return self._get(Histogram, name, help, label_names, **kwargs)
+
+    def expose(self):
+        "Return every metric in the Prometheus text format."
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for name, metric in metrics:
+            lines.append(u'# HELP {} {}'.format(name, metric.help))
+            lines.append(u'# TYPE {} {}'.format(name, metric.TYPE))
+            lines.extend(metric.expose())
+        return u'\n'.join(lines) + u'\n'
+
+# The registry the bot's own metrics go in.
+REGISTRY = MetricsRegistry()
+
+def timed(histogram, *label_values):
+    "Decorator: observe how long each call to the function takes in histogram."
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = now()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(now() - start, *label_values)
+        return wrapper
+    return decorator
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            return self.send_error(404)
+        data = self.server.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    "Serves a registry at http://host:port/metrics from a background thread."
+
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _MetricsHandler)
+        self.registry = registry
+        self._thread = threading.Thread(target=self.serve_forever, name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+# } and end.
+
+# Logging start {
+class SampleFilter(logging.Filter):
+    """
+    Let through only a fraction (sample_rate) of the records below min_level, picked at random, so
+    debug logging can stay on under load. Records at min_level and up always get through.
+    """
+
+    def __init__(self, sample_rate=1.0, min_level=logging.INFO):
+        logging.Filter.__init__(self)
+        self.sample_rate = sample_rate
+        self.min_level = min_level
+
+    def filter(self, record):
+        return record.levelno >= self.min_level or random.random() < self.sample_rate
+
+LOG_FORMAT = '%(asctime)s level=%(levelname)s logger=%(name)s %(message)s'
+
+def configure_logging(level=logging.INFO, sample_rate=1.0, stream=None):
+    """
+    Send log records to stream (stderr by default) as key=value lines, keeping only sample_rate
+    of those below INFO.
+    """
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(SampleFilter(sample_rate))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
+# } and end.
@@ -1,4 +1,20 @@
+import re
+
+# Check the fields of every Message as it's made. That's a chain of isinstance calls on every
+# message the bot sees, so it's off unless we're debugging (see --validate in slack_dicebot).
+VALIDATE = False
+
 class Message(object):
+    """
+    A message someone sent. Its words (tokenized, and token_set for membership tests) are only
+    worked out from the text the first time something asks for them, unless they're given.
+    """
+
+    __slots__ = ('text', 'user_id', 'chan_id', 'im', 'user_name', 'chan_name', '_tokenized', '_token_set')
+
+    # Words, @mentions and `quoted bits`, from the lowercased text.
+    TOKENIZER_RE = re.compile(r'(?:@?\w+|`[^`]*`)')
+
     def __init__(self,
                  text=None,
                  user_id=None,
@@ -8,27 +24,41 @@ class Message(object):
                  chan_name=None,
                  tokenized=None
                  ):
-        assert isinstance(text, (basestring))
         self.text = text
-
-        assert isinstance(user_id, (basestring))
         self.user_id = user_id
-
-        assert isinstance(chan_id, (basestring))
         self.chan_id = chan_id
-
-        assert isinstance(im, bool)
         self.im = im
-
-        if user_name: assert isinstance(user_name, (basestring))
         self.user_name = user_name
-
-        if chan_name: assert isinstance(chan_name, (basestring))
         self.chan_name = chan_name
+        self._tokenized = tokenized
+        self._token_set = None
+        if VALIDATE:
+            self.validate()
+
+    def validate(self):
+        "Assert that the fields are of the types they should be."
+        assert isinstance(self.text, (basestring))
+        assert isinstance(self.user_id, (basestring))
+        assert isinstance(self.chan_id, (basestring))
+        assert isinstance(self.im, bool)
+        if self.user_name: assert isinstance(self.user_name, (basestring))
+        if self.chan_name: assert isinstance(self.chan_name, (basestring))
+        if self._tokenized: assert (isinstance(self._tokenized, (list, tuple))
+                                    and all(isinstance(x, basestring) for x in self._tokenized))
 
-        if tokenized: assert (isinstance(tokenized, (list, tuple))
-                              and all(isinstance(x, basestring) for x in tokenized))
-        self.tokenized = tokenized
+    @property
+    def tokenized(self):
+        "The words of the lowercased text, in order."
+        if self._tokenized is None:
+            self._tokenized = self.TOKENIZER_RE.findall(self.text.lower())
+        return self._tokenized
+
+    @property
+    def token_set(self):
+        "The words of the lowercased text, as a frozenset."
+        if self._token_set is None:
+            self._token_set = frozenset(self.tokenized)
+        return self._token_set
 
     def __str__(self):
         return "{u}@{c}: {t}".format(
@@ -46,6 +76,9 @@ class Message(object):
 
 
 class Response(object):
+
+    __slots__ = ('none', 'text', 'chan_id', 'im')
+
     def __init__(self, text=None, chan_id=None, im=None, none=False):
         self.none = none
         self.text = text
@@ -0,0 +1,292 @@
+import collections
+import cProfile
+import logging
+import marshal
+import os
+import pstats
+import StringIO
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class ProfileSession(object):
+    """
+    Profiles a running bot for a while, without a restart, then writes what it found to out_dir
+    and hands a top-N summary to on_done(session, summary).
+
+    In 'sample' mode a background thread looks at the stack of every thread that's handling a
+    message (see run()) each interval seconds, which costs the bot next to nothing. In 'cprofile'
+    mode each message is run under cProfile (see run()), which counts every call but slows the
+    bot down while it's on.
+
+    Either way the results are written twice: as collapsed stacks (a .collapsed file of
+    'outer;inner;innermost count' lines, as flame graph tools expect) and as pstats (a .pstats
+    file, for pstats or snakeviz). path is the one the mode gives first hand, paths both. Samples
+    only know which functions were running, not their calls, so in their pstats every call count
+    is a count of samples, and the times are samples * interval. cProfile's stacks are worked out
+    from who called whom, sharing each function's time between its callers in proportion to what
+    each called it for, with counts in microseconds.
+
+    The session stops after seconds seconds, or after messages messages, or when stop() is called,
+    whichever comes first.
+    """
+
+    MODES = ('sample', 'cprofile')
+
+    def __init__(self, mode='sample', seconds=None, messages=None, out_dir='profiles',
+                 on_done=None, interval=0.005, top=15):
+        assert mode in self.MODES
+        self.mode = mode
+        self.seconds = seconds
+        self.messages = messages
+        self.out_dir = out_dir
+        self.on_done = on_done
+        self.interval = interval
+        self.top = top
+        self.num_messages = 0
+        self.path = None
+        self.paths = ()
+        self._lock = threading.Lock()
+        self._active = False
+        self._in_flight = 0
+        self._finished = False
+        self._profiles = []
+        self._local = threading.local()
+        self._busy_threads = set()
+        self._stacks = collections.Counter()
+
+    @property
+    def active(self):
+        "Whether messages are still being profiled."
+        return self._active
+
+    def start(self):
+        "Start profiling. Return this object."
+        self._started = time.time()
+        self._active = True
+        if self.mode == 'sample':
+            self._sampler = threading.Thread(target=self._sample, name='profile-sampler')
+            self._sampler.daemon = True
+            self._sampler.start()
+        if self.seconds:
+            self._timer = threading.Timer(self.seconds, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+        log.info("profile_started mode=%s seconds=%s messages=%s", self.mode, self.seconds, self.messages)
+        return self
+
+    def run(self, func):
+        "Call func() as one message: under cProfile if that's the mode, and counting towards the limit."
+        with self._lock:
+            if not self._active:
+                return func()
+            self._in_flight += 1
+        try:
+            if self.mode == 'cprofile':
+                profile = getattr(self._local, 'profile', None)
+                if profile is None:
+                    # cProfile only sees the thread it's enabled in, so each worker gets its own.
+                    profile = self._local.profile = cProfile.Profile()
+                    with self._lock:
+                        self._profiles.append(profile)
+                profile.enable()
+                try:
+                    return func()
+                finally:
+                    profile.disable()
+            thread_id = threading.current_thread().ident
+            self._busy_threads.add(thread_id)
+            try:
+                return func()
+            finally:
+                self._busy_threads.discard(thread_id)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self.num_messages += 1
+                if self.messages and self.num_messages >= self.messages:
+                    self._active = False
+                finish = not self._active and not self._in_flight
+            if finish:
+                self._finish()
+
+    def stop(self):
+        "Stop profiling; the results are written once any message still being profiled is done."
+        with self._lock:
+            self._active = False
+            finish = not self._in_flight
+        if finish:
+            self._finish()
+
+    def _sample(self):
+        while self._active:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in self._busy_threads:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self._stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def _finish(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        if self.seconds:
+            self._timer.cancel()
+        try:
+            if not os.path.isdir(self.out_dir):
+                os.makedirs(self.out_dir)
+            base = self._new_base()
+            collapsed_path, pstats_path = base + '.collapsed', base + '.pstats'
+            if self.mode == 'sample':
+                self.paths = (collapsed_path, pstats_path)
+                self.path = collapsed_path
+                self._sampler.join()
+                summary = self._write_samples(collapsed_path, pstats_path)
+            else:
+                self.paths = (pstats_path, collapsed_path)
+                self.path = pstats_path
+                summary = self._write_pstats(pstats_path, collapsed_path)
+        except (IOError, OSError), err:
+            log.exception("profile_write_failed")
+            summary = "Profiling finished, but I couldn't write the results: {}".format(err)
+        log.info("profile_finished mode=%s path=%s", self.mode, self.path)
+        if self.on_done:
+            self.on_done(self, summary)
+
+    def _new_base(self):
+        "A path in out_dir, without an extension, that neither results file is at yet."
+        name = 'profile-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), self.mode)
+        base = os.path.join(self.out_dir, name)
+        copy = 1
+        while os.path.exists(base + '.collapsed') or os.path.exists(base + '.pstats'):
+            base = os.path.join(self.out_dir, '{}-{}'.format(name, copy))
+            copy += 1
+        return base
+
+    def _header(self):
+        return "Profiled ({m}) {n} message{s} over {t:.1f}s; results in {p}.".format(
+            m=self.mode, n=self.num_messages, s='' if self.num_messages == 1 else 's',
+            t=time.time() - self._started, p=' and '.join('`{}`'.format(path) for path in self.paths))
+
+    @staticmethod
+    def _write_collapsed(path, stacks):
+        with open(path, 'wb') as out:
+            for stack, count in sorted(stacks.iteritems()):
+                out.write('{} {}\n'.format(stack, count))
+
+    def _samples_as_pstats(self):
+        """
+        The samples as the dict pstats loads: for each function, (calls, calls, own time, total
+        time, {caller: the same, for the calls from there}), counting a sample as a call.
+        """
+        def func(frame):
+            filename, _, name = frame.rpartition(':')
+            return (filename, 0, name)
+        entries = {}
+        for stack, count in self._stacks.iteritems():
+            frames = [func(frame) for frame in stack.split(';')]
+            seconds = count * self.interval
+            innermost = frames[-1]
+            seen = set()
+            for depth, callee in enumerate(frames):
+                caller = frames[depth - 1] if depth else None
+                if (caller, callee) in seen:
+                    continue
+                own = seconds if callee == innermost else 0.0
+                entry = entries.setdefault(callee, [0, 0, 0.0, 0.0, {}])
+                if callee not in seen:
+                    entry[0] += count
+                    entry[1] += count
+                    entry[2] += own
+                    entry[3] += seconds
+                    seen.add(callee)
+                if caller is not None:
+                    calls = entry[4].setdefault(caller, [0, 0, 0.0, 0.0])
+                    calls[0] += count
+                    calls[1] += count
+                    calls[2] += own
+                    calls[3] += seconds
+                seen.add((caller, callee))
+        return dict(
+            (callee, (cc, nc, tt, ct, dict((caller, tuple(calls)) for caller, calls in callers.iteritems())))
+            for callee, (cc, nc, tt, ct, callers) in entries.iteritems())
+
+    def _write_samples(self, path, pstats_path):
+        self._write_collapsed(path, self._stacks)
+        with open(pstats_path, 'wb') as out:
+            marshal.dump(self._samples_as_pstats(), out)
+        # A frame's own samples are the ones where it's innermost; its total, where it's anywhere.
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self._stacks.iteritems():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        num_samples = sum(self._stacks.itervalues()) or 1
+        lines = [self._header(), "```", "  own%  total%  function"]
+        for frame, count in own.most_common(self.top):
+            lines.append("{:6.1f}  {:6.1f}  {}".format(
+                100.0 * count / num_samples, 100.0 * total[frame] / num_samples, frame))
+        lines.append("```")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _collapse(stats, max_depth=100):
+        """
+        Turn pstats' stats (func -> (cc, nc, tt, ct, callers)) in to collapsed stacks, with counts
+        in microseconds. A function's time on each stack it's on is its share of its caller's time
+        there, in proportion to what that caller called it for.
+        """
+        callees = collections.defaultdict(list)
+        for callee, (_, _, _, _, callers) in stats.iteritems():
+            for caller, (_, _, _, edge_time) in callers.iteritems():
+                callees[caller].append((callee, edge_time))
+        def name(func):
+            filename, _, funcname = func
+            return '{}:{}'.format(os.path.basename(filename), funcname)
+        stacks = collections.Counter()
+        def walk(func, path, share):
+            # share: how much of func's total time is on this path.
+            _, _, own_time, total_time, _ = stats[func]
+            if total_time * share < 1e-6:
+                return
+            stacks[';'.join(path)] += int(round(own_time * share * 1e6))
+            if len(path) >= max_depth:
+                return
+            for callee, edge_time in callees.get(func, ()):
+                callee_total = stats[callee][3]
+                if callee_total <= 0 or name(callee) in path:
+                    continue
+                walk(callee, path + [name(callee)], share * edge_time / callee_total)
+        for func, (_, _, _, _, callers) in stats.iteritems():
+            if not callers:
+                walk(func, [name(func)], 1.0)
+        return dict((stack, count) for stack, count in stacks.iteritems() if count > 0)
+
+    def _write_pstats(self, path, collapsed_path):
+        if not self._profiles:
+            for empty_path in (path, collapsed_path):
+                with open(empty_path, 'wb'):
+                    pass
+            return self._header() + "\nNo messages came in to profile."
+        stats = pstats.Stats(self._profiles[0])
+        for profile in self._profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+        self._write_collapsed(collapsed_path, self._collapse(stats.stats))
+        out = StringIO.StringIO()
+        stats.stream = out
+        stats.strip_dirs().sort_stats('cumulative').print_stats(self.top)
+        # Skip pstats' preamble; the table is what's worth reading in a DM.
+        table = out.getvalue()
+        table = table[table.find('   ncalls'):].rstrip() if '   ncalls' in table else table.strip()
+        return "\n".join((self._header(), "```", table, "```"))
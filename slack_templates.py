@@ -0,0 +1,113 @@
+# coding=utf-8
+
+import bisect
+import string
+
+class Template(object):
+    """
+    A str.format() style template that's parsed once, when it's made, instead of on every use.
+    Rendered text is cached by the values of its fields, so rendering the same thing again (the
+    help for a game state, in a channel, for our bot user) is a dict lookup.
+    """
+
+    # Don't let the cache grow without bound; start over past this many renderings.
+    MAX_CACHED = 1000
+
+    def __init__(self, text):
+        self.text = text
+        # (literal text, field name or None, format string for the field or None)
+        self._parts = []
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(text):
+            field_format = None
+            if field_name is not None and (format_spec or conversion):
+                field_format = u'{0' + (u'!' + conversion if conversion else u'') + (
+                    u':' + format_spec if format_spec else u'') + u'}'
+            self._parts.append((literal, field_name, field_format))
+        self.field_names = tuple(sorted(set(
+            field_name for _, field_name, _ in self._parts if field_name is not None)))
+        self._rendered = {}
+
+    def render(self, **fields):
+        "Return the text with these fields filled in."
+        key = tuple(fields[name] for name in self.field_names)
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            pieces = []
+            for literal, field_name, field_format in self._parts:
+                pieces.append(literal)
+                if field_name is None:
+                    continue
+                elif field_format is None:
+                    pieces.append(unicode(fields[field_name]))
+                else:
+                    pieces.append(field_format.format(fields[field_name]))
+            rendered = u''.join(pieces)
+            if len(self._rendered) >= self.MAX_CACHED:
+                self._rendered = {}
+            self._rendered[key] = rendered
+        return rendered
+
+    def __repr__(self):
+        return 'Template({})'.format(repr(self.text))
+
+class CardListRenderer(object):
+    """
+    Renders lists of cards as bullet lists. Each card's line is built once and reused. The lines
+    for a pile are kept, and when the pile changes (see CardPile.version) only the cards that came
+    or went are spliced in or out, rather than the whole list being sorted and built again.
+    """
+
+    LINE = Template(u' • `{name}`')
+
+    def __init__(self):
+        self._pile_texts = {}   # key -> _RenderedPile
+
+    def render(self, cards, sort=True):
+        "Return a bullet list of these cards, sorted by name unless sort is False."
+        if sort:
+            cards = sorted(cards)
+        line = self.LINE.render
+        return u"\n".join(line(name=card.name) for card in cards)
+
+    def render_pile(self, key, pile):
+        "Return a bullet list of the cards in this pile in sorted order, kept under key."
+        rendered = self._pile_texts.get(key)
+        if rendered is None or rendered.pile is not pile:
+            rendered = self._pile_texts[key] = _RenderedPile(pile, self.LINE.render)
+        elif rendered.version != pile.version:
+            rendered.update()
+        return rendered.text
+
+    def forget(self, key):
+        "Drop the list kept under key."
+        self._pile_texts.pop(key, None)
+
+class _RenderedPile(object):
+    "The cards of a pile in sorted order, each with its line, as of pile.version."
+
+    def __init__(self, pile, render_line):
+        self.pile = pile
+        self._render_line = render_line
+        self.version = pile.version
+        self._card_set = pile.peek()
+        self._cards = list(pile.peek_sorted())
+        self._lines = [render_line(name=card.name) for card in self._cards]
+        self.text = u"\n".join(self._lines)
+
+    def update(self):
+        "Splice in the cards that have come in to the pile since, and out the ones that have gone."
+        card_set = self.pile.peek()
+        for card in self._card_set - card_set:
+            index = bisect.bisect_left(self._cards, card)
+            # Cards with the same name sort together; find this one.
+            while self._cards[index] is not card:
+                index += 1
+            del self._cards[index]
+            del self._lines[index]
+        for card in card_set - self._card_set:
+            index = bisect.bisect_right(self._cards, card)
+            self._cards.insert(index, card)
+            self._lines.insert(index, self._render_line(name=card.name))
+        self._card_set = card_set
+        self.version = self.pile.version
+        self.text = u"\n".join(self._lines)
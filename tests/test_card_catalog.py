@@ -0,0 +1,56 @@
+import unittest
+
+from game_objects import Card, CardCatalog, CardDeck, CardPile, deck_dict
+
+class CardCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.deck = deck_dict['poker_deck'].copy().shuffle()
+        self.catalog = self.deck.catalog
+
+    def test_cards_are_slotted(self):
+        card = self.deck.peek(1)[0]
+        self.assertFalse(hasattr(card, '__dict__'))
+        self.assertRaises(AttributeError, setattr, card, 'colour', 'red')
+
+    def test_copies_share_cards(self):
+        copy = self.deck.copy().shuffle()
+        self.assertIs(copy.catalog, self.catalog)
+        by_name = dict((card.name, card) for card in self.deck.peek())
+        for card in copy.peek():
+            self.assertIs(by_name[card.name], card)
+
+    def test_ids(self):
+        cards = list(self.deck.peek(5))
+        card_ids = self.catalog.ids(cards)
+        self.assertEqual(self.catalog.cards(card_ids), cards)
+        self.assertEqual([self.catalog.card(card_id) for card_id in card_ids], cards)
+
+    def test_find_by_name(self):
+        self.assertEqual(self.catalog.card_named(u'  ace of SPADES ').name, u'Ace of Spades')
+        self.assertEqual(len(self.catalog.find(u'ace of spades')), 1)
+        self.assertEqual(self.catalog.find(u'the fool'), ())
+
+    def test_sorted_order(self):
+        in_order = [self.catalog.card_by_sort_rank(rank) for rank in range(len(self.catalog))]
+        self.assertEqual([card.name for card in in_order], sorted(card.name for card in self.deck.peek()))
+        for rank, card in enumerate(in_order):
+            self.assertEqual(self.catalog.sort_rank(card._id), rank)
+
+    def test_one_catalog_a_card(self):
+        cards = [Card(name=u'Red'), Card(name=u'Blue')]
+        catalog = CardCatalog(cards, u'Colours')
+        self.assertIs(CardCatalog.of(cards), catalog)
+        self.assertRaises(AssertionError, CardCatalog, cards[:1])
+        self.assertRaises(AssertionError, self.deck.insert, cards)
+
+    def test_indexed_pile(self):
+        pile = CardPile(name=u'Hand', indexed=True, catalog=self.catalog)
+        pile.add(self.deck.draw(10))
+        pile.pull(3, key_fn=lambda card: True)
+        pile.pull_named(pile.peek_sorted()[0].name)
+        self.assertEqual(len(pile), 6)
+        self.assertEqual(list(pile.peek_sorted()), sorted(pile.peek()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+
+from game_objects import deck_dict
+from slack_dicebot import GameRegistry, RegexCardGame, SlackInterface
+from slack_dispatch import ChannelDispatcher
+from slack_token import BOT_USER_NAME
+from tests.test_slack_directory import Endpoint, Event, ListsSlack
+
+class StallingSocket(object):
+    "Gives the events it was made with, then nothing more, ever, as a quiet workspace does."
+
+    def __init__(self, events):
+        self._events = events
+        self.stalled = threading.Event()
+
+    def events(self):
+        for event in self._events:
+            yield event
+        self.stalled.set()
+        threading.Event().wait()
+
+def interface(events, **kwargs):
+    "A SlackInterface with two channels (C1, C2) and two users (U1, U2), reading events from a StallingSocket."
+    slack = ListsSlack({'U1':'alice', 'U2':'bob'}, {'C1':'general', 'C2':'random'}, {})
+    slack.posts = []
+    slack.chat = Endpoint(post_message=lambda channel, text, as_user=True: slack.posts.append((channel, text)))
+    registry = GameRegistry(lambda: RegexCardGame(deck=deck_dict['major_arcana'].copy()))
+    return SlackInterface(registry, slack=slack, socket=StallingSocket(events), num_senders=0, **kwargs)
+
+def said(text, chan_id='C1', user_id='U1'):
+    return Event('message', user=user_id, channel=chan_id, text=u'@{} {}'.format(BOT_USER_NAME, text))
+
+class ChannelDispatcherTest(unittest.TestCase):
+
+    def test_each_lane_in_order(self):
+        dispatcher = ChannelDispatcher(4)
+        done = []
+        def job(key, i):
+            time.sleep(0.001 * (i % 3))
+            done.append((key, i))
+        for i in range(20):
+            for key in ('a', 'b', 'c'):
+                dispatcher.submit(key, lambda key=key, i=i: job(key, i))
+        dispatcher.stop()
+        for key in ('a', 'b', 'c'):
+            self.assertEqual([i for done_key, i in done if done_key == key], range(20))
+        self.assertEqual(len(dispatcher), 0)
+
+    def test_slow_lane_holds_up_only_itself(self):
+        dispatcher = ChannelDispatcher(2)
+        slow = threading.Event()
+        done = []
+        dispatcher.submit('slow', lambda: slow.wait(5) and done.append('slow 1'))
+        dispatcher.submit('slow', lambda: done.append('slow 2'))
+        for i in range(5):
+            dispatcher.submit('fast', lambda i=i: done.append('fast {}'.format(i)))
+        deadline = time.time() + 5
+        while len(done) < 5 and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(done, ['fast {}'.format(i) for i in range(5)])
+        slow.set()
+        dispatcher.stop()
+        self.assertEqual(done[5:], ['slow 1', 'slow 2'])
+
+    def test_stop_waits_for_queued_jobs(self):
+        dispatcher = ChannelDispatcher(2)
+        done = []
+        for i in range(10):
+            dispatcher.submit(i % 2, lambda i=i: time.sleep(0.002) or done.append(i))
+        dispatcher.stop()
+        self.assertEqual(sorted(done), range(10))
+        self.assertFalse(any(worker.is_alive() for worker in dispatcher._workers))
+
+    def test_exit_stops_without_waiting(self):
+        dispatcher = ChannelDispatcher(1)
+        done = []
+        def quit():
+            raise SystemExit
+        dispatcher.submit('a', quit)
+        for i in range(100):
+            dispatcher.submit('a', lambda: time.sleep(0.01) or done.append(i))
+        dispatcher.stop()
+        self.assertTrue(dispatcher.exit_requested)
+        self.assertLess(len(done), 100)
+
+class ListenConcurrentlyTest(unittest.TestCase):
+
+    def test_quit_stops_listening_without_another_message(self):
+        si = interface([said(u'wake'), said(u'quit', 'C2')])
+        start = time.time()
+        self.assertRaises(SystemExit, si.listen_concurrently, 2)
+        self.assertTrue(si.socket.stalled.is_set())
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual([channel for channel, _ in si.slack.posts], ['C1'])
+
+if __name__ == '__main__':
+    unittest.main()
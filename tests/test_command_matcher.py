@@ -0,0 +1,59 @@
+import itertools
+import random
+import unittest
+
+from slack_dicebot import CommandMatcher, RegexCardGame, required_literals, re_comp
+from slack_token import BOT_USER_NAME
+
+def search_in_turn(regex_method_pairs, text):
+    "What RegexResponder did before CommandMatcher: search with each regex in turn."
+    for regex_obj, method_name in regex_method_pairs:
+        match_obj = regex_obj.search(text)
+        if match_obj:
+            return method_name, match_obj
+    return None, None
+
+class CommandMatcherTest(unittest.TestCase):
+
+    PREFIXES = (u'@{} ', u'@{}: ', u'@{}  ', u'hey @{} ', u'@{}', u'', u'{} ', u'@{}\n')
+    COMMANDS = (
+        u'roll 4d6kh3', u'stats 3d6 &gt;= 10', u'wake up', u'quit', u'sleep', u'go to sleep', u'help',
+        u'join', u'leave', u'list', u'begin game', u'begin  game', u'check hand', u'check hand @bob',
+        u'examine card The Tower', u'where is Ace of Spades', u'return card The Moon',
+        u'discard hand', u'shuffle', u'check deck', u'check deck 3', u'deal 2 to @bob',
+        u'deal 2 to me', u'odds 2 aces in 5', u'what are the odds of drawing a king in 3',
+        u'DEAL 3 TO @Bob', u'Where Is the fool', u'huh', u'', u'roll', u'deal two to me',
+        u'lunch, anyone?', u'wakeful', u'I\'ll check hand later')
+
+    def texts(self):
+        for prefix, command in itertools.product(self.PREFIXES, self.COMMANDS):
+            yield prefix.format(BOT_USER_NAME) + command
+        # And some noise made of the same words, in any order.
+        words = u' '.join(self.COMMANDS).split() + [u'@' + BOT_USER_NAME, u'@' + BOT_USER_NAME.upper()]
+        rng = random.Random(1)
+        for _ in range(5000):
+            yield u' '.join(rng.choice(words) for _ in range(rng.randint(1, 8)))
+
+    def test_same_handler_and_groups_as_searching_in_turn(self):
+        for state, regex_method_pairs in RegexCardGame.REGEX_METHOD_BY_STATE.iteritems():
+            matcher = CommandMatcher(regex_method_pairs)
+            for text in self.texts():
+                expected_method, expected_match = search_in_turn(regex_method_pairs, text)
+                method_name, match_obj = matcher.match(text)
+                self.assertEqual(method_name, expected_method, (state, text))
+                if expected_match:
+                    self.assertEqual(match_obj.groupdict(), expected_match.groupdict(), (state, text))
+
+    def test_required_literals(self):
+        self.assertEqual(
+            required_literals(re_comp(r'{BOT_USER_ID}\s+check\s+hand\s*(?P<player_name>@?[\w.]*)')),
+            (u'@' + BOT_USER_NAME, u'check', u'hand'))
+        # Nothing inside an optional group is required.
+        self.assertEqual(required_literals(re_comp(r'(?:what\s+)?odds')), (u'odds',))
+
+    def test_no_match(self):
+        matcher = CommandMatcher(RegexCardGame.REGEX_METHOD_BY_STATE[RegexCardGame.ACTIVE_GAME])
+        self.assertEqual(matcher.match(u'lunch, anyone?'), (None, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import logging
+import unittest
+
+from game_objects import Card, CardDeck, DeckRegistry
+
+class DeckRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.built = []
+        self.loaded = []
+        self.registry = DeckRegistry(builders={'red':self.builder('red')}, sources=[self.source])
+
+    def builder(self, name):
+        def build():
+            self.built.append(name)
+            return CardDeck([Card(name=name.title())], name=name)
+        return build
+
+    def source(self):
+        self.loaded.append('private')
+        return {'secret':CardDeck([Card(name=u'Secret')], name='secret')}
+
+    def test_built_on_first_use(self):
+        self.assertEqual(self.built, [])
+        deck = self.registry['red']
+        self.assertIs(self.registry['red'], deck)
+        self.assertEqual(self.built, ['red'])
+        # A built-in deck doesn't need the sources.
+        self.assertEqual(self.loaded, [])
+
+    def test_sources_loaded_for_unknown_names(self):
+        self.assertIn('red', self.registry)
+        self.assertEqual(self.loaded, [])
+        self.assertEqual(self.registry['secret'].name, 'secret')
+        self.assertEqual(self.loaded, ['private'])
+        self.assertIsNone(self.registry.get('blue'))
+        self.assertRaises(KeyError, lambda: self.registry['blue'])
+        self.assertEqual(self.loaded, ['private'])
+
+    def test_names_build_nothing(self):
+        self.registry.register('blue', self.builder('blue'))
+        self.assertEqual(self.registry.keys(), ['blue', 'red', 'secret'])
+        self.assertEqual(len(self.registry), 3)
+        self.assertEqual(self.built, [])
+
+    def test_failing_source_is_tried_again(self):
+        failures = [ImportError("No module named private_game_data")]
+        def flaky():
+            if failures:
+                raise failures.pop()
+            return self.source()
+        registry = DeckRegistry(builders={'red':self.builder('red')}, sources=[flaky])
+        logging.disable(logging.ERROR)
+        try:
+            self.assertIsNone(registry.get('secret'))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.loaded, [])
+        # The next lookup loads it.
+        self.assertEqual(registry.get('secret').name, 'secret')
+        self.assertEqual(registry.keys(), ['red', 'secret'])
+
+    def test_failing_source_raises_from_lookups(self):
+        def broken():
+            raise ImportError("No module named private_game_data")
+        registry = DeckRegistry(builders={'red':self.builder('red')}, sources=[broken])
+        self.assertEqual(registry['red'].name, 'red')
+        self.assertRaises(ImportError, lambda: registry['secret'])
+        self.assertRaises(ImportError, lambda: registry['secret'])
+
+    def test_register_replaces(self):
+        self.registry['red']
+        self.registry.register('red', self.builder('crimson'))
+        self.assertEqual(self.registry['red'].name, 'crimson')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import random
+import unittest
+
+import dice
+
+class KeptTest(unittest.TestCase):
+
+    ROW = [1, 5, 3, 6, 2]
+
+    def test_keep_some(self):
+        self.assertEqual(sorted(dice.Dice(5, 6, keep=('kh', 2))._kept(self.ROW)), [5, 6])
+        self.assertEqual(sorted(dice.Dice(5, 6, keep=('kl', 2))._kept(self.ROW)), [1, 2])
+
+    def test_keep_all_or_none(self):
+        self.assertIs(dice.Dice(5, 6, keep=('kh', 5))._kept(self.ROW), self.ROW)
+        self.assertIs(dice.Dice(5, 6, keep=('kl', 9))._kept(self.ROW), self.ROW)
+        self.assertEqual(dice.Dice(5, 6, keep=('kh', 0))._kept(self.ROW), [])
+
+    def test_drop_none(self):
+        self.assertEqual(str(dice.parse(u'1000d6dl0').root), '1000d6kh1000')
+        total, detail = dice.parse(u'1000d6dl0').roll()[0]
+        self.assertTrue(1000 <= total <= 6000)
+
+class ExplodeTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+
+    def test_explode(self):
+        for total, detail in dice.parse(u'20x 10d6!').roll():
+            rolled = [int(value) for value in detail.split('[')[1].rstrip(']').split(', ')]
+            self.assertEqual(total, sum(rolled))
+            self.assertEqual(len(rolled), 10 + sum(1 for value in rolled if value == 6))
+
+    def test_no_dice_left_to_explode_into(self):
+        self.assertRaises(dice.DiceError, dice.roll, u'{}d2!'.format(dice.MAX_DICE))
+
+    def test_one_budget_for_the_message(self):
+        # Every roll and every term draws on the same budget, however the dice are split up.
+        self.assertRaises(dice.DiceError, dice.roll, u'20x {}d2!'.format(dice.MAX_DICE // 20))
+        self.assertRaises(dice.DiceError, dice.roll, u'{0}d2!+{0}d2'.format(dice.MAX_DICE // 2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# coding=utf-8
+
+import collections
+import itertools
+import threading
+import unittest
+
+import dice
+import dice_stats
+from numpy_support import HAVE_NUMPY
+
+def enumerate_totals(dice_list, combine=sum):
+    """
+    The chance of each total of rolling every pool in dice_list ((count, sides, keep), where keep
+    is None or ('kh'|'kl', n)), by going through every way the dice can come up. combine makes the
+    total out of each pool's.
+    """
+    rolls = [list(itertools.product(range(1, sides + 1), repeat=count)) for count, sides, _ in dice_list]
+    chances = collections.Counter()
+    for faces in itertools.product(*rolls):
+        values = []
+        for (count, sides, keep), row in zip(dice_list, faces):
+            if keep:
+                how, num_kept = keep
+                row = sorted(row, reverse=(how == 'kh'))[:num_kept]
+            values.append(sum(row))
+        chances[combine(values)] += 1
+    total = float(sum(chances.values()))
+    return dict((value, count / total) for value, count in chances.items())
+
+@unittest.skipUnless(HAVE_NUMPY, "dice_stats needs NumPy")
+class DistributionTest(unittest.TestCase):
+
+    def assertDistribution(self, text, chances):
+        low, pmf = dice_stats.distribution(dice.parse(text).root)
+        self.assertAlmostEqual(pmf.sum(), 1.0, places=9)
+        for offset, chance in enumerate(pmf):
+            self.assertAlmostEqual(chance, chances.get(low + offset, 0.0), places=9, msg=(text, low + offset))
+        self.assertTrue(all(low <= value < low + len(pmf) for value in chances), text)
+
+    def test_pools(self):
+        for text, count, sides in (('3d6', 3, 6), ('1d20', 1, 20), ('5d4', 5, 4)):
+            self.assertDistribution(text, enumerate_totals([(count, sides, None)]))
+
+    def test_keep(self):
+        for text, count, sides, keep in (
+                ('4d6kh3', 4, 6, ('kh', 3)), ('4d6kl2', 4, 6, ('kl', 2)), ('5d4kh1', 5, 4, ('kh', 1)),
+                ('2d20kl1', 2, 20, ('kl', 1)), ('4d6dl1', 4, 6, ('kh', 3)), ('3d8dh2', 3, 8, ('kl', 1)),
+                ('3d6kh3', 3, 6, None), ('5d3kh4', 5, 3, ('kh', 4))):
+            self.assertDistribution(text, enumerate_totals([(count, sides, keep)]))
+
+    def test_arithmetic(self):
+        self.assertDistribution('2d6-1d6*2', enumerate_totals(
+            [(2, 6, None), (1, 6, None)], lambda (a, b): a - 2 * b))
+        self.assertDistribution('1d6*1d4+3', enumerate_totals(
+            [(1, 6, None), (1, 4, None)], lambda (a, b): a * b + 3))
+        self.assertDistribution('4d6kh3+2d4kl1', enumerate_totals([(4, 6, ('kh', 3)), (2, 4, ('kl', 1))]))
+
+    def test_big_pools_by_fft(self):
+        # Past FFT_SIZE values convolutions go by FFT; the moments still come out as they should.
+        result = dice_stats.stats(dice.parse('1000d6'))
+        self.assertEqual((result.low, result.high), (1000, 6000))
+        self.assertAlmostEqual(result.mean, 3500, places=6)
+        self.assertAlmostEqual(result.stdev, (1000 * 35 / 12.0) ** 0.5, places=6)
+
+    def test_exploding(self):
+        # A d6! averages 3.5 a roll over 6/5 rolls.
+        self.assertAlmostEqual(dice_stats.stats(dice.parse('1d6!')).mean, 3.5 * 6 / 5, places=9)
+
+    def test_at_least(self):
+        result = dice_stats.stats(dice.parse('2d6'))
+        self.assertAlmostEqual(result.at_least(7), 21 / 36.0)
+        self.assertEqual(result.at_least(2), 1.0)
+        self.assertEqual(result.at_least(13), 0.0)
+        self.assertEqual(dict(result.percentiles)[50], 7)
+
+    def test_describe(self):
+        text = dice_stats.describe(u'4d6kh3 &gt;= 15')
+        self.assertTrue(text.startswith(u'`4d6kh3`: mean *12.24*, σ 2.85, from 3 to 18'), text)
+        self.assertIn(u'P(≥ 15) = *23.15%*', text)
+
+    def test_too_much_work(self):
+        self.assertRaises(dice.DiceError, dice_stats.describe, u'100d1000kh50')
+        self.assertRaises(dice.DiceError, dice_stats.describe, u'1000000d1000')
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_drops_least_recently_used(self):
+        cache = dice_stats.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        self.assertEqual(len(cache), 2)
+
+    def test_shared_between_threads(self):
+        cache = dice_stats.LRUCache(8)
+        errors = []
+        def hammer(offset):
+            try:
+                for i in range(20000):
+                    key = (i * 7 + offset) % 12
+                    if cache.get(key) is None:
+                        cache.put(key, key)
+            except Exception, err:
+                errors.append(err)
+        threads = [threading.Thread(target=hammer, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cache), 8)
+        self.assertEqual(len(list(cache._items)), 8)
+
+if __name__ == '__main__':
+    unittest.main()
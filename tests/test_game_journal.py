@@ -0,0 +1,50 @@
+import unittest
+
+from game_objects import deck_dict
+from slack_dicebot import RegexCardGame
+from slack_objects import Message
+from slack_token import BOT_USER_NAME
+
+def say(game, text, user_id='U1', user_name='alice', im=False):
+    responses = game.respond_to_message(Message(
+        text=u'@{} {}'.format(BOT_USER_NAME, text), user_id=user_id, user_name=user_name,
+        chan_id='D1' if im else 'C1', chan_name='general', im=im))
+    if responses is None:
+        return []
+    if not isinstance(responses, (list, tuple)):
+        responses = [responses]
+    return [response.text for response in responses]
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.game = RegexCardGame(deck=deck_dict['major_arcana'].copy())
+        say(self.game, u'wake')
+        say(self.game, u'join')
+        say(self.game, u'join', user_id='U2', user_name='bob')
+        say(self.game, u'begin game')
+        say(self.game, u'shuffle')
+        say(self.game, u'deal 3 to @alice')
+
+    def replayed(self):
+        game = RegexCardGame(deck=deck_dict['major_arcana'].copy())
+        game.replay('snapshot', self.game.get_state())
+        return game
+
+    def test_round_trip(self):
+        self.assertEqual(self.replayed().get_state(), self.game.get_state())
+
+    def test_where_is_a_card_in_a_hand(self):
+        card = self.game.get_state()['state']['hands']['U1'][0]
+        game = self.replayed()
+        self.assertEqual(say(game, u'where is {}'.format(card), im=True),
+                         [u"`{}` is in alice's hand.".format(card)])
+        self.assertNotIn(u"I couldn't find", say(game, u'examine card {}'.format(card))[0])
+
+    def test_where_is_a_card_in_the_deck(self):
+        card = self.game.get_state()['state']['deck'][0]
+        self.assertEqual(say(self.replayed(), u'where is {}'.format(card)),
+                         [u"`{}` is in the deck.".format(card)])
+
+if __name__ == '__main__':
+    unittest.main()
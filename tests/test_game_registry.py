@@ -0,0 +1,108 @@
+import unittest
+
+from game_objects import deck_dict
+from slack_dicebot import GameRegistry, RegexCardGame
+from slack_objects import Message
+from slack_token import BOT_USER_NAME
+
+def message(chan_id, text, user_id='U1'):
+    return Message(text=u'@{} {}'.format(BOT_USER_NAME, text), user_id=user_id, user_name=user_id,
+                   chan_id=chan_id, chan_name=chan_id, im=False)
+
+def im(text, user_id='U1'):
+    return Message(text=text, user_id=user_id, user_name=user_id,
+                   chan_id='D' + user_id, chan_name=None, im=True)
+
+def texts(responses):
+    if not isinstance(responses, (list, tuple, set)):
+        responses = [responses]
+    return [response.text for response in responses]
+
+class GameRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = GameRegistry(lambda: RegexCardGame(deck=deck_dict['major_arcana'].copy()))
+
+    def say(self, msg):
+        return self.registry.respond_to_message(msg)
+
+    def players(self, chan_id):
+        "Who the game in chan_id lists as playing."
+        [text] = texts(self.say(message(chan_id, u'list')))
+        return [user_name for user_name in (u'u1', u'u2', u'u3') if u'<@{}>'.format(user_name) in text]
+
+    def test_a_game_per_channel(self):
+        self.say(message('C1', u'wake'))
+        self.say(message('C2', u'wake', 'U2'))
+        self.say(message('C1', u'join'))
+        self.say(message('C2', u'join', 'U2'))
+        self.say(message('C2', u'join', 'U3'))
+        self.assertEqual(len(self.registry), 2)
+        self.assertEqual(self.players('C1'), [u'u1'])
+        self.assertEqual(self.players('C2'), [u'u2', u'u3'])
+
+        self.say(message('C1', u'go to sleep'))
+        self.assertNotIn('C1', self.registry)
+        self.assertIn('C2', self.registry)
+        self.assertEqual(self.players('C2'), [u'u2', u'u3'])
+
+    def test_channels_without_a_game_keep_none(self):
+        self.say(message('C1', u'roll 2d1'))
+        self.assertEqual(len(self.registry), 0)
+
+    def test_ims_go_to_the_last_channel(self):
+        self.say(message('C1', u'wake'))
+        self.say(message('C1', u'join'))
+        self.say(message('C2', u'wake'))
+        self.assertEqual(self.registry.route_key(im(u'list')), 'C2')
+        self.say(message('C1', u'list'))
+        self.assertEqual(self.registry.route_key(im(u'list')), 'C1')
+        self.assertIn(u'<@u1>', texts(self.say(im(u'list')))[0])
+        # Someone who's never talked in a channel just gets their IM channel's (sleeping) game.
+        self.assertEqual(self.registry.route_key(im(u'list', 'U9')), 'DU9')
+
+    def test_routes_go_when_the_game_does(self):
+        self.say(message('C1', u'wake'))
+        self.say(message('C1', u'join', 'U2'))
+        self.say(message('C2', u'wake', 'U3'))
+        self.say(message('C1', u'sleep'))
+        for user_id in ('U1', 'U2'):
+            self.assertEqual(self.registry.route_key(im(u'list', user_id)), 'D' + user_id)
+        self.assertEqual(self.registry.route_key(im(u'list', 'U3')), 'C2')
+        self.assertEqual(self.registry._user_id_to_game_chan_id, {'U3':'C2'})
+        self.assertEqual(self.registry._chan_id_to_user_ids, {'C2':set(['U3'])})
+
+    def test_moving_channels(self):
+        self.say(message('C1', u'wake'))
+        self.say(message('C2', u'wake'))
+        self.say(message('C1', u'sleep', 'U2'))
+        # U1 went on to C2, so C1 going to sleep doesn't change where their IMs go.
+        self.assertEqual(self.registry.route_key(im(u'list')), 'C2')
+        self.say(message('C2', u'sleep'))
+        self.assertEqual((self.registry._user_id_to_game_chan_id, self.registry._chan_id_to_user_ids), ({}, {}))
+
+class CardLookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = GameRegistry(lambda: RegexCardGame(deck=deck_dict['major_arcana'].copy()))
+        self.registry.respond_to_message(message('C1', u'wake'))
+        self.registry.respond_to_message(message('C1', u'join'))
+        self.registry.respond_to_message(message('C1', u'begin game'))
+
+    def both(self, card_name):
+        "What examine card and where is say about card_name."
+        return [texts(self.registry.respond_to_message(message('C1', u'{} {}'.format(command, card_name))))
+                for command in (u'examine card', u'where is')]
+
+    def test_same_errors_from_both(self):
+        for card_name, error in ((u'', u"This command requires a card name to function."),
+                                 (u'nope', u"I couldn't find that card. May not be in the game; did you typo?")):
+            self.assertEqual(self.both(card_name), [[error], [error]])
+
+    def test_found(self):
+        examined, located = self.both(u'the fool')
+        self.assertEqual(examined, [u"The card `the fool` has no details."])
+        self.assertEqual(located, [u"`The Fool` is in the deck."])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import itertools
+import unittest
+
+from game_objects import deck_dict
+from slack_dicebot import MethodCardGame, MethodResponder, guard_handler, require_words
+from slack_objects import Message, Response
+
+def call_in_turn(responder, msg):
+    "What MethodResponder did before HandlerIndex: call each (wrapped) handler in turn."
+    for method_name in responder.METHOD_LIST_BY_STATE[responder.state]:
+        response = getattr(responder, method_name)(msg)
+        if isinstance(response, (tuple, set, list)):
+            return response
+        elif isinstance(response, Response):
+            return [response]
+
+def players_only(self, msg):
+    return msg.user_id in self.players or None
+
+def no_ims(self, msg):
+    if msg.im:
+        return Response(text='not in IMs', im=msg.user_id)
+    return True
+
+class ToyResponder(MethodResponder):
+    "Handlers with every mix of words and guards, some of which decline even when they run."
+
+    METHOD_LIST_BY_STATE = {0:(
+        '_apple_banana', '_players_apple', '_decline_apple', '_no_ims_banana', '_banana',
+        '_players_no_ims', '_cherry', '_anything')}
+
+    def __init__(self):
+        MethodResponder.__init__(self)
+        self.state = 0
+        self.players = set(['U1'])
+
+    def _answer(name):
+        def handler(self, msg):
+            return Response(text=name, chan_id=msg.chan_id)
+        handler.__name__ = name
+        return handler
+
+    _apple_banana = require_words(_answer('_apple_banana'), ['apple', 'banana'])
+    _players_apple = guard_handler(require_words(_answer('_players_apple'), ['apple']), players_only)
+    _decline_apple = require_words(lambda self, msg: None, ['apple'])
+    _no_ims_banana = require_words(guard_handler(_answer('_no_ims_banana'), no_ims), ['banana'])
+    _banana = require_words(_answer('_banana'), ['banana'])
+    _players_no_ims = guard_handler(guard_handler(_answer('_players_no_ims'), no_ims), players_only)
+    _cherry = require_words(_answer('_cherry'), ['cherry'])
+
+    def _anything(self, msg):
+        if 'nothing' not in msg.token_set:
+            return [Response(text='_anything', chan_id=msg.chan_id)]
+
+def summary(responses):
+    if responses is None:
+        return None
+    return [(response.text, response.chan_id, response.im) for response in responses]
+
+class HandlerIndexTest(unittest.TestCase):
+
+    WORDS = ('apple', 'banana', 'cherry', 'nothing', 'other')
+
+    def messages(self):
+        for num_words in range(len(self.WORDS) + 1):
+            for words in itertools.permutations(self.WORDS, num_words):
+                for user_id, im in itertools.product(('U1', 'U2'), (False, True)):
+                    yield Message(text=u' '.join(words), user_id=user_id, user_name='someone',
+                                  chan_id='D1' if im else 'C1', chan_name='general', im=im)
+
+    def test_same_handler_as_calling_in_turn(self):
+        responder = ToyResponder()
+        for msg in self.messages():
+            self.assertEqual(summary(responder.respond_to_message(msg)),
+                             summary(call_in_turn(responder, msg)), msg.text)
+
+    def test_candidates(self):
+        index = ToyResponder()._HANDLER_INDEX_BY_STATE[0]
+        names = lambda words: [name for name, _, _ in index.candidates(frozenset(words))]
+        self.assertEqual(names(['banana', 'apple']), [
+            '_apple_banana', '_players_apple', '_decline_apple', '_no_ims_banana', '_banana',
+            '_players_no_ims', '_anything'])
+        # A guard outside the word check has to run whatever the words are.
+        self.assertEqual(names(['other']), ['_players_apple', '_players_no_ims', '_anything'])
+        # A handler's guards come unwrapped, outermost first.
+        [(_, _, guards)] = [entry for entry in index.candidates(frozenset()) if entry[0] == '_players_no_ims']
+        self.assertEqual(guards, (players_only, no_ims))
+
+    def test_card_game(self):
+        texts = (u'wake', u'wake up', u'sleep', u'go to sleep', u'roll 3d1', u'stats 2d1', u'hello', u'roll')
+        for state, text, im in itertools.product(
+                (MethodCardGame.ASLEEP, MethodCardGame.ACCEPTING_PLAYERS, MethodCardGame.ACTIVE_GAME),
+                texts, (False, True)):
+            responses = []
+            for respond in (MethodCardGame.respond_to_message, call_in_turn):
+                game = MethodCardGame(deck=deck_dict['major_arcana'].copy())
+                game.state = state
+                msg = Message(text=text, user_id='U1', user_name='alice',
+                              chan_id='D1' if im else 'C1', chan_name='general', im=im)
+                responses.append((summary(respond(game, msg)), game.state))
+            self.assertEqual(responses[0], responses[1], (state, text, im))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import urllib2
+import unittest
+
+import slack_metrics
+
+class ExpositionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = slack_metrics.MetricsRegistry()
+
+    def test_labelled_histogram(self):
+        histogram = self.registry.histogram(
+            'handle_seconds', 'Time to handle a message.', ['command'], buckets=(0.1, 0.5, 1))
+        histogram.observe(0.05, 'roll')
+        histogram.observe(0.5, 'roll')
+        histogram.observe(2, 'roll')
+        histogram.observe(0.25, 'say "hi"\\')
+        self.assertEqual(histogram.count('roll'), 3)
+        self.assertEqual(self.registry.expose(), u'\n'.join([
+            u'# HELP handle_seconds Time to handle a message.',
+            u'# TYPE handle_seconds histogram',
+            u'handle_seconds_bucket{command="roll",le="0.1"} 1',
+            u'handle_seconds_bucket{command="roll",le="0.5"} 2',
+            u'handle_seconds_bucket{command="roll",le="1"} 2',
+            u'handle_seconds_bucket{command="roll",le="+Inf"} 3',
+            u'handle_seconds_sum{command="roll"} 2.55',
+            u'handle_seconds_count{command="roll"} 3',
+            u'handle_seconds_bucket{command="say \\"hi\\"\\\\",le="0.1"} 0',
+            u'handle_seconds_bucket{command="say \\"hi\\"\\\\",le="0.5"} 1',
+            u'handle_seconds_bucket{command="say \\"hi\\"\\\\",le="1"} 1',
+            u'handle_seconds_bucket{command="say \\"hi\\"\\\\",le="+Inf"} 1',
+            u'handle_seconds_sum{command="say \\"hi\\"\\\\"} 0.25',
+            u'handle_seconds_count{command="say \\"hi\\"\\\\"} 1',
+        ]) + u'\n')
+
+    def test_counter_and_gauge(self):
+        self.registry.counter('messages_total', 'Messages seen.', ['kind']).inc('im')
+        self.registry.gauge('queued', 'Posts waiting.').add(3)
+        self.assertEqual(self.registry.expose(), u'\n'.join([
+            u'# HELP messages_total Messages seen.',
+            u'# TYPE messages_total counter',
+            u'messages_total{kind="im"} 1',
+            u'# HELP queued Posts waiting.',
+            u'# TYPE queued gauge',
+            u'queued 3',
+        ]) + u'\n')
+
+    def test_registered_once(self):
+        counter = self.registry.counter('messages_total', 'Messages seen.', ['kind'])
+        self.assertIs(self.registry.counter('messages_total', 'Messages seen.', ['kind']), counter)
+        self.assertRaises(AssertionError, self.registry.histogram, 'messages_total', 'Oops.', ['kind'])
+
+    def test_served(self):
+        self.registry.counter('messages_total', 'Messages seen.').inc()
+        server = slack_metrics.MetricsServer(0, registry=self.registry)
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+            self.assertEqual(urllib2.urlopen(url).read().decode('utf-8'), self.registry.expose())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import itertools
+import unittest
+
+import odds
+
+def brute_force(pool, wants, draws):
+    "The chance draw_odds works out, by looking at every hand of draws cards there could be."
+    hits = hands = 0
+    for hand in itertools.combinations(pool, min(draws, len(pool))):
+        hands += 1
+        hits += all(len(set(cards) & set(hand)) >= at_least for cards, at_least in wants)
+    return float(hits) / hands
+
+class DrawOddsTest(unittest.TestCase):
+
+    POOL = range(10)
+
+    def assertExact(self, wants, draws):
+        result = odds.draw_odds(self.POOL, wants, draws)
+        self.assertTrue(result.exact)
+        self.assertAlmostEqual(result.probability, brute_force(self.POOL, wants, draws), places=12)
+
+    def test_one_want(self):
+        for draws in range(11):
+            self.assertExact([([0, 1, 2], 2)], draws)
+
+    def test_disjoint_wants(self):
+        for draws in range(11):
+            self.assertExact([([0, 1, 2], 2), ([3, 4], 1), ([5], 1)], draws)
+
+    def test_wants_of_none(self):
+        self.assertExact([([0, 1, 2], 2), ([2, 3], 0)], 4)
+
+    def test_drawing_everything(self):
+        self.assertEqual(odds.draw_odds(self.POOL, [([0, 1], 1), ([1, 2], 2)], 12), (1.0, True, 0))
+        self.assertEqual(odds.draw_odds(self.POOL, [([0, 1], 3)], 12), (0.0, True, 0))
+
+    def test_overlapping_wants_are_simulated(self):
+        wants = [([0, 1, 2], 2), ([2, 3], 1)]
+        result = odds.draw_odds(self.POOL, wants, 4, trials=20000)
+        self.assertFalse(result.exact)
+        self.assertLess(abs(result.probability - brute_force(self.POOL, wants, 4)), 5 * result.error)
+
+    def test_huge_pools(self):
+        # Far too many hands to count in a float.
+        self.assertAlmostEqual(odds.hypergeometric_at_least(5200, 400, 200, 10), 0.9517, places=4)
+
+if __name__ == '__main__':
+    unittest.main()
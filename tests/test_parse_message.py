@@ -0,0 +1,120 @@
+import itertools
+import unittest
+
+import slack_objects
+from game_objects import deck_dict
+from slack_dicebot import GameRegistry, RegexCardGame, SlackInterface
+from slack_objects import Message, Response
+from slack_token import BOT_USER_ID, BOT_USER_NAME
+from tests.test_slack_directory import Event, ListsSlack
+
+def interface():
+    "A SlackInterface over a workspace with a channel, an IM with alice, and the bot."
+    slack = ListsSlack({'U1':'alice', 'U2':'bob', BOT_USER_ID:BOT_USER_NAME}, {'C1':'general'}, {})
+    registry = GameRegistry(lambda: RegexCardGame(deck=deck_dict['major_arcana'].copy()))
+    si = SlackInterface(registry, slack=slack, socket=object(), num_senders=0)
+    si.directory._set_ims([{'id':'D1', 'user':'U1'}])
+    return si
+
+def parse_in_full(si, e):
+    "What _parse_message did before the raw-text prefilter: rewrite, tokenize, then look for us."
+    text = si.MENTION_RE.sub(si._replace_mention, e.event['text'])
+    tokenized = Message.TOKENIZER_RE.findall(text.lower())
+    chan_name, is_im = si._get_channel_name_and_type(e.event['channel'])
+    if '@{}'.format(BOT_USER_NAME) not in tokenized and not is_im:
+        return None
+    return text, tokenized
+
+TEXTS = (
+    u'@{name} deal 2 to @alice', u'<@{id}> wake up', u'hey <@{id}>', u'@{NAME} join', u'@{name}: list',
+    u'@{name}s are great', u'{name} join', u'mail me at bob@{name}.com', u'x@{name} join',
+    u'<@U1> and <@U2> went to lunch', u'nothing to see', u'`@{name}` in a quote', u'@{name}_bot hi',
+    u'<@U9> who?', u'<@{id}|{name}> hi', u'', u'@@{name} hi')
+
+def events():
+    for template, (channel, user) in itertools.product(TEXTS, (('C1', 'U2'), ('D1', 'U1'))):
+        text = template.format(name=BOT_USER_NAME, NAME=BOT_USER_NAME.upper(), id=BOT_USER_ID)
+        yield Event('message', user=user, channel=channel, text=text)
+
+class MessageTest(unittest.TestCase):
+
+    def test_lazy_tokens_match_eager(self):
+        for e in events():
+            text = e.event['text']
+            eager = Message.TOKENIZER_RE.findall(text.lower())
+            msg = Message(text=text, user_id='U1', chan_id='C1')
+            self.assertIsNone(msg._tokenized)
+            self.assertEqual(msg.tokenized, eager)
+            self.assertEqual(msg.token_set, frozenset(eager))
+            self.assertIs(msg.tokenized, msg.tokenized)
+
+    def test_given_tokens_are_kept(self):
+        msg = Message(text=u'a b', user_id='U1', chan_id='C1', tokenized=['c'])
+        self.assertEqual((msg.tokenized, msg.token_set), (['c'], frozenset(['c'])))
+
+    def test_validate(self):
+        Message(text=u'hi', user_id='U1', chan_id='C1').validate()
+        bad = Message(text=u'hi', user_id=None, chan_id='C1')
+        self.assertRaises(AssertionError, bad.validate)
+        slack_objects.VALIDATE = True
+        try:
+            self.assertRaises(AssertionError, Message, text=u'hi', user_id='U1', chan_id='C1', im='no')
+            self.assertRaises(AssertionError, Message, text=u'hi', user_id='U1', chan_id='C1', tokenized=[1])
+        finally:
+            slack_objects.VALIDATE = False
+
+class PrefilterTest(unittest.TestCase):
+
+    def test_same_messages_as_a_full_parse(self):
+        si = interface()
+        for e in events():
+            expected = parse_in_full(si, e)
+            msg = si._parse_message(e)
+            if expected is None:
+                self.assertIsNone(msg, e.event)
+            else:
+                self.assertIsNotNone(msg, e.event)
+                self.assertEqual((msg.text, msg.tokenized), expected)
+                self.assertEqual(msg.im, e.event['channel'] == 'D1')
+
+    def test_skips_our_own_messages(self):
+        si = interface()
+        self.assertIsNone(si._parse_message(Event('message', user=BOT_USER_ID, channel='D1', text=u'hi')))
+        self.assertIsNone(si._parse_message(Event('user_typing', user='U1', channel='D1')))
+
+class MentionTest(unittest.TestCase):
+
+    def test_rewrites_known_users(self):
+        si = interface()
+        msg = si._parse_message(Event('message', user='U1', channel='C1',
+                                      text=u'<@{}> deal 2 to <@U1>, <@U2> and <@U9>'.format(BOT_USER_ID)))
+        self.assertEqual(msg.text, u'@{} deal 2 to @alice, @bob and <@U9>'.format(BOT_USER_NAME))
+        self.assertEqual(msg.user_name, 'alice')
+
+    def test_same_as_replacing_each_user(self):
+        # What _parse_message did before the one-pass rewrite.
+        si = interface()
+        for e in events():
+            text = e.event['text']
+            for user_id, user_name in si.directory.user_id_to_user_name.iteritems():
+                text = text.replace(u'<@{}>'.format(user_id), u'@{}'.format(user_name))
+            self.assertEqual(si.MENTION_RE.sub(si._replace_mention, e.event['text']), text)
+
+class IMIndexTest(unittest.TestCase):
+
+    def test_im_channels_by_id(self):
+        si = interface()
+        self.assertEqual(si.directory.im_chan_id_to_user_id, {'D1':'U1'})
+        self.assertEqual(si._get_channel_name_and_type('D1'), (si.FAKE_PM_CHANNEL_NAME, True))
+        self.assertEqual(si._get_channel_name_and_type('C1'), ('general', False))
+
+    def test_new_im(self):
+        si = interface()
+        si.directory.handle_event(Event('im_created', user='U2', channel={'id':'D2'}))
+        self.assertEqual(si.directory.im_chan_id_to_user_id, {'D1':'U1', 'D2':'U2'})
+        msg = si._parse_message(Event('message', user='U2', channel='D2', text=u'check hand'))
+        self.assertTrue(msg.im)
+        self.assertEqual(si._get_response_channel(Response(text=u'hi', im='U2')), 'D2')
+
+if __name__ == '__main__':
+    unittest.main()
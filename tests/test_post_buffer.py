@@ -0,0 +1,101 @@
+import threading
+import time
+import unittest
+
+from game_objects import deck_dict
+from slack_dicebot import GameRegistry, RegexCardGame, SlackInterface
+from slack_dispatch import PostBuffer, coalesce_posts
+from slack_token import BOT_USER_NAME
+from tests.test_slack_directory import Endpoint, Event, ListsSlack
+
+class FakeSocket(object):
+    def __init__(self, events):
+        self._events = events
+
+    def events(self):
+        return iter(self._events)
+
+class CoalescePostsTest(unittest.TestCase):
+
+    def test_merges_each_channel_in_order(self):
+        posts = [('C1', u'a'), ('D1', u'b'), ('C1', u'c'), ('C2', u'd'), ('D1', u'e'), ('C1', u'f')]
+        self.assertEqual(coalesce_posts(posts), [('C1', u'a\nc\nf'), ('D1', u'b\ne'), ('C2', u'd')])
+
+    def test_splits_at_max_chars(self):
+        posts = [('C1', u'aaaa'), ('C1', u'bbbb'), ('C1', u'cccc'), ('C1', u'x' * 12), ('C1', u'dd')]
+        self.assertEqual(coalesce_posts(posts, max_chars=10), [
+            ('C1', u'aaaa\nbbbb'), ('C1', u'cccc'), ('C1', u'x' * 12), ('C1', u'dd')])
+        for _, text in coalesce_posts(posts, max_chars=10):
+            self.assertTrue(len(text) <= 10 or text == u'x' * 12)
+
+    def test_nothing(self):
+        self.assertEqual(coalesce_posts([]), [])
+
+class PostBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.posts = []
+        self.posted = threading.Event()
+
+    def post(self, channel, text):
+        self.posts.append((channel, text))
+        self.posted.set()
+
+    def test_merges_what_comes_in_within_the_window(self):
+        buf = PostBuffer(self.post, window=0.1)
+        buf.extend([('C1', u'one'), ('C2', u'two')])
+        buf.extend([('C1', u'three')])
+        self.assertEqual(self.posts, [])
+        self.assertTrue(self.posted.wait(2))
+        time.sleep(0.05)
+        self.assertEqual(self.posts, [('C1', u'one\nthree'), ('C2', u'two')])
+
+    def test_flush(self):
+        buf = PostBuffer(self.post, window=10, max_chars=8)
+        buf.extend([('C1', u'one'), ('C1', u'two'), ('C1', u'three')])
+        buf.flush()
+        self.assertEqual(self.posts, [('C1', u'one\ntwo'), ('C1', u'three')])
+        buf.flush()
+        self.assertEqual(len(self.posts), 2)
+
+    def test_keeps_order_across_flushes(self):
+        buf = PostBuffer(self.post, window=0.001)
+        for i in range(200):
+            buf.extend([('C1', unicode(i))])
+            if i % 7 == 0:
+                time.sleep(0.002)
+        buf.flush()
+        texts = [line for channel, text in self.posts for line in text.split(u'\n')]
+        self.assertEqual(texts, [unicode(i) for i in range(200)])
+
+    def test_failed_post_doesnt_stop_the_rest(self):
+        def post(channel, text):
+            if channel == 'C1':
+                raise StandardError, "channel_not_found"
+            self.post(channel, text)
+        buf = PostBuffer(post, window=10)
+        buf.extend([('C1', u'one'), ('C2', u'two')])
+        buf.flush()
+        self.assertEqual(self.posts, [('C2', u'two')])
+
+class SlackInterfaceCoalesceTest(unittest.TestCase):
+
+    def interface(self, **kwargs):
+        slack = ListsSlack({'U1':'alice', 'U2':'bob'}, {'C1':'general'}, {})
+        slack.posts = []
+        slack.chat = Endpoint(post_message=lambda channel, text, as_user=True: slack.posts.append((channel, text)))
+        events = [Event('message', user=user_id, channel='C1', text=u'@{} {}'.format(BOT_USER_NAME, text))
+                  for user_id, text in (('U1', u'wake'), ('U1', u'join'), ('U2', u'join'))]
+        registry = GameRegistry(lambda: RegexCardGame(deck=deck_dict['major_arcana'].copy()))
+        return SlackInterface(registry, slack=slack, socket=FakeSocket(events), num_senders=0, **kwargs)
+
+    def test_window_merges_responses_to_several_messages(self):
+        each = self.interface()
+        each.listen()
+        self.assertEqual([channel for channel, _ in each.slack.posts], ['C1'] * 3)
+        merged = self.interface(coalesce_window=10)
+        merged.listen()
+        self.assertEqual(merged.slack.posts, [('C1', u'\n'.join(text for _, text in each.slack.posts))])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import random
+import threading
+import time
+import unittest
+
+from slack_dispatch import POSTS, PostSender, TokenBucket, retry_after
+
+class RateLimited(Exception):
+    "Looks like the HTTPError slacker raises for a 429, as far as retry_after cares."
+
+    class _Response(object):
+        status_code = 429
+        def __init__(self, wait):
+            self.headers = {'Retry-After':str(wait)}
+
+    def __init__(self, wait):
+        Exception.__init__(self, '429 Client Error: Too Many Requests')
+        self.response = self._Response(wait)
+
+class FakeSlack(object):
+    "Records every post with when it was made. fail(channel, text) can say to raise instead."
+
+    def __init__(self, fail=lambda channel, text: None, delay=lambda: 0):
+        self.fail = fail
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.attempts = []
+        self.posts = []
+        self.sending = set()
+        self.overlaps = 0
+
+    def make_post(self):
+        return self.post
+
+    def post(self, channel, text):
+        with self.lock:
+            self.attempts.append((time.time(), channel, text))
+            if channel in self.sending:
+                self.overlaps += 1
+            self.sending.add(channel)
+        try:
+            time.sleep(self.delay())
+            err = self.fail(channel, text)
+            if err is not None:
+                raise err
+            with self.lock:
+                self.posts.append((time.time(), channel, text))
+        finally:
+            with self.lock:
+                self.sending.discard(channel)
+
+    def times(self, channel):
+        return [at for at, post_channel, _ in self.posts if post_channel == channel]
+
+class RetryAfterTest(unittest.TestCase):
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(RateLimited(7)), 7.0)
+        self.assertEqual(retry_after(StandardError('ratelimited')), 1.0)
+        self.assertIsNone(retry_after(StandardError('channel_not_found')))
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2.0, burst=3, at=100.0)
+        times = []
+        at = 100.0
+        for _ in range(5):
+            at = bucket.ready_at(at)
+            bucket.take(at)
+            times.append(at)
+        self.assertEqual(times, [100.0, 100.0, 100.0, 100.5, 101.0])
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=2.0, burst=3, at=100.0)
+        bucket.pause(110.0)
+        self.assertEqual(bucket.ready_at(100.0), 110.0)
+        bucket.take(110.0)
+        self.assertEqual(bucket.ready_at(110.0), 110.5)
+
+class PostSenderTest(unittest.TestCase):
+
+    def test_waits_for_retry_after(self):
+        failed = []
+        def fail(channel, text):
+            if not failed:
+                failed.append(text)
+                return RateLimited(0.3)
+        slack = FakeSlack(fail)
+        sender = PostSender(slack.make_post, num_workers=2, rate=100, burst=5)
+        sender.send('C1', u'one')
+        sender.send('C1', u'two')
+        sender.send('C2', u'other')
+        sender.stop(5)
+        self.assertEqual([text for _, channel, text in slack.posts if channel == 'C1'], [u'one', u'two'])
+        first_try = slack.attempts[0][0]
+        # The retry, and everything behind it, waited the Retry-After; the other channel didn't.
+        self.assertGreaterEqual(min(slack.times('C1')) - first_try, 0.3)
+        self.assertLess(slack.times('C2')[0] - first_try, 0.2)
+
+    def test_keeps_each_channels_order(self):
+        slack = FakeSlack(delay=lambda: random.random() * 0.005)
+        sender = PostSender(slack.make_post, num_workers=4, rate=1000, burst=10)
+        sent = dict((channel, [u'{} {}'.format(channel, i) for i in range(30)]) for channel in ('C1', 'C2', 'C3'))
+        for i in range(30):
+            for channel in sorted(sent):
+                sender.send(channel, sent[channel][i])
+        sender.stop(10)
+        self.assertEqual(slack.overlaps, 0)
+        for channel, texts in sent.iteritems():
+            self.assertEqual([text for _, post_channel, text in slack.posts if post_channel == channel], texts)
+
+    def test_paces_each_channel(self):
+        slack = FakeSlack()
+        sender = PostSender(slack.make_post, num_workers=2, rate=20, burst=2)
+        for i in range(6):
+            sender.send('C1', unicode(i))
+        sender.stop(5)
+        times = slack.times('C1')
+        self.assertEqual(len(times), 6)
+        # Two at once, then one every 1/20 of a second.
+        self.assertLess(times[1] - times[0], 0.03)
+        for earlier, later in zip(times[1:], times[2:]):
+            self.assertGreater(later - earlier, 0.04)
+        self.assertLess(times[-1] - times[0], 0.5)
+
+    def test_drops_posts_past_max_queued(self):
+        blocked = threading.Event()
+        slack = FakeSlack(delay=lambda: blocked.wait(5) and 0)
+        sender = PostSender(slack.make_post, num_workers=1, max_queued=2, queue_timeout=0.05, rate=1000)
+        dropped = POSTS.value('dropped')
+        self.assertTrue(sender.send('C1', u'one'))
+        self.assertTrue(sender.send('C2', u'two'))
+        self.assertFalse(sender.send('C3', u'three'))
+        self.assertEqual(POSTS.value('dropped'), dropped + 1)
+        self.assertEqual(len(sender), 2)
+        blocked.set()
+        sender.stop(5)
+        self.assertEqual(sorted(text for _, _, text in slack.posts), [u'one', u'two'])
+
+    def test_drops_posts_that_keep_failing(self):
+        slack = FakeSlack(lambda channel, text: StandardError('channel_not_found'))
+        sender = PostSender(slack.make_post, num_workers=1, max_failures=1)
+        dropped = POSTS.value('dropped')
+        sender.send('C1', u'one')
+        self.assertTrue(sender.drain(5))
+        sender.stop()
+        self.assertEqual((len(slack.attempts), slack.posts), (1, []))
+        self.assertEqual(POSTS.value('dropped'), dropped + 1)
+
+    def test_stop_sends_whats_queued(self):
+        slack = FakeSlack()
+        sender = PostSender(slack.make_post, num_workers=2, rate=50, burst=1)
+        for i in range(5):
+            for channel in ('C1', 'C2'):
+                sender.send(channel, unicode(i))
+        sender.stop()
+        self.assertEqual(len(slack.posts), 10)
+        self.assertEqual(len(sender), 0)
+        self.assertFalse(any(worker.is_alive() for worker in sender._workers))
+
+if __name__ == '__main__':
+    unittest.main()
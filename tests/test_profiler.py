@@ -0,0 +1,92 @@
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+
+from slack_profiler import ProfileSession
+
+def busy_handler(seconds=0.05):
+    "Stands in for handling a message: keeps the CPU busy for a while."
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+    return 'handled'
+
+def read_collapsed(path):
+    "A collapsed stacks file, as {stack: count}."
+    with open(path) as collapsed:
+        return dict((stack, int(count)) for stack, count in
+                    (line.rsplit(' ', 1) for line in collapsed.read().splitlines()))
+
+class ProfileSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.done = []
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def session(self, **kwargs):
+        return ProfileSession(out_dir=self.out_dir, on_done=lambda *args: self.done.append(args), **kwargs)
+
+    def test_cprofile_stops_after_messages(self):
+        session = self.session(mode='cprofile', messages=2).start()
+        self.assertEqual(session.run(busy_handler), 'handled')
+        self.assertTrue(session.active)
+        self.assertEqual(session.run(busy_handler), 'handled')
+        self.assertFalse(session.active)
+        # Once it's done, messages just run.
+        self.assertEqual(session.run(busy_handler), 'handled')
+        self.assertEqual(session.num_messages, 2)
+
+        [(finished, summary)] = self.done
+        self.assertIs(finished, session)
+        self.assertIn('Profiled (cprofile) 2 messages', summary)
+        self.assertIn('busy_handler', summary)
+        stats = pstats.Stats(session.path)
+        self.assertTrue(any(name == 'busy_handler' for _, _, name in stats.stats))
+        # The same, as collapsed stacks, in microseconds.
+        self.assertEqual(session.paths[0], session.path)
+        self.assertTrue(session.paths[1].endswith('.collapsed'))
+        stacks = read_collapsed(session.paths[1])
+        busy = sum(count for stack, count in stacks.iteritems()
+                   if 'test_profiler.py:busy_handler' in stack.split(';'))
+        self.assertGreater(busy, 0.08 * 1e6)
+        self.assertLess(busy, sum(stacks.itervalues()) * 1.01)
+
+    def test_sample(self):
+        session = self.session(mode='sample', interval=0.001).start()
+        session.run(lambda: busy_handler(0.2))
+        session.stop()
+
+        [(_, summary)] = self.done
+        self.assertIn('Profiled (sample) 1 message', summary)
+        self.assertTrue(session.path.endswith('.collapsed'))
+        stacks = read_collapsed(session.path)
+        self.assertTrue(stacks)
+        self.assertTrue(all(count > 0 for count in stacks.itervalues()))
+        self.assertTrue(any(stack.endswith('test_profiler.py:busy_handler') for stack in stacks))
+        # The same samples, as pstats, with a sample's worth of time for each.
+        self.assertEqual(session.paths, (session.path, session.path[:-len('.collapsed')] + '.pstats'))
+        stats = pstats.Stats(session.paths[1]).stats
+        [busy] = [func for func in stats if func[2] == 'busy_handler']
+        busy_samples = sum(count for stack, count in stacks.iteritems()
+                           if stack.endswith('test_profiler.py:busy_handler'))
+        self.assertAlmostEqual(stats[busy][2], busy_samples * 0.001)
+        self.assertIn('test_profiler.py', [caller[0] for caller in stats[busy][4]])
+
+    def test_stop_waits_for_messages_in_flight(self):
+        session = self.session(mode='cprofile').start()
+        def handler():
+            session.stop()
+            self.assertEqual(self.done, [])
+            return busy_handler(0.01)
+        session.run(handler)
+        self.assertEqual(len(self.done), 1)
+        self.assertTrue(os.path.exists(session.path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from game_journal import GameJournal
+from game_objects import deck_dict
+from slack_dicebot import GameRegistry, RegexCardGame, fork_shards
+from slack_objects import Message
+from slack_token import BOT_USER_NAME
+from tests.test_channel_dispatcher import interface, said
+
+def message(chan_id, text, user_id='U1'):
+    return Message(text=u'@{} {}'.format(BOT_USER_NAME, text), user_id=user_id, user_name=user_id,
+                   chan_id=chan_id, chan_name=chan_id, im=False)
+
+def close(journal):
+    "Close the journal and wait for its thread to finish, so the next fork doesn't see it."
+    journal.close()
+    if journal._committer is not None:
+        journal._committer.join()
+
+class ShardingTest(unittest.TestCase):
+
+    CHANNELS = ['C{}'.format(number) for number in range(6)]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'games.journal')
+        self.game_factory = lambda: RegexCardGame(deck=deck_dict['major_arcana'].copy())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_journal_starts_no_thread_until_appended_to(self):
+        journal = GameJournal(self.path)
+        registry = GameRegistry(self.game_factory, journal)
+        self.assertIsNone(journal._committer)
+        registry.respond_in_channel('C1', message('C1', u'wake'))
+        registry.respond_in_channel('C1', message('C1', u'join'))
+        self.assertTrue(journal._committer.is_alive())
+        close(journal)
+
+    def test_games_answer_from_workers(self):
+        # A journal with games in it, recovered before the fork, as main() does.
+        journal = GameJournal(self.path)
+        registry = GameRegistry(self.game_factory, journal)
+        for chan_id in self.CHANNELS:
+            registry.respond_in_channel(chan_id, message(chan_id, u'wake'))
+        close(journal)
+        journal = GameJournal(self.path)
+        registry = GameRegistry(self.game_factory, journal)
+        self.assertEqual(len(registry), len(self.CHANNELS))
+
+        threads = threading.active_count()
+        dispatcher = fork_shards(registry, 2)
+        self.assertEqual(threading.active_count(), threads)
+        results = []
+        dispatcher.start(results.append)
+        for chan_id in self.CHANNELS:
+            for text in (u'join', u'list'):
+                msg = message(chan_id, text)
+                dispatcher.submit(registry.route_key(msg), msg)
+        dispatcher.stop()
+        close(journal)
+
+        answers = dict((chan_id, []) for chan_id in self.CHANNELS)
+        journaled = set()
+        for kind, payload in results:
+            if kind == 'responses':
+                chan_id, responses = payload
+                answers[chan_id].extend(response.text for response in responses)
+            elif kind == 'journal':
+                journaled.add(payload[0])
+        for chan_id in self.CHANNELS:
+            # Every channel's game was still awake in its worker, and answered in order.
+            self.assertEqual(len(answers[chan_id]), 2, answers[chan_id])
+            self.assertIn(u'<@u1>', answers[chan_id][1])
+        self.assertEqual(journaled, set(self.CHANNELS))
+
+    def test_routes_go_when_a_worker_drops_the_game(self):
+        si = interface([said(u'wake'), said(u'sleep'), said(u'quit', 'C2', 'U2')])
+        self.assertRaises(SystemExit, si.listen_sharded, fork_shards(si.responder, 2))
+        self.assertEqual(si.responder._user_id_to_game_chan_id, {'U2':'C2'})
+
+    def test_stop_without_start(self):
+        dispatcher = fork_shards(GameRegistry(self.game_factory), 2)
+        dispatcher.submit('C1', message('C1', u'wake'))
+        dispatcher.stop()
+        self.assertFalse(dispatcher.exit_requested)
+
+    def test_quit_stops_listening_without_another_message(self):
+        si = interface([said(u'wake'), said(u'quit', 'C2')])
+        dispatcher = fork_shards(si.responder, 2)
+        start = time.time()
+        self.assertRaises(SystemExit, si.listen_sharded, dispatcher)
+        self.assertTrue(si.socket.stalled.is_set())
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual([channel for channel, _ in si.slack.posts], ['C1'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+
+from slack_directory import DIRECTORY_LOOKUPS, SlackDirectory
+
+class Response(object):
+    def __init__(self, body):
+        self.body = body
+
+class Endpoint(object):
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+class Event(object):
+    def __init__(self, type, **event):
+        self.type = type
+        self.event = event
+
+class ListsSlack(object):
+    "Just the list APIs, each of which calls during(name) before it answers, as though it took a while."
+
+    def __init__(self, users, channels, groups, during=lambda name: None):
+        self.lists = {'users':users, 'channels':channels, 'groups':groups, 'im':{}}
+        self.during = during
+        self.users = Endpoint(list=self._list('users', 'members'))
+        self.channels = Endpoint(list=self._list('channels', 'channels'))
+        self.groups = Endpoint(list=self._list('groups', 'groups'))
+        self.im = Endpoint(list=self._list('im', 'ims'))
+
+    def _list(self, name, key):
+        def api_call():
+            self.during(name)
+            return Response({key:[{'id':item_id, 'name':item_name}
+                                  for item_id, item_name in sorted(self.lists[name].items())]})
+        return api_call
+
+class RefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.slack = ListsSlack({'U1':'alice'}, {'C1':'general', 'C2':'random'}, {'G1':'secret'})
+        self.directory = SlackDirectory(self.slack)
+        self.directory.refresh()
+
+    def test_private_channels_never_go_missing(self):
+        seen = []
+        self.slack.during = lambda name: seen.append((name, self.directory.channel('G1')))
+        self.directory.refresh()
+        self.assertEqual(seen, [(name, ('secret', False)) for name in ('users', 'channels', 'groups', 'im')])
+        self.assertEqual(self.directory.chan_id_to_chan_name, {'C1':'general', 'C2':'random', 'G1':'secret'})
+
+    def test_events_during_a_refresh_win(self):
+        # The lists were made before these events, so they still have the old names.
+        def during(name):
+            if name == 'channels':
+                self.directory.handle_event(Event('channel_rename', channel={'id':'C1', 'name':'lobby'}))
+                self.directory.handle_event(Event('channel_deleted', channel='C2'))
+                self.directory.handle_event(Event('team_join', user={'id':'U2', 'name':'bob'}))
+        self.slack.during = during
+        self.directory.refresh()
+        self.assertEqual(self.directory.chan_id_to_chan_name, {'C1':'lobby', 'G1':'secret'})
+        self.assertEqual(self.directory.user_id_to_user_name, {'U1':'alice', 'U2':'bob'})
+
+    def test_refresh_after_events(self):
+        self.directory.handle_event(Event('channel_rename', channel={'id':'C1', 'name':'lobby'}))
+        self.slack.lists['channels']['C1'] = 'town-square'
+        self.directory.refresh()
+        # Once it's done, the next refresh has the last word.
+        self.assertEqual(self.directory.channel('C1'), ('town-square', False))
+
+    def test_failed_refresh_changes_nothing(self):
+        def during(name):
+            if name == 'groups':
+                raise IOError("timed out")
+        self.slack.during = during
+        self.slack.lists['channels']['C1'] = 'lobby'
+        self.assertRaises(IOError, self.directory.refresh)
+        self.assertEqual(self.directory.channel('C1'), ('general', False))
+        self.directory.handle_event(Event('channel_rename', channel={'id':'C1', 'name':'lobby'}))
+        self.assertIsNone(self.directory._changes)
+
+class LookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.slack = ListsSlack({}, {}, {})
+        self.error = None
+        self.calls = 0
+        self.slack.users.info = self._info
+        self.slack.channels.info = self._info
+        self.slack.im.open = self._info
+        self.directory = SlackDirectory(self.slack)
+
+    def _info(self, item_id):
+        self.calls += 1
+        raise StandardError, self.error
+
+    def test_missing_ids_are_remembered(self):
+        for error, lookup, item_id in (
+                ('user_not_found', self.directory.user_name, 'U9'),
+                ('channel_not_found', self.directory.channel, 'C9'),
+                ('user_not_found', self.directory.im_channel, 'U9')):
+            self.error, self.calls = error, 0
+            negative_hits = DIRECTORY_LOOKUPS.value('negative_hit')
+            self.assertRaises(ValueError, lookup, item_id)
+            self.assertRaises(ValueError, lookup, item_id)
+            self.assertEqual(self.calls, 1, lookup)
+            self.assertEqual(DIRECTORY_LOOKUPS.value('negative_hit'), negative_hits + 1)
+
+    def test_failed_calls_are_tried_again(self):
+        for error in ('ratelimited', 'timed out'):
+            for lookup, item_id in (
+                    (self.directory.user_name, 'U9'), (self.directory.channel, 'C9'),
+                    (self.directory.im_channel, 'U9')):
+                self.error, self.calls = error, 0
+                self.assertRaises(ValueError, lookup, item_id)
+                self.assertRaises(ValueError, lookup, item_id)
+                self.assertEqual(self.calls, 2, (error, lookup))
+        self.assertEqual(self.directory._missing_until, {})
+
+if __name__ == '__main__':
+    unittest.main()
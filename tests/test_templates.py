@@ -0,0 +1,83 @@
+# coding=utf-8
+
+import random
+import unittest
+
+from game_objects import CardPile, deck_dict
+from slack_templates import CardListRenderer, Template
+
+class TemplateTest(unittest.TestCase):
+
+    def test_renders_like_format(self):
+        for text, fields in (
+                (u'@{name} has {count} cards', dict(name=u'bob', count=3)),
+                (u'{total:,} = {detail!r}, {total:>8}', dict(total=12345, detail=u'x')),
+                (u'{{literal}} braces and no fields', {}),
+                (u'{a}{b}{a}', dict(a=u'é', b=1))):
+            self.assertEqual(Template(text).render(**fields), text.format(**fields))
+
+    def test_field_names(self):
+        self.assertEqual(Template(u'{b} {a:>3} {b!s}').field_names, ('a', 'b'))
+
+    def test_cached(self):
+        template = Template(u'hi {name}')
+        first = template.render(name=u'bob')
+        self.assertIs(template.render(name=u'bob'), first)
+        self.assertEqual(template.render(name=u'sue'), u'hi sue')
+
+class CardListRendererTest(unittest.TestCase):
+
+    def setUp(self):
+        self.renderer = CardListRenderer()
+        self.deck = deck_dict['poker_deck'].copy().shuffle()
+
+    def test_render(self):
+        cards = self.deck.draw(3)
+        self.assertEqual(self.renderer.render(cards).split(u'\n'),
+                         [u' • `{}`'.format(card.name) for card in sorted(cards)])
+        self.assertEqual(self.renderer.render(cards, sort=False).split(u'\n'),
+                         [u' • `{}`'.format(card.name) for card in cards])
+
+    def test_render_pile_follows_changes(self):
+        pile = CardPile(self.deck.draw(3), name=u'Hand', indexed=True)
+        text = self.renderer.render_pile('U1', pile)
+        self.assertIs(self.renderer.render_pile('U1', pile), text)
+        pile.add(self.deck.draw(1))
+        self.assertEqual(self.renderer.render_pile('U1', pile), self.renderer.render(pile.peek()))
+        text = self.renderer.render_pile('U1', pile)
+        self.assertEqual(len(text.split(u'\n')), 4)
+        self.renderer.forget('U1')
+        self.assertIsNot(self.renderer.render_pile('U1', pile), text)
+        self.assertEqual(self.renderer.render_pile('U1', pile), text)
+
+    def test_render_pile_splices_changes(self):
+        rng = random.Random(7)
+        for indexed in (False, True):
+            deck = deck_dict['poker_deck'].copy().shuffle()
+            pile = CardPile(deck.draw(5), name=u'Hand', indexed=indexed)
+            for _ in range(200):
+                action = rng.random()
+                if action < 0.5 and len(deck):
+                    pile.add(deck.draw(rng.randint(1, min(3, len(deck)))))
+                elif action < 0.9 and len(pile):
+                    deck.insert(pile.pull_named(rng.choice(list(pile.peek())).name))
+                elif action < 0.95:
+                    deck.insert(list(pile.pull(rng.randint(0, 3), lambda card: rng.random() < 0.5)))
+                else:
+                    deck.insert(list(pile.pull('all')))
+                self.assertEqual(self.renderer.render_pile('U1', pile), self.renderer.render(pile.peek()))
+
+    def test_render_pile_renders_only_new_cards(self):
+        cards = self.deck.draw(10)
+        pile = CardPile(cards, name=u'Hand', indexed=True)
+        self.renderer.render_pile('U1', pile)
+        rendered = []
+        self.renderer._pile_texts['U1']._render_line = lambda name: rendered.append(name) or name
+        new_card = self.deck.draw(1)[0]
+        pile.add(new_card)
+        pile.pull_named(cards[0].name)
+        self.renderer.render_pile('U1', pile)
+        self.assertEqual(rendered, [new_card.name])
+
+if __name__ == '__main__':
+    unittest.main()